@@ -154,6 +154,7 @@ from fabfileTemplate.utils import overwrite_defaults, failure
 from fabfileTemplate.system import check_command, get_linux_flavor, MACPORT_DIR
 from fabfileTemplate.APPcommon import virtualenv, APP_doc_dependencies, APP_source_dir
 from fabfileTemplate.APPcommon import APP_root_dir, extra_python_packages, APP_user, build
+from fabfileTemplate.APPcommon import install_python_packages
 from fabfileTemplate.pkgmgr import check_brew_port, check_brew_cellar
 
 # get the settings from the fab environment if set on command line
@@ -206,7 +207,7 @@ def build_APP():
     with cd(APP_source_dir()):
         extra_pkgs = extra_python_packages()
         if extra_pkgs:
-            virtualenv('pip install %s' % ' '.join(extra_pkgs))
+            install_python_packages(extra_pkgs)
         develop = False
         no_doc_dependencies = APP_doc_dependencies()
         build_cmd = APP_build_cmd()
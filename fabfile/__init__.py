@@ -30,8 +30,11 @@ Other tasks, including lower-level tasks, can also be invoked.
 from . import APPspecific
 from fabfileTemplate import APPcommon
 from fabfileTemplate import aws
+from fabfileTemplate import executor
+from fabfileTemplate import facts
 from fabfileTemplate import hl
 from fabfileTemplate import pkgmgr
+from fabfileTemplate import steps
 from fabfileTemplate import system
 from fabfileTemplate import utils
 
@@ -26,18 +26,29 @@ sources, installing it and making sure it works after starting it.
 NOTE: This requires modifications for the specific application where this
 fabfile is used. Please make sure not to use it without those modifications.
 """
+import base64
 import contextlib
 import functools
+import glob
+import hashlib
+import inspect
+import json
+import re
+import shutil
+import tarfile
+import zlib
 from six.moves import http_client as httplib
 import os
+import pkg_resources
 import tempfile
+import time
 from six.moves.urllib import parse as urlparse
 
 
-from fabric.context_managers import settings, cd
+from fabric.context_managers import settings, cd, hide, shell_env
 from fabric.contrib.files import exists, sed
 from fabric.decorators import task, parallel
-from fabric.operations import local, put
+from fabric.operations import local, put, get
 from fabric.state import env
 from fabric.utils import abort
 from fabric.colors import red
@@ -46,8 +57,12 @@ from fabfileTemplate.pkgmgr import install_system_packages, check_brew_port, che
 from fabfileTemplate.system import check_dir, download, check_command, \
     create_user, get_linux_flavor, python_setup, check_python, \
     MACPORT_DIR
+from fabfileTemplate import delta
+from fabfileTemplate.facts import host_fact
+from fabfileTemplate.fanout import fanout_degree, fanout_path, local_checksum, remote_checksum
+from fabfileTemplate.steps import Step, run_steps
 from fabfileTemplate.utils import is_localhost, home, default_if_empty, sudo, run, success,\
-    info
+    info, local_cache_dir, local_lock, stream_to_remote, exchange_with_remote
 
 # Don't re-export the tasks imported from other modules, only the ones defined
 # here
@@ -55,7 +70,8 @@ __all__ = [
     'virtualenv_setup',
     'install_user_profile',
     'copy_sources',
-    'install_and_check'
+    'install_and_check',
+    'benchmark_copy_sources',
 ]
 
 APP_NAME_DEFAULT = 'DEFAULT'
@@ -82,6 +98,35 @@ APP_REPO_ROOT_DEFAULT = os.path.abspath(os.path.join(os.path.dirname(__file__),
 
 APP_REPO_GIT_DEFAULT = False
 
+# Number of source tarballs kept in the local artifact cache
+APP_ARTIFACT_CACHE_KEEP_DEFAULT = 10
+
+# How sources are transferred to the target host:
+#  * tarball: a (cached) tarball is uploaded and extracted
+#  * stream: the tar stream is piped directly into tar on the host
+#  * delta: only the changed blocks of changed files are sent (rsync-style)
+APP_SOURCES_TRANSFER_MODES = ['tarball', 'stream', 'delta']
+APP_SOURCES_TRANSFER_DEFAULT = 'tarball'
+
+# Where the wheelhouse of the extra python packages is built:
+#  * '' (empty): no wheelhouse, every host runs pip install from PyPI
+#  * host: on the first target host of each python/platform/OS combination
+#  * local: on the control node, if its python/platform/OS match the target's
+APP_WHEELHOUSE_MODES = ['', 'host', 'local']
+APP_WHEELHOUSE_DEFAULT = ''
+
+# Prints the python and platform tags of the running interpreter, and the
+# C library and OS release it runs on: compiled extensions built on another
+# distribution (or glibc version) of the same platform may not load
+PYTHON_TAG_SNIPPET = ("import os, platform, re, sys, sysconfig; "
+                      "f = '/etc/os-release'; "
+                      "rel = dict(re.findall('^(ID|VERSION_ID)=[^A-Za-z0-9]*([A-Za-z0-9._]*)', "
+                      "open(f).read(), re.M)) if os.path.exists(f) else dict(); "
+                      "parts = ['cp%d%d' % (sys.version_info[0], sys.version_info[1]), "
+                      "sysconfig.get_platform(), ''.join(platform.libc_ver()) or 'unknownlibc', "
+                      "rel.get('ID', 'unknown') + rel.get('VERSION_ID', '')]; "
+                      "print('-'.join(re.sub('[^A-Za-z0-9]', '_', p) for p in parts))")
+
 DEFAULT_PYTHON_PKGS = [
     # Install myself into new environment
     'git+https://github.com/ICRAR/fabfileTemplate'
@@ -105,6 +150,13 @@ def APP_repo_git():
     default_if_empty(env, 'APP_REPO_GIT', APP_REPO_GIT_DEFAULT)
     return env.APP_REPO_GIT
 
+def APP_sources_transfer():
+    default_if_empty(env, 'APP_SOURCES_TRANSFER', APP_SOURCES_TRANSFER_DEFAULT)
+    if env.APP_SOURCES_TRANSFER not in APP_SOURCES_TRANSFER_MODES:
+        abort('APP_SOURCES_TRANSFER must be one of {0}'.format(
+            ', '.join(APP_SOURCES_TRANSFER_MODES)))
+    return env.APP_SOURCES_TRANSFER
+
 def APP_user():
     default_if_empty(env, 'APP_USER', APP_USER)
     return env.APP_USER
@@ -126,6 +178,16 @@ def APP_overwrite_installation():
     return False
 
 
+def APP_venv_reconcile():
+    key = 'APP_VENV_RECONCILE'
+    return key in env and env[key] != False
+
+
+def APP_venv_snapshot():
+    key = 'APP_VENV_SNAPSHOT'
+    return key in env and env[key] != False
+
+
 def APP_use_custom_pip_cert():
     key = 'APP_USE_CUSTOM_PIP_CERT'
     return key in env
@@ -174,7 +236,7 @@ def APP_revision():
 def extra_python_packages():
     key = 'APP_EXTRA_PYTHON_PACKAGES'
     if key in env.pkgs:
-        env.pkgs[key] += DEFAULT_PYTHON_PKGS
+        env.pkgs[key] += [p for p in DEFAULT_PYTHON_PKGS if p not in env.pkgs[key]]
         return env.pkgs[key]
     else:
         env.pkgs[key] = DEFAULT_PYTHON_PKGS
@@ -189,11 +251,83 @@ def virtualenv(command, **kwargs):
     return run('source {0}/bin/activate && {1}'.format(nid, command), **kwargs)
 
 
+def venv_snapshot_key(ppath):
+    """
+    Returns the hash identifying a virtualenv: its interpreter and platform,
+    the extra python packages and the requirements of the APP
+    """
+    h = hashlib.sha256()
+    interpreter = run('{0} -V 2>&1'.format(ppath), quiet=True)
+    for item in (ppath, interpreter, get_linux_flavor(), host_fact('arch', '')):
+        h.update(item.encode('utf-8') + b'\n')
+    packages = env.pkgs.get('APP_EXTRA_PYTHON_PACKAGES') or []
+    for pkg in sorted(set(packages + DEFAULT_PYTHON_PKGS)):
+        h.update(pkg.encode('utf-8') + b'\n')
+    for fname in ('requirements.txt', 'setup.py', 'setup.cfg', 'pyproject.toml'):
+        path = os.path.join(APP_repo_root(), fname)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()[:24]
+
+
+def _venv_snapshot_file(key):
+    return os.path.join(local_cache_dir('venvs'), key + '.tar.gz')
+
+
+def restore_venv_snapshot(key, install_dir):
+    """
+    Restores the virtualenv snapshot for key into install_dir, if there is
+    one. Virtualenvs hardcode their location in their scripts, pyvenv.cfg and
+    the .pth and .egg-link files of their packages, so these are rewritten if
+    the snapshot was taken somewhere else.
+    """
+    snapshot = _venv_snapshot_file(key)
+    if not os.path.exists(snapshot):
+        info('No virtualenv snapshot for {0}'.format(key))
+        return False
+    with open(snapshot + '.prefix', 'rt') as f:
+        prefix = f.read().strip()
+    remote_tarball = '/tmp/{0}_venv.tar.gz'.format(APP_name())
+    put(snapshot, remote_tarball)
+    run('mkdir -p {0} && tar xzf {1} -C {0} && rm {1}'.format(install_dir, remote_tarball))
+    if prefix != install_dir:
+        run("find {1} \\( -path '{1}/bin/*' -o -name pyvenv.cfg -o -name '*.pth' "
+            "-o -name '*.egg-link' \\) -type f -print0 | xargs -0 -r grep -lIFZ -e '{0}' | "
+            "xargs -0 -r sed -i 's|{0}|{1}|g'".format(prefix, install_dir), warn_only=True)
+    env.APP_VENV_RESTORED = True
+    return True
+
+
+def save_venv_snapshot(key):
+    """
+    Stores the virtualenv of the current host as the snapshot for key
+    """
+    snapshot = _venv_snapshot_file(key)
+    with local_lock(snapshot + '.lock'):
+        if os.path.exists(snapshot):
+            return
+        install_dir = APP_install_dir()
+        remote_tarball = '/tmp/{0}_venv.tar.gz'.format(APP_name())
+        run('tar czf {0} -C {1} .'.format(remote_tarball, install_dir))
+        get(remote_tarball, snapshot + '.tmp')
+        run('rm {0}'.format(remote_tarball))
+        with open(snapshot + '.prefix', 'wt') as f:
+            f.write(install_dir)
+        os.rename(snapshot + '.tmp', snapshot)
+    info('Saved virtualenv snapshot {0}'.format(key))
+
+
 @task
 def virtualenv_setup():
     """
     Creates a new virtualenv that will hold the APP installation
     """
+    # The state of the virtualenv of a previous host doesn't apply to this one
+    env.APP_VENV_RESTORED = False
+    env.APP_VENV_RECONCILING = False
+    env.APP_VENV_KEY = None
+
     APPInstallDir = APP_install_dir()
     if check_dir(APPInstallDir):
         overwrite = APP_overwrite_installation()
@@ -201,6 +335,11 @@ def virtualenv_setup():
             msg = ("%s exists already. Specify APP_OVERWRITE_INSTALLATION "
                    "to overwrite, or a different APP_INSTALL_DIR location")
             abort(msg % (APPInstallDir,))
+        if APP_venv_reconcile():
+            # build() will only change the packages that differ
+            env.APP_VENV_RECONCILING = True
+            success("Reusing existing virtualenv")
+            return
         run("rm -rf %s" % (APPInstallDir,))
 
     # Check which python will be bound to the virtualenv
@@ -208,14 +347,6 @@ def virtualenv_setup():
     if not ppath:
         ppath = python_setup(os.path.join(home(), 'python'))
 
-    # Use our create_venv.sh script to create the virtualenv
-    # It already handles the download automatically if no virtualenv command is
-    # found in the system, and also allows to specify a python executable path
-    script_path = os.path.dirname(os.path.realpath(__file__))+'/create_venv.sh'
-    put(script_path, APP_source_dir()+'/create_venv.sh')
-    with cd(APP_source_dir()):
-        run("/bin/bash create_venv.sh -p {0} {1}".format(ppath, APPInstallDir))
-
     # Download this particular certifcate; otherwise pip complains
     # in some platforms
     if APP_use_custom_pip_cert():
@@ -226,6 +357,23 @@ def virtualenv_setup():
         run('echo "[global]" > ~/.pip/pip.conf; echo '
             '"cert = {0}/.pip/cacert.pem" >> ~/.pip/pip.conf;'.format(home()))
 
+    if APP_venv_snapshot():
+        env.APP_VENV_KEY = venv_snapshot_key(ppath)
+        if restore_venv_snapshot(env.APP_VENV_KEY, APPInstallDir):
+            success("Virtualenv restored from snapshot")
+            return
+
+    # Use our create_venv.sh script to create the virtualenv
+    # It already handles the download automatically if no virtualenv command is
+    # found in the system, and also allows to specify a python executable path
+    # The script doesn't go into the sources directory, which might be
+    # (re)created by copy_sources at the same time
+    script_path = os.path.dirname(os.path.realpath(__file__))+'/create_venv.sh'
+    remote_script = run('mktemp', quiet=True)
+    put(script_path, remote_script)
+    run("/bin/bash {0} -p {1} {2}; status=$?; rm -f {0}; exit $status".format(
+        remote_script, ppath, APPInstallDir))
+
     # Update pip and install wheel; this way we can install binary wheels from
     # PyPI if available (like astropy)
     # TODO: setuptools and python-daemon are here only because
@@ -255,6 +403,182 @@ def create_sources_tarball(tarball_filename):
         local('cd {0}; tar czf {1} .'.format(repo_root, tarball_filename))
 
 
+def sources_cache_key():
+    """
+    Returns the key identifying the contents of the sources tarball:
+    the resolved revision (git archive ships only committed files, so
+    uncommitted changes don't matter) or a hash of the tree listing when
+    there is no git repository, and the APP_REPO_GIT flag
+    """
+    repo_root = APP_repo_root()
+    h = hashlib.sha1()
+    if has_local_git_repo():
+        with settings(hide('everything')):
+            rev = local('cd {0}; git rev-parse {1}'.format(repo_root, APP_revision()),
+                        capture=True)
+    else:
+        # No git, the tree itself is all we have
+        rev = 'local'
+        for root, dirs, files in os.walk(repo_root):
+            dirs.sort()
+            for fname in sorted(files):
+                path = os.path.join(root, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                h.update('{0}:{1}:{2}\n'.format(path, st.st_size, st.st_mtime).encode('utf-8'))
+    return '{0}-{1}-{2}{3}'.format(APP_name(), rev[:12], h.hexdigest()[:12],
+                                   '-git' if APP_repo_git() else '')
+
+
+def _prune_sources_cache(cache_dir):
+    default_if_empty(env, 'APP_ARTIFACT_CACHE_KEEP', APP_ARTIFACT_CACHE_KEEP_DEFAULT)
+    tarballs = glob.glob(os.path.join(cache_dir, '*.tar.gz'))
+    tarballs.sort(key=os.path.getmtime, reverse=True)
+    for tarball in tarballs[int(env.APP_ARTIFACT_CACHE_KEEP):]:
+        os.unlink(tarball)
+
+    # Expanded trees of tarballs that are gone
+    trees_dir = local_cache_dir('artifacts', 'trees')
+    for tree in os.listdir(trees_dir):
+        name = tree[:-len('.lock')] if tree.endswith('.lock') else tree
+        if not os.path.exists(os.path.join(cache_dir, name + '.tar.gz')):
+            path = os.path.join(trees_dir, tree)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.unlink(path)
+
+
+def sources_tarball():
+    """
+    Returns the path of the sources tarball in the local artifact cache,
+    building it first if needed. The build happens under a lock, so when
+    many hosts are deployed in parallel the tarball is built only once,
+    and later runs of the same revision reuse it.
+    """
+    cache_dir = local_cache_dir('artifacts', 'sources')
+    tarball = os.path.join(cache_dir, sources_cache_key() + '.tar.gz')
+    with local_lock(os.path.join(cache_dir, '.lock')):
+        if os.path.exists(tarball):
+            os.utime(tarball, None)
+            info('Reusing sources tarball {0}'.format(tarball))
+            return tarball
+
+        # Build with a temporary name so an interrupted build is never reused
+        tmp_tarball = '{0}.{1}.tmp'.format(tarball[:-len('.tar.gz')], os.getpid())
+        if APP_repo_git() and has_local_git_repo():
+            # In this case the compression is done after git archive
+            create_sources_tarball(tmp_tarball + '.tar')
+            tmp_tarball += '.tar.gz'
+        else:
+            tmp_tarball += '.tar.gz'
+            create_sources_tarball(tmp_tarball)
+        os.rename(tmp_tarball, tarball)
+        _prune_sources_cache(cache_dir)
+    return tarball
+
+
+def sources_tar_commands():
+    """
+    Returns the local commands whose tar outputs make up the sources
+    """
+    if has_local_git_repo():
+        commands = ['git archive --format=tar {0}'.format(APP_revision())]
+        if APP_repo_git():
+            commands.append('tar cf - .git*')
+    else:
+        commands = ['tar cf - .']
+    return commands
+
+
+def stream_sources(nsd):
+    """
+    Pipes the sources straight into tar on the target host, without any
+    intermediate file. Returns the number of (compressed) bytes sent.
+    """
+    repo_root = APP_repo_root()
+    run('mkdir -p {0}'.format(nsd))
+    nbytes = 0
+    for tar_cmd in sources_tar_commands():
+        nbytes += stream_to_remote('cd {0}; {1} | gzip -1'.format(repo_root, tar_cmd),
+                                   'cd {0} && tar xpzf -'.format(nsd))
+    return nbytes
+
+
+def sources_tree():
+    """
+    Returns the directory where the sources tarball is expanded locally,
+    and the manifest of its files
+    """
+    tarball = sources_tarball()
+    name = os.path.basename(tarball)[:-len('.tar.gz')]
+    tree = os.path.join(local_cache_dir('artifacts', 'trees'), name)
+    manifest_file = os.path.join(tree, '.manifest.json')
+    with local_lock(tree + '.lock'):
+        if not os.path.exists(manifest_file):
+            shutil.rmtree(tree, ignore_errors=True)
+            with tarfile.open(tarball) as tar:
+                tar.extractall(tree)
+            manifest = delta.manifest(tree)
+            with open(manifest_file, 'wt') as f:
+                json.dump(manifest, f)
+            return tree, manifest
+    with open(manifest_file, 'rt') as f:
+        return tree, json.load(f)
+
+
+def _remote_delta_command(python, mode, nsd, block_size):
+    program = base64.b64encode(zlib.compress(inspect.getsource(delta).encode('utf-8')))
+    return ("{0} -c 'import base64,zlib;exec(zlib.decompress(base64.b64decode(\"{1}\")))' "
+            "{2} {3} {4}").format(python, program.decode('ascii'), mode, nsd, block_size)
+
+
+def delta_sources(nsd):
+    """
+    Brings APP_source_dir() up to date by sending only the blocks that
+    changed since the last deployment, using rsync's rolling checksums.
+    Falls back to streaming the sources if there is nothing to compare with
+    or no python on the target host.
+    """
+    python = check_command('python3') or check_command('python')
+    if not python or not check_dir(nsd):
+        info('No previous sources or python in target host, streaming them')
+        return stream_sources(nsd)
+
+    default_if_empty(env, 'APP_DELTA_BLOCK_SIZE', delta.DEFAULT_BLOCK_SIZE)
+    block_size = int(env.APP_DELTA_BLOCK_SIZE)
+    tree, manifest = sources_tree()
+    manifest.pop('.manifest.json', None)
+
+    request = zlib.compress(json.dumps(manifest).encode('utf-8'))
+    signatures = json.loads(exchange_with_remote(
+        _remote_delta_command(python, 'signatures', nsd, block_size), request).decode('utf-8'))
+
+    patch = {}
+    literal_bytes = 0
+    for relpath, sigs in signatures.items():
+        if sigs is None:
+            continue
+        entry = manifest[relpath]
+        if entry[0] == 'link':
+            patch[relpath] = {'type': 'link', 'target': entry[1]}
+            continue
+        with open(os.path.join(tree, relpath), 'rb') as f:
+            data = f.read()
+        ops = delta.compute_delta(data, sigs if sigs != 'missing' else [], block_size)
+        literal_bytes += sum(len(op) for op in ops if not isinstance(op, int))
+        patch[relpath] = {'type': 'file', 'ops': ops, 'mtime': entry[1], 'mode': entry[3]}
+
+    if patch:
+        request = zlib.compress(json.dumps(patch).encode('utf-8'))
+        exchange_with_remote(_remote_delta_command(python, 'patch', nsd, block_size), request)
+    info('Delta sync: {0} of {1} files changed, {2} bytes of literal data sent'.format(
+        len(patch), len(manifest), literal_bytes))
+    return literal_bytes
+
+
 @task
 def copy_sources():
     """
@@ -267,22 +591,27 @@ def copy_sources():
 
     nsd = APP_source_dir()
 
-    # Because this could be happening in parallel in various machines
-    # we generate a tmpfile locally, but the target file is the same
-    repo_git = APP_repo_git()
-    if not repo_git:
-        local_file = tempfile.mktemp(".tar.gz")
-    else:
-        #In this case the compression is done after git archive
-        local_file = tempfile.mktemp(".tar")
-    create_sources_tarball(local_file)
-    if repo_git:
-        local_file += ".gz"
+    transfer = APP_sources_transfer()
+    if transfer == 'stream':
+        stream_sources(nsd)
+        success("{0} sources streamed".format(APP_name()))
+        return
+    elif transfer == 'delta':
+        delta_sources(nsd)
+        success("{0} sources synchronized".format(APP_name()))
+        return
+
+    # The tarball is shared by all hosts (and later runs) of this revision
+    local_file = sources_tarball()
 
-    # transfer the tar file if not local
+    # transfer the tar file if not local, unless it was distributed already
     if not is_localhost():
         target_tarfile = '/tmp/{0}_tmp.tar'.format(APP_name())
-        put(local_file, target_tarfile)
+        if fanout_degree() > 0 and \
+           remote_checksum(fanout_path(local_file)) == local_checksum(local_file):
+            target_tarfile = fanout_path(local_file)
+        else:
+            put(local_file, target_tarfile)
     else:
         target_tarfile = local_file
 
@@ -294,12 +623,90 @@ def copy_sources():
         if not is_localhost():
             run('rm {0}'.format(target_tarfile))
 
-    # Cleaning up now
-    local('rm {0}'.format(local_file))
-
     success("{0} sources copied".format(APP_name()))
 
 
+def _disk_used(df_output):
+    """
+    Returns the KB used in each sample of the (concatenated) df -Pk output,
+    counting each filesystem once
+    """
+    samples = []
+    for line in df_output.splitlines():
+        fields = line.split()
+        if line.startswith('Filesystem'):
+            samples.append({})
+        elif samples and len(fields) >= 6 and fields[2].isdigit():
+            samples[-1][fields[-1]] = int(fields[2])
+    return [sum(s.values()) for s in samples if s]
+
+
+@contextlib.contextmanager
+def sampled_disk_use(paths, peak, interval=0.2):
+    """
+    Samples in the background the disk space used in the filesystems of paths
+    on the host while the block runs, and appends to peak how many bytes it
+    grew at most over what was used before the block
+    """
+    samples = '/tmp/{0}_disk_samples'.format(APP_name())
+    df = 'df -Pk {0}'.format(' '.join(paths))
+    run("{0} > {1} && (nohup sh -c 'while :; do {0}; sleep {2}; done' >> {1} 2>&1 & "
+        "echo $! > {1}.pid)".format(df, samples, interval), quiet=True)
+    try:
+        yield
+    finally:
+        run('kill $(cat {0}.pid); rm -f {0}.pid'.format(samples), quiet=True)
+    used = _disk_used(run('{0} >> {1}; cat {1}; rm -f {1}'.format(df, samples), quiet=True))
+    peak.append((max(used) - used[0]) * 1024 if used else 0)
+
+
+@task
+def benchmark_copy_sources():
+    """
+    Compares the tarball and stream transfer of the sources
+
+    The disk space each of them takes on the host at its peak is sampled,
+    so other writers on the same filesystems add noise to it.
+    """
+    nsd = APP_source_dir()
+    peaks = []
+
+    # Both modes start from an empty source directory so the disk space
+    # they take can be compared
+    run('rm -rf {0} && mkdir -p {0}'.format(nsd))
+
+    # tarball: build (uncached), upload, extract
+    start = time.time()
+    local_file = tempfile.mktemp('.tar.gz')
+    if APP_repo_git() and has_local_git_repo():
+        create_sources_tarball(local_file[:-3])
+    else:
+        create_sources_tarball(local_file)
+    tarball_size = os.path.getsize(local_file)
+    target_tarfile = '/tmp/{0}_tmp.tar'.format(APP_name())
+    with sampled_disk_use(['/tmp', nsd], peaks):
+        put(local_file, target_tarfile)
+        with cd(nsd):
+            run('tar xpf {0}'.format(target_tarfile))
+            run('rm {0}'.format(target_tarfile))
+    os.unlink(local_file)
+    tarball_time = time.time() - start
+
+    run('rm -rf {0} && mkdir -p {0}'.format(nsd))
+    with sampled_disk_use(['/tmp', nsd], peaks):
+        start = time.time()
+        stream_size = stream_sources(nsd)
+        stream_time = time.time() - start
+
+    info('{0:<8} {1:>10} {2:>12} {3:>14} {4:>16}'.format(
+        'mode', 'time [s]', 'sent [MB]', 'rate [MB/s]', 'peak disk [MB]'))
+    for mode, elapsed, size, disk in (('tarball', tarball_time, tarball_size, peaks[0]),
+                                      ('stream', stream_time, stream_size, peaks[1])):
+        mb = size / 1024. / 1024.
+        info('{0:<8} {1:>10.2f} {2:>12.2f} {3:>14.2f} {4:>16.2f}'.format(
+            mode, elapsed, mb, mb / max(elapsed, 1e-6), disk / 1024. / 1024.))
+
+
 @task
 def install_user_profile():
     """
@@ -356,28 +763,313 @@ def install_user_profile():
 #     abort(error)
 
 
+def _source_of(func):
+    """
+    Identifies an APPspecific function for the deployment journal, so steps
+    running it are repeated when it changes
+    """
+    if not func:
+        return None
+    try:
+        return inspect.getsource(func)
+    except (IOError, TypeError):
+        return repr(func)
+
+
+def _as_user(user, func):
+    def step():
+        with settings(user=user):
+            func()
+    return step
+
+
+def _prepare_data_dir():
+    env.APP_DATA_DIR_CFG = None
+    if 'prepare_APP_data_dir' in env:
+        env.APP_DATA_DIR_CFG = env.prepare_APP_data_dir()
+
+
+def _start_check():
+    if 'APP_start_check_function' in env:
+        env.APP_start_check_function()
+    else:
+        info('APP_start_check_function not defined in APPspecific')
+
+
+def copy_sources_tools_missing():
+    """
+    Returns whether the target host lacks the commands copy_sources needs:
+    tar, and python too when the sources are transferred as a delta.
+    """
+    if not check_command('tar'):
+        return True
+    if APP_sources_transfer() == 'delta':
+        return not (check_command('python3') or check_command('python'))
+    return False
+
+
+def install_and_check_steps(user=None, after=(), build_after=(), copy_after=()):
+    """
+    Returns the steps of install_and_check, run as user (or the current
+    one), starting after the given steps. build and the steps following it
+    also wait for build_after, and copy_sources for copy_after.
+    """
+    def step(name, func, deps, inputs=None):
+        return Step(name, _as_user(user, func) if user else func, deps, inputs)
+
+    after = tuple(after)
+    steps = [step('copy_sources', copy_sources, after + tuple(copy_after),
+                  lambda: [sources_cache_key(), APP_source_dir(), APP_sources_transfer()])]
+    build_deps = ('copy_sources',) + tuple(build_after)
+    if env.APP_PYTHON_URL:      # if APP needs python at all
+        steps.append(step('virtualenv_setup', virtualenv_setup, after + tuple(build_after),
+                          lambda: [env.APP_PYTHON_VERSION, env.APP_PYTHON_URL,
+                                   APP_install_dir(), extra_python_packages()]))
+        build_deps += ('virtualenv_setup',)
+    steps += [
+        step('build', build, build_deps,
+             lambda: [extra_python_packages(), _source_of(env.get('build_cmd')),
+                      _source_of(env.get('build_function'))]),
+        step('prepare_data_dir', _prepare_data_dir, ('build',),
+             lambda: _source_of(env.get('prepare_APP_data_dir'))),
+        # These are cheap, and always run
+        step('install_user_profile', install_user_profile, after),
+        step('start_check', _start_check, ('prepare_data_dir', 'install_user_profile')),
+    ]
+    return steps
+
+
 @parallel
 def prepare_install_and_check():
 
     # Install system packages, create user if necessary, install and start APP
+    # Copying the sources only needs the user (and tar), so it overlaps with
+    # the installation of the system packages unless the host still lacks
+    # the tools to unpack them. Steps with inputs are journaled,
+    # a failed deployment resumes from the step where it stopped
     nuser = APP_user()
-    install_system_packages()
-    create_user(nuser)
-    # Execute addition sudo related functions
-    env.APP_extra_sudo_function()
-    # postfix_config()
 
+    def init_install():
+        if 'APP_init_install_function' in env:
+            env.APP_init_install_function(APP_source_dir(), nuser, env.get('APP_DATA_DIR_CFG'))
+        else:
+            info('APP_init_install_function not defined in APPspecific')
+
+    def sysinit_start_check():
+        if 'sysinitAPP_start_check_function' in env:
+            env.sysinitAPP_start_check_function()
+        else:
+            info('sysinitAPP_start_check_function not defined in APPspecific')
+
+    steps = [
+        Step('system_packages', install_system_packages, (),
+             lambda: [env.pkgs, env.get('APP_EXTRA_PACKAGES')]),
+        Step('create_user', functools.partial(create_user, nuser), (), lambda: nuser),
+        # Execute addition sudo related functions
+        Step('extra_sudo', env.APP_extra_sudo_function, ('system_packages', 'create_user'),
+             lambda: _source_of(env.APP_extra_sudo_function)),
+        # postfix_config()
+    ]
     # Go, go, go!
-    with settings(user=nuser):
-        nsd, cfgfile = install_and_check()
-    if 'APP_init_install_function' in env:
-        env.APP_init_install_function(nsd, nuser, cfgfile)
-    else:
-        info('APP_init_install_function not defined in APPspecific')
-    if 'sysinitAPP_start_check_function' in env:
-        env.sysinitAPP_start_check_function()
-    else:
-        info('sysinitAPP_start_check_function not defined in APPspecific')
+    copy_after = ('system_packages',) if copy_sources_tools_missing() else ()
+    steps += install_and_check_steps(nuser, after=('create_user',),
+                                     build_after=('system_packages', 'extra_sudo'),
+                                     copy_after=copy_after)
+    steps += [
+        Step('init_install', init_install, ('start_check',)),
+        Step('sysinit_start_check', sysinit_start_check, ('init_install',)),
+    ]
+    run_steps(steps)
+
+
+def APP_wheelhouse():
+    key = 'APP_WHEELHOUSE'
+    if key not in env:
+        env[key] = APP_WHEELHOUSE_DEFAULT
+    if env[key] not in APP_WHEELHOUSE_MODES:
+        abort('APP_WHEELHOUSE must be one of {0}'.format(
+            ', '.join(repr(m) for m in APP_WHEELHOUSE_MODES)))
+    return env[key]
+
+
+def wheelhouse_key(packages, python_tag):
+    h = hashlib.sha256()
+    h.update(python_tag.encode('utf-8'))
+    for pkg in sorted(packages):
+        h.update(pkg.encode('utf-8') + b'\n')
+    return '{0}-{1}'.format(python_tag, h.hexdigest()[:16])
+
+
+def _build_remote_wheelhouse(packages, remote_dir, local_tarball):
+    remote_tarball = '/tmp/{0}_wheelhouse.tar.gz'.format(APP_name())
+    virtualenv('pip wheel -w {0} {1}'.format(remote_dir, ' '.join(packages)))
+    run('tar czf {0} -C {1} .'.format(remote_tarball, remote_dir))
+    get(remote_tarball, local_tarball + '.tmp')
+    run('rm {0}'.format(remote_tarball))
+    os.rename(local_tarball + '.tmp', local_tarball)
+
+
+def _build_local_wheelhouse(packages, local_tarball):
+    build_dir = tempfile.mkdtemp()
+    try:
+        local('pip wheel -w {0} {1}'.format(build_dir, ' '.join(packages)))
+        local('tar czf {0}.tmp -C {1} .'.format(local_tarball, build_dir))
+        os.rename(local_tarball + '.tmp', local_tarball)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def wheelhouse(packages):
+    """
+    Makes sure the target host has a wheelhouse with the given packages and
+    returns its location.
+
+    Wheelhouses are built once per set of packages and python/platform/OS tag,
+    either on the control node or on the first host that needs them, and
+    cached locally across runs. Other hosts get the cached wheelhouse pushed.
+    """
+    python_tag = virtualenv('python -c "{0}"'.format(PYTHON_TAG_SNIPPET), quiet=True).strip()
+    key = wheelhouse_key(packages, python_tag)
+    remote_dir = '{0}/.wheelhouse/{1}'.format(home(), key)
+    if check_dir(remote_dir):
+        return remote_dir
+
+    cache_dir = local_cache_dir('wheelhouse')
+    local_tarball = os.path.join(cache_dir, key + '.tar.gz')
+    with local_lock(os.path.join(cache_dir, key + '.lock')):
+        if not os.path.exists(local_tarball):
+            local_tag = ''
+            if APP_wheelhouse() == 'local':
+                with settings(hide('everything'), warn_only=True):
+                    local_tag = local('python -c "{0}"'.format(PYTHON_TAG_SNIPPET),
+                                      capture=True).strip()
+            if local_tag == python_tag:
+                info('Building wheelhouse {0} locally'.format(key))
+                _build_local_wheelhouse(packages, local_tarball)
+            else:
+                info('Building wheelhouse {0} in {1}'.format(key, env.host))
+                _build_remote_wheelhouse(packages, remote_dir, local_tarball)
+                return remote_dir
+
+    info('Pushing wheelhouse {0}'.format(key))
+    remote_tarball = '/tmp/{0}_wheelhouse.tar.gz'.format(APP_name())
+    put(local_tarball, remote_tarball)
+    run('mkdir -p {0} && tar xzf {1} -C {0} && rm {1}'.format(remote_dir, remote_tarball))
+    return remote_dir
+
+
+def install_python_packages(packages):
+    """
+    Installs packages into the APP virtualenv, from a wheelhouse if
+    APP_WHEELHOUSE is set, or from the package index otherwise
+    """
+    if not APP_wheelhouse():
+        virtualenv('pip install %s' % ' '.join(packages))
+        return
+    wheel_dir = wheelhouse(packages)
+    virtualenv('pip install --no-index --find-links {0} {1}'.format(
+        wheel_dir, ' '.join(packages)))
+
+
+def _requirement(req):
+    """
+    Parses a requirement, returning None for the ones that can't be
+    checked against pip freeze (e.g., URLs)
+    """
+    try:
+        return pkg_resources.Requirement.parse(req)
+    except Exception:
+        return None
+
+
+def canonical_name(name):
+    """
+    Returns the PEP 503 normalized form of a project name
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def reconcile_python_packages(packages):
+    """
+    Installs, upgrades or uninstalls only the extra python packages that
+    differ between the existing virtualenv and the desired set.
+
+    The packages installed by previous runs (and how long they took) are
+    recorded in the virtualenv, so packages that were removed from the
+    desired set are uninstalled and the time saved can be reported.
+    """
+    start = time.time()
+    state_file = '{0}/.APP_extra_packages.json'.format(APP_install_dir())
+    marker = '--- extra packages ---'
+    out = virtualenv('pip freeze --all; echo "{0}"; cat {1} 2>/dev/null'.format(marker, state_file),
+                     quiet=True, warn_only=True)
+    freeze, _, state = out.partition(marker)
+    installed = {}
+    for line in freeze.splitlines():
+        if '==' in line:
+            name, version = line.split('==', 1)
+            installed[canonical_name(name.strip())] = version.strip()
+    try:
+        previous = json.loads(state.strip() or '{}')
+    except ValueError:
+        previous = {}
+    # Older runs recorded the names without full normalization
+    previous = dict((canonical_name(name), t) for name, t in previous.items())
+
+    to_install, skipped, wanted = [], [], set()
+    for pkg in packages:
+        req = _requirement(pkg)
+        if req is None:
+            to_install.append(pkg)
+            continue
+        name = canonical_name(req.project_name)
+        wanted.add(name)
+        if name in installed and installed[name] in req:
+            skipped.append(name)
+        else:
+            to_install.append(pkg)
+    to_uninstall = [name for name in previous if name not in wanted and name in installed]
+
+    if to_uninstall:
+        virtualenv('pip uninstall -y {0}'.format(' '.join(to_uninstall)))
+    install_time = 0
+    if to_install:
+        install_start = time.time()
+        install_python_packages(to_install)
+        install_time = time.time() - install_start
+
+    # Record what we installed and how long (on average) each package took
+    current = {}
+    for pkg in packages:
+        req = _requirement(pkg)
+        if req is None:
+            continue
+        name = canonical_name(req.project_name)
+        if name in skipped:
+            current[name] = previous.get(name, 0)
+        else:
+            current[name] = install_time / max(len(to_install), 1)
+    run("echo '{0}' > {1}".format(json.dumps(current), state_file), quiet=True)
+
+    saved = sum(previous.get(name, 0) for name in skipped)
+    info('Reconciled virtualenv in {0:.1f} s: {1} installed/upgraded, {2} uninstalled, '
+         '{3} up to date'.format(time.time() - start, len(to_install), len(to_uninstall),
+                                 len(skipped)))
+    if skipped:
+        info('Skipped {0} (~{1:.1f} s of installation saved)'.format(', '.join(sorted(skipped)), saved))
+
+
+@contextlib.contextmanager
+def wheelhouse_links(packages):
+    """
+    Makes pip (e.g., in the APP build command) look for packages in the
+    wheelhouse first
+    """
+    if not APP_wheelhouse() or not packages:
+        yield
+        return
+    with shell_env(PIP_FIND_LINKS=wheelhouse(packages)):
+        yield
 
 
 def build():
@@ -387,18 +1079,25 @@ def build():
     info('Building {0}...'.format(env.APP_NAME))
     with cd(APP_source_dir()):
         extra_pkgs = extra_python_packages()
-        if extra_pkgs:
-            virtualenv('pip install %s' % ' '.join(extra_pkgs))
+        if env.get('APP_VENV_RESTORED'):
+            info('Extra Python packages restored with the virtualenv')
+        elif extra_pkgs and env.get('APP_VENV_RECONCILING'):
+            reconcile_python_packages(extra_pkgs)
+        elif extra_pkgs:
+            install_python_packages(extra_pkgs)
         else:
             info('No extra Python packages')
 
-    with cd(APP_source_dir()):
+    with cd(APP_source_dir()), wheelhouse_links(extra_pkgs):
         build_cmd = env.build_cmd()
         info('Build command: {0}'.format(build_cmd))
         if build_cmd and build_cmd != '':
              virtualenv(build_cmd)
         if 'build_function' in env and env.build_function:
             res = env.build_function()
+
+    if env.get('APP_VENV_KEY') and not env.get('APP_VENV_RESTORED'):
+        save_venv_snapshot(env.APP_VENV_KEY)
         
     
     # Install the /etc/init.d script for automatic start
@@ -416,18 +1115,8 @@ def install_and_check():
     Creates a virtualenv, installs APP on it,
     starts APP and checks that it is running
     """
-    copy_sources()
-    if env.APP_PYTHON_URL: virtualenv_setup()       # if APP needs python at all
-    build()
-    tgt_cfg = None
-    if 'prepare_APP_data_dir' in env:
-        tgt_cfg = env.prepare_APP_data_dir()
-    install_user_profile()
-    if 'APP_start_check_function' in env:
-        env.APP_start_check_function()
-    else:
-        info('APP_start_check_function not defined in APPspecific')
-    return APP_source_dir(), tgt_cfg
+    run_steps(install_and_check_steps())
+    return APP_source_dir(), env.get('APP_DATA_DIR_CFG')
 
 
 def upload_to(host, filename, port=7777):
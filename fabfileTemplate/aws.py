@@ -23,25 +23,34 @@
 Module containing AWS-related methods and tasks
 """
 
+import hashlib
+import json
 import os
+import subprocess
+import sys
 import time
 import six
-from sys import version_info
 
 from fabric.colors import green, red, blue, yellow
+from fabric.context_managers import settings
 from fabric.contrib.console import confirm
 from fabric.decorators import task
 from fabric.state import env
 from fabric.tasks import execute
 from fabric.utils import puts, abort, fastprint
 
-from fabfileTemplate.APPcommon import APP_revision, APP_user, APP_name
-from fabfileTemplate.utils import default_if_empty, whatsmyip, check_ssh, key_filename
+from fabfileTemplate.APPcommon import APP_revision, APP_user, APP_name, \
+    prepare_install_and_check
+from fabfileTemplate.executor import execute_on_hosts, executor_name
+from fabfileTemplate.readiness import ready_hosts
+from fabfileTemplate.utils import default_if_empty, whatsmyip, check_ssh, key_filename, \
+    to_boolean, info, success, failure, warning, local_cache_dir, local_lock
 
 import boto3
 
 # Don't re-export the tasks imported from other modules
-__all__ = ['create_aws_instances', 'list_instances', 'terminate', 'acheck_ssh']
+__all__ = ['create_aws_instances', 'list_instances', 'terminate', 'acheck_ssh',
+           'clear_aws_cache', 'fill_warm_pool']
 
 # Available known AMI IDs
 AMI_INFO = {
@@ -62,6 +71,31 @@ DEFAULT_AWS_KEY_NAME = 'icrar_ngas'
 DEFAULT_AWS_SEC_GROUP = 'NGAS' # Security group allows SSH and other ports
 DEFAULT_AWS_SEC_GROUP_PORTS = [22, 80, 7777, 8888]
 
+# Whether new instances are launched from an AMI baked for the same
+# deployment (see bake_ami), when there is one
+DEFAULT_AWS_USE_BAKED_AMI = True
+
+# Tags of the baked AMIs
+BAKE_KEY_TAG = 'APP Bake Key'
+BAKE_USER_TAG = 'APP Root User'
+
+# Number of provisioned, stopped instances kept for each APP revision, so
+# new deployments start them instead of launching new ones (0 disables it)
+DEFAULT_AWS_WARM_POOL = 0
+
+# Tags of the warm pool instances
+WARM_POOL_TAG = 'APP Warm Pool'
+WARM_POOL_CLAIM_TAG = 'APP Warm Pool Claim'
+
+# Time given to concurrent claims of the same instances to show up
+WARM_POOL_CLAIM_SETTLE = 2.
+
+# How long the state of key pairs and security groups is trusted, in seconds
+DEFAULT_AWS_CACHE_TTL = 3600
+
+# Errors meaning that a recorded key pair or security group is gone
+STALE_AWS_STATE_ERRORS = ('InvalidGroup.NotFound', 'InvalidKeyPair.NotFound')
+
 # Connection defaults
 DEFAULT_AWS_PROFILE = 'NGAS'  # the default user profile to use
 DEFAULT_AWS_REGION = 'us-east-1'  # The default region
@@ -69,10 +103,40 @@ DEFAULT_AWS_VPC_ID = 'vpc-0e2d88e4476b37393'  # The default developer VPC in reg
 DEFAULT_AWS_SUBNET_ID = 'subnet-0bc37d21234d81577'  # The default subnet ID
 # NOTE: Both the VPC and the subnet have been created manually
 
+# Whether aws_deploy deploys each instance as soon as it is reachable,
+# instead of waiting for all of them. Needs APP_EXECUTOR=async
+DEFAULT_AWS_PIPELINE = False
+
+# How long to wait for new instances to run, and the delays between polls
+DEFAULT_AWS_POLL_TIMEOUT = 600
+POLL_MIN_DELAY = 1.
+POLL_MAX_DELAY = 15.
+
 default_if_empty(env, 'AWS_VPC_ID', DEFAULT_AWS_VPC_ID)
 default_if_empty(env, 'AWS_SUBNET_ID', DEFAULT_AWS_SUBNET_ID)
 
 
+def use_baked_ami():
+    default_if_empty(env, 'AWS_USE_BAKED_AMI', DEFAULT_AWS_USE_BAKED_AMI)
+    return to_boolean(env.AWS_USE_BAKED_AMI)
+
+
+def warm_pool_size():
+    default_if_empty(env, 'AWS_WARM_POOL', DEFAULT_AWS_WARM_POOL)
+    return int(env.AWS_WARM_POOL)
+
+
+def aws_pipeline():
+    default_if_empty(env, 'AWS_PIPELINE', DEFAULT_AWS_PIPELINE)
+    if not to_boolean(env.AWS_PIPELINE):
+        return False
+    # Hosts are handed over to the workers of the async engine as they come
+    if executor_name() != 'async':
+        warning('AWS_PIPELINE needs APP_EXECUTOR=async, waiting for all instances instead')
+        return False
+    return True
+
+
 def connect():
     import boto3
 
@@ -97,67 +161,165 @@ def connect():
 def userAtHost():
     return os.environ['USER'] + '@' + whatsmyip()
 
+def _aws_cache_file():
+    fname = 'state-{0}-{1}.json'.format(env.AWS_PROFILE, env.AWS_REGION)
+    return os.path.join(local_cache_dir('aws'), fname)
+
+
+def _load_aws_cache():
+    try:
+        with open(_aws_cache_file(), 'rt') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_aws_cache(cache):
+    fname = _aws_cache_file()
+    tmp = '{0}.{1}'.format(fname, os.getpid())
+    with open(tmp, 'wt') as f:
+        json.dump(cache, f, indent=1)
+    os.rename(tmp, fname)
+
+
+def cached_aws_state(key):
+    """
+    Returns the state of an AWS resource recorded for the current profile
+    and region, or None if there is none or it is older than AWS_CACHE_TTL
+    seconds
+    """
+    default_if_empty(env, 'AWS_CACHE_TTL', DEFAULT_AWS_CACHE_TTL)
+    entry = _load_aws_cache().get(key)
+    if not entry or time.time() - entry['time'] > float(env.AWS_CACHE_TTL):
+        return None
+    return entry['value']
+
+
+def cache_aws_state(key, value):
+    cache = _load_aws_cache()
+    cache[key] = {'time': time.time(), 'value': value}
+    _save_aws_cache(cache)
+
+
+def invalidate_aws_state(key=None):
+    """
+    Forgets the recorded state of the given AWS resource, or of all of them
+    """
+    if key is None:
+        cache = {}
+    else:
+        cache = _load_aws_cache()
+        if cache.pop(key, None) is None:
+            return
+    _save_aws_cache(cache)
+
+
+@task
+def clear_aws_cache():
+    """
+    Forgets the recorded state of the AWS key pairs and security groups,
+    so they are checked again on the next launch
+    """
+    connect()
+    invalidate_aws_state()
+
+
 def aws_create_key_pair(conn):
 
     key_name = env.AWS_KEY_NAME
     key_file = key_filename(key_name)
+    cache_key = 'key_pair/' + key_name
+
+    if not cached_aws_state(cache_key):
+        try:
+            conn.describe_key_pairs(KeyNames=[key_name])
+        except conn.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidKeyPair.NotFound':
+                raise
+            # key does not exist on AWS, create it there and bring it back,
+            # overwriting anything we have
+            kp = conn.create_key_pair(KeyName=key_name)
+            if os.path.exists(key_file):
+                os.unlink(key_file)
+            with os.fdopen(os.open(key_file, os.O_WRONLY | os.O_CREAT, 0o600), 'wt') as f:
+                f.write(kp['KeyMaterial'])
+        cache_aws_state(cache_key, True)
 
-    # key does not exist on AWS, create it there and bring it back,
-    # overwriting anything we have
-    kps = conn.describe_key_pairs(KeyNames=[key_name])
-    if not kps:
-        kp = conn.create_key_pair(KeyName=key_name)
-        if os.path.exists(key_file):
-            os.unlink(key_file)
-
-        # We don't have the private key locally, save it
-        if not os.path.exists(key_file):
-            if version_info[0] > 2:  # workaround for bug in boto for Python3
-                kp.material = kp.material.encode()
-            kp.save('~/.ssh/')
-            return
     if not os.path.exists(key_file):
         raise FileNotFoundError('Key file {0} not found locally'. format(key_file))
 
 
-def check_create_aws_sec_group(conn):
+def _port_is_open(permissions, port):
+    for perm in permissions:
+        if perm['IpProtocol'] == '-1' or (
+                perm['IpProtocol'] == 'tcp' and perm['FromPort'] <= port <= perm['ToPort']):
+            if any(r['CidrIp'] == '0.0.0.0/0' for r in perm.get('IpRanges', [])):
+                return True
+    return False
+
+
+def security_group_cache_key():
+    return 'security_group/{0}/{1}'.format(env.AWS_VPC_ID, env.AWS_SEC_GROUP)
+
+
+def forget_stale_aws_state(error):
     """
-    Check whether the security group exists
+    Forgets the recorded key pair and security group if error says that one
+    of them doesn't exist anymore, and returns whether it did
     """
-    import boto3.exceptions
+    if error.response['Error']['Code'] not in STALE_AWS_STATE_ERRORS:
+        return False
+    invalidate_aws_state('key_pair/' + env.AWS_KEY_NAME)
+    invalidate_aws_state(security_group_cache_key())
+    return True
 
+
+def check_create_aws_sec_group(conn, use_cache=True):
+    """
+    Check whether the security group exists
+    """
     default_if_empty(env, 'AWS_SEC_GROUP', DEFAULT_AWS_SEC_GROUP)
     default_if_empty(env, 'AWS_SEC_GROUP_PORTS', DEFAULT_AWS_SEC_GROUP_PORTS)
 
     app_secgroup = env.AWS_SEC_GROUP
-    sec = conn.describe_security_groups(Filters=[{'Name':'group-name','Values':[env.AWS_SEC_GROUP]}])
-    conn.close()
-    exfl = False
-    if sec['SecurityGroups']:
-        appsg = sec['SecurityGroups'][0]
-        puts(green("AWS Security Group {0} exists ({1})".format(app_secgroup, appsg['GroupId'])))
-    else:
-        # Not found, create a new one
-        appsg = conn.create_security_group(app_secgroup, '{0} default permissions'.format(APP_name()),
-        vpc_id=env.AWS_VPC_ID)
-
-    # make sure the correct ports are open
-    for port in env.AWS_SEC_GROUP_PORTS:
+    cache_key = security_group_cache_key()
+    appsg = cached_aws_state(cache_key) if use_cache else None
+    if appsg is None:
+        sec = conn.describe_security_groups(Filters=[{'Name':'group-name','Values':[app_secgroup]},
+                                                     {'Name':'vpc-id','Values':[env.AWS_VPC_ID]}])
+        if sec['SecurityGroups']:
+            appsg = sec['SecurityGroups'][0]
+            puts(green("AWS Security Group {0} exists ({1})".format(app_secgroup, appsg['GroupId'])))
+        else:
+            # Not found, create a new one
+            created = conn.create_security_group(
+                GroupName=app_secgroup, VpcId=env.AWS_VPC_ID,
+                Description='{0} default permissions'.format(APP_name()))
+            appsg = {'GroupId': created['GroupId'], 'IpPermissions': []}
+        appsg = {'GroupId': appsg['GroupId'], 'IpPermissions': appsg['IpPermissions']}
+
+    # make sure the correct ports are open, with a single call for all the
+    # ones that are not
+    ports = env.AWS_SEC_GROUP_PORTS
+    if isinstance(ports, six.string_types):
+        ports = ports.split(',')
+    missing = [{'IpProtocol': 'tcp', 'FromPort': int(port), 'ToPort': int(port),
+                'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}
+               for port in ports if not _port_is_open(appsg['IpPermissions'], int(port))]
+    if missing:
         try:
-            data = conn.authorize_security_group_ingress(
-                GroupId=appsg['GroupId'],
-                IpPermissions=[
-                    {'IpProtocol': 'tcp',
-                    'FromPort': port,
-                    'ToPort': port,
-                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}]},
-                ])
-
-            # appsg.authorize('tcp', port, port, '0.0.0.0/0')
-        except conn.exceptions.from_code('InvalidPermission.Duplicate'):
-            pass
+            conn.authorize_security_group_ingress(GroupId=appsg['GroupId'], IpPermissions=missing)
         except conn.exceptions.ClientError as error:
-            raise error
+            code = error.response['Error']['Code']
+            if code not in ('InvalidPermission.Duplicate', 'InvalidGroup.NotFound') or \
+               (code == 'InvalidGroup.NotFound' and not use_cache):
+                raise
+            # The recorded group or its permissions were outdated, check them again
+            if use_cache:
+                invalidate_aws_state(cache_key)
+                return check_create_aws_sec_group(conn, use_cache=False)
+        appsg['IpPermissions'] = appsg['IpPermissions'] + missing
+    cache_aws_state(cache_key, appsg)
     return appsg['GroupId']
 
 def check_vpc(secg_id):
@@ -166,9 +328,103 @@ def check_vpc(secg_id):
     """
     pass
 
-def create_instances(conn, sgid):
+def base_ami():
     """
-    Create one or more EC2 instances
+    Returns the ID of the AMI new instances start from, and its root user
+    """
+    default_if_empty(env, 'AWS_AMI_NAME', DEFAULT_AWS_AMI_NAME)
+    if 'AMI_ID' in env:
+        return env['AMI_ID'], env['root']
+    return AMI_INFO[env.AWS_AMI_NAME]['id'], AMI_INFO[env.AWS_AMI_NAME]['root']
+
+
+def bake_key():
+    """
+    Returns the hash identifying the AMIs baked for the current deployment:
+    its base AMI, the APP revision, the system packages and the python version
+    """
+    h = hashlib.sha256()
+    for item in (APP_name(), base_ami()[0], APP_revision(),
+                 json.dumps(env.pkgs, sort_keys=True), env.get('APP_EXTRA_PACKAGES'),
+                 env.get('APP_PYTHON_VERSION'), env.get('APP_PYTHON_URL')):
+        h.update(str(item).encode('utf-8') + b'\n')
+    return h.hexdigest()[:32]
+
+
+def baked_ami(conn):
+    """
+    Returns the ID and root user of the newest AMI baked for the current
+    deployment, or None if there is none
+    """
+    key = bake_key()
+    cache_key = 'baked_ami/' + key
+    baked = cached_aws_state(cache_key)
+    if baked:
+        return tuple(baked)
+
+    images = conn.describe_images(Owners=['self'], Filters=[
+        {'Name': 'tag:' + BAKE_KEY_TAG, 'Values': [key]},
+        {'Name': 'state', 'Values': ['available']}])['Images']
+    if not images:
+        return None
+    image = max(images, key=lambda i: i['CreationDate'])
+    tags = dict((t['Key'], t['Value']) for t in image.get('Tags', []))
+    baked = (image['ImageId'], tags.get(BAKE_USER_TAG, base_ami()[1]))
+    cache_aws_state(cache_key, baked)
+    return baked
+
+
+def instance_of_host(conn, host):
+    """
+    Returns the ID of the instance with the given public DNS name or IP
+    """
+    for name in ('dns-name', 'ip-address'):
+        reservations = conn.describe_instances(
+            Filters=[{'Name': name, 'Values': [host]}])['Reservations']
+        for reservation in reservations:
+            for data in reservation['Instances']:
+                return data['InstanceId']
+    abort('No EC2 instance found for {0}'.format(host))
+
+
+def bake_ami(host):
+    """
+    Creates an AMI from the (freshly deployed) instance behind host, tagged
+    with the bake key of the current deployment, and waits until it can be
+    used. New instances for the same deployment are launched from it.
+    """
+    conn = connect()
+    key = bake_key()
+    instance_id = instance_of_host(conn, host)
+    name = '{0}-{1}-{2}'.format(APP_name(), key[:12], time.strftime('%Y%m%d%H%M%S'))
+    puts('Baking AMI {0} from instance {1}'.format(name, instance_id))
+    tags = [
+        {'Key': 'Name', 'Value': name},
+        {'Key': BAKE_KEY_TAG, 'Value': key},
+        {'Key': BAKE_USER_TAG, 'Value': env.user},
+        {'Key': 'APP Revision', 'Value': str(APP_revision())},
+        {'Key': 'Created By', 'Value': userAtHost()},
+    ]
+    image_id = conn.create_image(
+        InstanceId=instance_id, Name=name,
+        Description='{0} {1} deployment'.format(APP_name(), APP_revision()),
+        TagSpecifications=[{'ResourceType': 'image', 'Tags': tags}])['ImageId']
+    start = time.time()
+    conn.get_waiter('image_available').wait(
+        ImageIds=[image_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 240})
+    cache_aws_state('baked_ami/' + key, (image_id, env.user))
+    success('AMI {0} baked in {1:.0f} [s]'.format(image_id, time.time() - start))
+    return image_id
+
+
+def launch_instances(conn, sgid, n_instances=None, warm_pool=False):
+    """
+    Launches one or more EC2 instances, without waiting for them to run.
+    Returns the instances and the elastic IPs to associate to them, if any.
+
+    Stopped instances in the warm pool are started first, if there is one,
+    and only the rest are launched. With warm_pool=True the instances are
+    launched for the warm pool instead.
     """
 
     default_if_empty(env, 'AWS_AMI_NAME',             DEFAULT_AWS_AMI_NAME)
@@ -177,8 +433,10 @@ def create_instances(conn, sgid):
     default_if_empty(env, 'AWS_KEY_NAME',             DEFAULT_AWS_KEY_NAME)
     puts("About to create instance {0} of type {1}.".format(env.AWS_AMI_NAME, env.AWS_INSTANCE_TYPE))
 
-    n_instances = int(env.AWS_INSTANCES)
-    if n_instances > 1:
+    n_instances = int(env.AWS_INSTANCES if n_instances is None else n_instances)
+    if warm_pool:
+        names = ['{0}_warm_pool'.format(APP_name())]
+    elif n_instances > 1:
         names = ["%s_%d" % (env.AWS_INSTANCE_NAME, i) for i in range(n_instances)]
     else:
         names = [env.AWS_INSTANCE_NAME]
@@ -196,29 +454,29 @@ def create_instances(conn, sgid):
             if not conn.disassociate_address(public_ip=public_ip):
                 abort('Could not disassociate the IP {0}'.format(public_ip))
 
-    if 'AMI_ID' in env:
-        AMI_ID = env['AMI_ID']
-        env.user = env['root']
-    else:
-        AMI_ID = AMI_INFO[env.AWS_AMI_NAME]['id']
-        env.user = AMI_INFO[env.AWS_AMI_NAME]['root']
-
-    interface = conn.create_network_interface(
-        SubnetId=env.AWS_SUBNET_ID,
-        Groups=[sgid],
-        )
-    interfaces = [
-        {
-            'AssociatePublicIpAddress': True,
-            'DeleteOnTermination': True,
-            'Description': 'string',
-            'DeviceIndex': 0,
-            'Groups': [
-                sgid
-            ],
-            'SubnetId': env.AWS_SUBNET_ID,
-        },
-    ]
+    AMI_ID, env.user = base_ami()
+    baked = baked_ami(conn) if use_baked_ami() else None
+    if baked:
+        # Everything up to the APP installation is there already, the
+        # deployment only updates it
+        AMI_ID, env.user = baked
+        puts(green('Launching from the baked AMI {0}'.format(AMI_ID)))
+        default_if_empty(env, 'APP_OVERWRITE_INSTALLATION', True)
+        default_if_empty(env, 'APP_VENV_RECONCILE', True)
+
+    resource = boto3.resource('ec2')
+    instances = []
+    if warm_pool_size() > 0 and not warm_pool and not public_ips:
+        instances = [resource.Instance(iid)
+                     for iid in claim_pool_instances(conn, n_instances, names[0])]
+        if instances:
+            # Like with a baked AMI, the deployment only updates them
+            default_if_empty(env, 'APP_OVERWRITE_INSTALLATION', True)
+            default_if_empty(env, 'APP_VENV_RECONCILE', True)
+        fill_warm_pool_in_background()
+        n_instances -= len(instances)
+        if not n_instances:
+            return instances, public_ips
 
     TagSpecifications = [
         {
@@ -243,47 +501,295 @@ def create_instances(conn, sgid):
             ]
         },
     ]
+    if warm_pool:
+        TagSpecifications[0]['Tags'].append({'Key': WARM_POOL_TAG, 'Value': warm_pool_key()})
+
+    def create(sgid, ami_id):
+        interface = conn.create_network_interface(
+            SubnetId=env.AWS_SUBNET_ID,
+            Groups=[sgid],
+            )
+        interfaces = [
+            {
+                'AssociatePublicIpAddress': True,
+                'DeleteOnTermination': True,
+                'Description': 'string',
+                'DeviceIndex': 0,
+                'Groups': [
+                    sgid
+                ],
+                'SubnetId': env.AWS_SUBNET_ID,
+            },
+        ]
+
+        return resource.create_instances(ImageId=ami_id, InstanceType=env.AWS_INSTANCE_TYPE,
+                                         KeyName=env.AWS_KEY_NAME,
+                                         MinCount=n_instances, MaxCount=n_instances,
+                                         NetworkInterfaces=interfaces,
+                                         TagSpecifications=TagSpecifications,
+                                         )
+
+    try:
+        launched = create(sgid, AMI_ID)
+    except conn.exceptions.ClientError as e:
+        if baked and e.response['Error']['Code'].startswith('InvalidAMIID'):
+            # The baked AMI was deregistered since it was recorded
+            puts(yellow('Baked AMI {0} not usable, launching from the base AMI'.format(AMI_ID)))
+            invalidate_aws_state('baked_ami/' + bake_key())
+            AMI_ID, env.user = base_ami()
+            launched = create(sgid, AMI_ID)
+        elif forget_stale_aws_state(e):
+            # The recorded key pair or security group were deleted since
+            puts(yellow('Key pair or security group not found, checking them again'))
+            aws_create_key_pair(conn)
+            launched = create(check_create_aws_sec_group(conn), AMI_ID)
+        else:
+            raise
+    for instance in launched:
+        print(f'EC2 instance "{instance.id}" has been launched')
+    return instances + list(launched), public_ips
 
-    resource = boto3.resource('ec2')
-    instances = resource.create_instances(ImageId=AMI_ID, InstanceType=env.AWS_INSTANCE_TYPE, 
-                                    KeyName=env.AWS_KEY_NAME,
-                                    MinCount=n_instances, MaxCount=n_instances,
-                                    NetworkInterfaces=interfaces,
-                                    TagSpecifications=TagSpecifications,
-                                    )
-
-    # Sleep so Amazon recognizes the new instance
-    for i in range(4):
-        fastprint('.')
-        time.sleep(5)
 
-    # Are we running yet?
-    for instance in instances:
-        print(f'EC2 instance "{instance.id}" has been launched')
-    
-        instance.wait_until_running()
-    puts('.') #enforce the line-end
+def warm_pool_key():
+    """
+    Returns the value of the warm pool tag of the instances provisioned for
+    the current deployment: the APP revision, the bake key (base AMI, system
+    packages and python) and the instance type
+    """
+    default_if_empty(env, 'AWS_INSTANCE_TYPE', DEFAULT_AWS_INSTANCE_TYPE)
+    return '{0}:{1}:{2}:{3}'.format(APP_name(), APP_revision(), bake_key()[:12],
+                                    env.AWS_INSTANCE_TYPE)
+
+
+def pool_instances(conn, states=('stopped',)):
+    """
+    Returns the IDs of the warm pool instances of the current deployment
+    in the given states
+    """
+    filters = [{'Name': 'tag:' + WARM_POOL_TAG, 'Values': [warm_pool_key()]},
+               {'Name': 'instance-state-name', 'Values': list(states)}]
+    ids = []
+    for page in conn.get_paginator('describe_instances').paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            ids += [data['InstanceId'] for data in reservation['Instances']]
+    return ids
 
-    # Local user and host
-    userAThost = userAtHost()
 
-    # We save the user under which we install APP for later display
-    nuser = APP_user()
+def _instance_states(conn, instance_ids):
+    """
+    Returns the state and the tags (as a dictionary) of the given instances
+    by their ID
+    """
+    states = {}
+    for page in conn.get_paginator('describe_instances').paginate(InstanceIds=instance_ids):
+        for reservation in page['Reservations']:
+            for data in reservation['Instances']:
+                states[data['InstanceId']] = (data['State']['Name'],
+                                              dict((t['Key'], t['Value'])
+                                                   for t in data.get('Tags', [])))
+    return states
 
-    # Associate the IP if needed
-    if public_ips:
-        for instance, public_ip in zip(instances, public_ips):
-            puts('Current DNS name is {0}. About to associate the Elastic IP'.format(instance.public_dns_name))
-            if not conn.associate_address(instance_id=instance.id, public_ip=public_ip):
-                abort('Could not associate the IP {0} to the instance {1}'.format(public_ip, instance.id))
 
-    # Load the new instance data as the dns_name may have changed
-    host_names = []
-    for instance in instances:
-        instance = resource.Instance(instance.id)
-        print_instance(instance)
-        puts(f"DNS name/IP address: {str(instance.public_dns_name)}/{str(instance.public_ip_address)}")
-        host_names.append(str(instance.public_dns_name))
+def claim_pool_instances(conn, n, name):
+    """
+    Takes up to n stopped instances out of the warm pool, naming and
+    starting them, and returns their IDs.
+
+    Instances are claimed by tagging them with a token of this process: the
+    last deployment to tag a stopped instance gets it. A moment after
+    tagging them, the instances that still have the token are taken out of
+    the pool, so no other deployment finds them anymore. The token is then
+    checked once more, as deployments that found them before can still have
+    tagged them in the meanwhile. An instance that is not stopped anymore
+    was started by the deployment that got it, whatever its tag says.
+    """
+    candidates = pool_instances(conn)[:n]
+    if not candidates:
+        info('No instances in the warm pool of {0}'.format(warm_pool_key()))
+        return []
+    token = '{0}:{1}:{2}'.format(userAtHost(), os.getpid(), time.time())
+    conn.create_tags(Resources=candidates, Tags=[{'Key': WARM_POOL_CLAIM_TAG, 'Value': token}])
+
+    def owned(instance_ids):
+        time.sleep(WARM_POOL_CLAIM_SETTLE)
+        return [iid for iid, (state, tags) in _instance_states(conn, instance_ids).items()
+                if state == 'stopped' and tags.get(WARM_POOL_CLAIM_TAG) == token]
+
+    claimed = owned(candidates)
+    if not claimed:
+        return []
+    conn.delete_tags(Resources=claimed, Tags=[{'Key': WARM_POOL_TAG}])
+    claimed = owned(claimed)
+    if not claimed:
+        return []
+    conn.delete_tags(Resources=claimed, Tags=[{'Key': WARM_POOL_CLAIM_TAG}])
+    conn.create_tags(Resources=claimed, Tags=[{'Key': 'Name', 'Value': name},
+                                              {'Key': 'Created By', 'Value': userAtHost()}])
+    conn.start_instances(InstanceIds=claimed)
+    success('Started {0} instance(s) from the warm pool: {1}'.format(
+        len(claimed), ', '.join(claimed)), with_stars=False)
+    return claimed
+
+
+@task
+def fill_warm_pool():
+    """
+    Launches and provisions instances until the warm pool of the current
+    revision has AWS_WARM_POOL of them, then stops them
+    """
+    default_if_empty(env, 'AWS_KEY_NAME',      DEFAULT_AWS_KEY_NAME)
+    default_if_empty(env, 'AWS_INSTANCE_NAME', default_instance_name)
+    size = warm_pool_size()
+    conn = connect()
+    with local_lock(os.path.join(local_cache_dir('aws'), 'warm_pool.lock')):
+        # Instances still being provisioned count as well
+        present = pool_instances(conn, ('pending', 'running', 'stopping', 'stopped'))
+        missing = size - len(present)
+        if missing <= 0:
+            info('The warm pool of {0} is full ({1} instances)'.format(warm_pool_key(), len(present)))
+            return
+
+        aws_create_key_pair(conn)
+        sgid = check_create_aws_sec_group(conn)
+        instances, _ = launch_instances(conn, sgid, n_instances=missing, warm_pool=True)
+        instance_ids = [i.id for i in instances]
+        try:
+            hosts = list(ready_hosts(running_hosts(conn, instances)))
+            with settings(hosts=hosts, key_filename=key_filename(env.AWS_KEY_NAME)):
+                execute_on_hosts(prepare_install_and_check)
+            conn.stop_instances(InstanceIds=instance_ids)
+        except BaseException:
+            # Half-provisioned instances must not be claimed later
+            failure('Provisioning the warm pool failed, terminating {0}'.format(
+                ', '.join(instance_ids)))
+            conn.terminate_instances(InstanceIds=instance_ids)
+            raise
+        success('Added {0} instance(s) to the warm pool of {1}'.format(missing, warm_pool_key()))
+
+
+def fill_warm_pool_in_background():
+    """
+    Runs fill_warm_pool in a new fab process, with the options (e.g., --set)
+    of this one, which keeps running after fab finishes. Its output goes to
+    aws/warm_pool.log in the local cache.
+    """
+    from fabric.main import parse_options
+
+    # A new process instead of a fork, which would inherit the connections,
+    # the workers of the executor and their queues
+    _, _, tasks = parse_options()
+    options = [arg for arg in sys.argv[1:] if arg not in tasks]
+    log = os.path.join(local_cache_dir('aws'), 'warm_pool.log')
+    with open(log, 'ab') as out, open(os.devnull, 'rb') as devnull:
+        subprocess.Popen([sys.executable, sys.argv[0]] + options + ['aws.fill_warm_pool'],
+                         stdin=devnull, stdout=out, stderr=subprocess.STDOUT,
+                         close_fds=True, start_new_session=True)
+    info('Filling the warm pool in the background, see {0}'.format(log))
+
+
+def _describe_instances(conn, instance_ids, stats):
+    """
+    Returns the description of the given instances by their ID, with one
+    describe_instances call per page instead of one call per instance
+    """
+    described = {}
+    paginator = conn.get_paginator('describe_instances')
+    for page in paginator.paginate(InstanceIds=sorted(instance_ids)):
+        stats['api_calls'] += 1
+        for reservation in page['Reservations']:
+            for data in reservation['Instances']:
+                described[data['InstanceId']] = data
+    return described
+
+
+def _record_launch(stats):
+    with open(os.path.join(local_cache_dir('aws'), 'launches.jsonl'), 'a') as f:
+        f.write(json.dumps(dict(stats, finished=time.time())) + '\n')
+
+
+def running_hosts(conn, instances, public_ips=None, timeout=None):
+    """
+    Yields the host name of each instance as soon as it is running
+    (associating its elastic IP first, if any), while the rest boot.
+
+    The state of all pending instances is polled together. The delay between
+    polls grows while nothing changes and goes back to the minimum once
+    instances start running, since the rest usually follow shortly.
+    """
+    default_if_empty(env, 'AWS_POLL_TIMEOUT', DEFAULT_AWS_POLL_TIMEOUT)
+    timeout = float(env.AWS_POLL_TIMEOUT if timeout is None else timeout)
+
+    by_id = dict((i.id, i) for i in instances)
+    elastic_ips = dict(zip([i.id for i in instances], public_ips or []))
+    pending = set(by_id)
+    stats = {'instances': len(by_id), 'api_calls': 0, 'polls': 0, 'wait': 0.}
+    start = time.time()
+    delay = POLL_MIN_DELAY
+    while pending:
+        stats['polls'] += 1
+        try:
+            described = _describe_instances(conn, pending, stats)
+        except conn.exceptions.ClientError as e:
+            # Amazon might not recognize the new instances yet
+            if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                raise
+            described = {}
+
+        running = [iid for iid in sorted(pending)
+                   if described.get(iid, {}).get('State', {}).get('Name') == 'running']
+        for iid in pending:
+            state = described.get(iid, {}).get('State', {}).get('Name')
+            if state in ('shutting-down', 'terminated'):
+                abort('Instance {0} is {1} instead of starting'.format(iid, state))
+
+        # Associate the IPs if needed, and describe those instances again
+        # as their DNS name changes
+        associated = []
+        for iid in running:
+            public_ip = elastic_ips.get(iid)
+            if public_ip:
+                puts('Current DNS name is {0}. About to associate the Elastic IP'.format(
+                    described[iid].get('PublicDnsName')))
+                if not conn.associate_address(instance_id=iid, public_ip=public_ip):
+                    abort('Could not associate the IP {0} to the instance {1}'.format(public_ip, iid))
+                associated.append(iid)
+        if associated:
+            described.update(_describe_instances(conn, associated, stats))
+
+        for iid in running:
+            pending.remove(iid)
+            instance = by_id[iid]
+            # Use the data just described instead of loading it again
+            instance.meta.data = described[iid]
+            print_instance(instance)
+            puts(f"DNS name/IP address: {str(instance.public_dns_name)}/{str(instance.public_ip_address)}")
+            yield str(instance.public_dns_name)
+        if not pending:
+            break
+
+        elapsed = time.time() - start
+        if elapsed > timeout:
+            abort('Instance(s) {0} not running after {1:.0f} seconds'.format(
+                ', '.join(sorted(pending)), elapsed))
+        delay = POLL_MIN_DELAY if running else min(delay * 2, POLL_MAX_DELAY)
+        fastprint('.')
+        wait = min(delay, max(timeout - elapsed, 0))
+        time.sleep(wait)
+        stats['wait'] += wait
+
+    stats['elapsed'] = time.time() - start
+    info('{instances} instance(s) running after {elapsed:.1f} [s]: {polls} polls, '
+         '{api_calls} describe_instances calls, {wait:.1f} [s] waiting'.format(**stats))
+    _record_launch(stats)
+
+
+def create_instances(conn, sgid):
+    """
+    Create one or more EC2 instances
+    """
+    instances, public_ips = launch_instances(conn, sgid)
+    host_names = list(running_hosts(conn, instances, public_ips))
+    puts('.') #enforce the line-end
     return host_names
 
 def default_instance_name():
@@ -316,7 +822,36 @@ def create_aws_instances():
     env.key_filename = key_filename(env.AWS_KEY_NAME)
     # Instances have started, but are not usable yet, make sure SSH has started
     puts('Started the instance(s) now waiting for the SSH daemon to start.')
-    execute(check_ssh, timeout=300)
+    for _ in ready_hosts(host_names, timeout=300):
+        pass
+    # Go through the same engine as the deployment, so its workers
+    # already hold the connections opened here
+    execute_on_hosts(check_ssh, timeout=300)
+
+
+def create_aws_instances_pipelined():
+    """
+    Like create_aws_instances, but returns right after launching the
+    instances. The returned generator yields each host as soon as it runs
+    and its SSH server answers, while the rest are still booting. The SSH
+    server answers before the key is installed, so the task run on each
+    host has to retry its session first with check_ssh(timeout=300).
+    """
+    default_if_empty(env, 'AWS_KEY_NAME',      DEFAULT_AWS_KEY_NAME)
+    default_if_empty(env, 'AWS_INSTANCE_NAME', default_instance_name)
+
+    conn = connect()
+    aws_create_key_pair(conn)
+    sgid = check_create_aws_sec_group(conn)
+    instances, public_ips = launch_instances(conn, sgid)
+    env.hosts = []
+    env.key_filename = key_filename(env.AWS_KEY_NAME)
+
+    def pipelined_hosts():
+        for host in ready_hosts(running_hosts(conn, instances, public_ips)):
+            env.hosts.append(host)
+            yield host
+    return pipelined_hosts()
 
 
 @task
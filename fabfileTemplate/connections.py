@@ -0,0 +1,180 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2016
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Module containing a persistent, key-aware SSH connection pool.
+
+Fabric already keeps one paramiko connection per host string and opens a new
+channel on it for every command (paramiko multiplexes channels over a single
+transport). The pool in this module extends that cache so that connections
+are keyed by (user, host, port, key), dead connections are transparently
+replaced and idle ones are closed after APP_SSH_IDLE_TIMEOUT seconds.
+
+Combined with the async execution engine, whose workers always serve the same
+hosts, this lets consecutive execute() calls (e.g., check_ssh and then
+prepare_install_and_check), settings(user=...) switches and the concurrent
+deployment steps of a host reuse the connections that are already
+authenticated.
+"""
+import hashlib
+import threading
+import time
+
+from fabric import state
+from fabric.network import HostConnectionCache, normalize_to_string
+from fabric.state import env
+
+from fabfileTemplate.utils import default_if_empty
+
+# Seconds after which an unused connection is closed
+DEFAULT_SSH_IDLE_TIMEOUT = 300
+
+# Seconds between keepalive packets, so pooled connections survive NATs
+DEFAULT_SSH_KEEPALIVE = 30
+
+
+def ssh_idle_timeout():
+    default_if_empty(env, 'APP_SSH_IDLE_TIMEOUT', DEFAULT_SSH_IDLE_TIMEOUT)
+    return float(env.APP_SSH_IDLE_TIMEOUT)
+
+
+def key_id():
+    """
+    Returns an identifier of the private key(s) currently used to connect
+    """
+    key_filename = env.get('key_filename')
+    if isinstance(key_filename, (list, tuple)):
+        key_filename = ','.join(k for k in key_filename if k)
+    key_material = env.get('key')
+    if key_material:
+        if not isinstance(key_material, bytes):
+            key_material = key_material.encode('utf-8')
+        key_material = hashlib.sha1(key_material).hexdigest()
+    return key_filename or None, key_material or None
+
+
+def pool_key(host_string):
+    return (normalize_to_string(host_string),) + key_id()
+
+
+def _is_active(conn):
+    transport = conn.get_transport() if conn is not None else None
+    return transport is not None and transport.is_active()
+
+
+class ConnectionPool(HostConnectionCache):
+    """
+    Fabric connection cache keyed by (user, host, port, key) with idle
+    eviction and reconnection of dead connections.
+
+    Fabric itself looks connections up by user@host:port, under which the
+    connection of the key currently in use is found. The connections of
+    other keys to the same user@host:port stay in the pool meanwhile.
+    """
+
+    def _init_pool(self):
+        self.pooled = {}
+        self.last_used = {}
+        # The deployment steps of a host run in threads sharing the pool
+        self.lock = threading.RLock()
+
+    def _drop(self, pkey, close=True):
+        conn = self.pooled.pop(pkey, None)
+        self.last_used.pop(pkey, None)
+        if conn is None:
+            return
+        if dict.get(self, pkey[0]) is conn:
+            dict.pop(self, pkey[0])
+        if close:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def evict_idle(self):
+        timeout = ssh_idle_timeout()
+        now = time.time()
+        for pkey, last_used in list(self.last_used.items()):
+            if now - last_used > timeout:
+                self._drop(pkey)
+
+    def __getitem__(self, key):
+        real_key = normalize_to_string(key)
+        pkey = pool_key(key)
+        with self.lock:
+            self.evict_idle()
+            conn = self.pooled.get(pkey)
+            if conn is not None and not _is_active(conn):
+                self._drop(pkey)
+                conn = None
+            if conn is None:
+                # Let fabric connect with the current key, which goes through
+                # __setitem__, keeping the connection of any other key pooled
+                dict.pop(self, real_key, None)
+                conn = HostConnectionCache.__getitem__(self, key)
+            else:
+                dict.__setitem__(self, real_key, conn)
+            self.last_used[pkey] = time.time()
+        return conn
+
+    def __setitem__(self, key, value):
+        HostConnectionCache.__setitem__(self, key, value)
+        pkey = pool_key(key)
+        self.pooled[pkey] = value
+        self.last_used[pkey] = time.time()
+
+    def forget(self):
+        """
+        Forgets all connections without closing them. Used by forked
+        processes, which must not touch the connections of their parent
+        """
+        dict.clear(self)
+        self.pooled.clear()
+        self.last_used.clear()
+
+    def __delitem__(self, key):
+        # Whoever deletes the connection in use closes it (e.g., fabric's
+        # disconnect_all), those of the other keys are closed here
+        real_key = normalize_to_string(key)
+        current = dict.get(self, real_key)
+        for pkey, conn in list(self.pooled.items()):
+            if pkey[0] == real_key:
+                self._drop(pkey, close=conn is not current)
+        dict.pop(self, real_key, None)
+
+
+def install_connection_pool():
+    """
+    Turns fabric's global connection cache into a ConnectionPool.
+
+    Fabric modules hold direct references to the cache object, so instead of
+    replacing it we change its class in place.
+    """
+    connections = state.connections
+    if isinstance(connections, ConnectionPool):
+        return connections
+    connections.__class__ = ConnectionPool
+    connections._init_pool()
+    for real_key in list(dict.keys(connections)):
+        connections.pooled[pool_key(real_key)] = dict.__getitem__(connections, real_key)
+        connections.last_used[pool_key(real_key)] = time.time()
+    default_if_empty(env, 'keepalive', DEFAULT_SSH_KEEPALIVE)
+    return connections
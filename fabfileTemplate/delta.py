@@ -0,0 +1,245 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2016
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+rsync-style delta transfer of a directory tree.
+
+This module is used on both sides of the transfer: the control node imports
+it to compute manifests and deltas, and its source is sent to the target
+host (and run there with whatever python is available) to compute block
+signatures and apply deltas. It must therefore only depend on the standard
+library, and work with both python 2 and 3.
+
+Remote usage::
+
+    python delta.py signatures <root> <block_size>  < manifest
+    python delta.py patch <root> <block_size>       < patch
+
+Both read zlib-compressed JSON from stdin and write JSON to stdout.
+"""
+import base64
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+DEFAULT_BLOCK_SIZE = 4096
+
+# Modulus of the rolling checksum
+_M = 1 << 16
+
+
+def weak_checksum(data):
+    """
+    Returns the (a, b) components of rsync's rolling checksum of data
+    """
+    a = b = 0
+    n = len(data)
+    for i, x in enumerate(bytearray(data)):
+        a += x
+        b += (n - i) * x
+    return a % _M, b % _M
+
+
+def strong_checksum(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_checksum(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def manifest(root):
+    """
+    Returns the manifest of all files under root: for regular files a list
+    with size, mtime, content hash and mode; for links the link target
+    """
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, root)
+            if os.path.islink(path):
+                entries[relpath] = ['link', os.readlink(path)]
+            elif os.path.isfile(path):
+                st = os.stat(path)
+                entries[relpath] = [st.st_size, int(st.st_mtime),
+                                    file_checksum(path), st.st_mode & 0o7777]
+    return entries
+
+
+def block_signatures(path, block_size):
+    """
+    Returns the weak and strong checksums of each block of a file
+    """
+    signatures = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            a, b = weak_checksum(block)
+            signatures.append([a + (b << 16), strong_checksum(block)])
+    return signatures
+
+
+def compute_delta(data, signatures, block_size):
+    """
+    Computes the delta turning the file described by signatures into data.
+    The result is a list of operations: integers are indexes of blocks
+    to copy from the old file, strings are base64-encoded literal data.
+    """
+    table = {}
+    for idx, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, []).append((idx, strong))
+
+    data = bytearray(data)
+    n = len(data)
+    ops = []
+    literal = bytearray()
+
+    def flush_literal():
+        if literal:
+            ops.append(base64.b64encode(bytes(literal)).decode('ascii'))
+            del literal[:]
+
+    i = 0
+    if n >= block_size:
+        a, b = weak_checksum(data[:block_size])
+    while i + block_size <= n:
+        match = None
+        candidates = table.get(a + (b << 16))
+        if candidates:
+            strong = strong_checksum(bytes(data[i:i + block_size]))
+            for idx, s in candidates:
+                if s == strong:
+                    match = idx
+                    break
+        if match is not None:
+            flush_literal()
+            ops.append(match)
+            i += block_size
+            if i + block_size <= n:
+                a, b = weak_checksum(data[i:i + block_size])
+            continue
+
+        # Roll the window one byte forward
+        out = data[i]
+        literal.append(out)
+        if i + block_size < n:
+            a = (a - out + data[i + block_size]) % _M
+            b = (b - block_size * out + a) % _M
+        i += 1
+
+    # The last (shorter) block of the old file can still match the tail
+    tail = bytes(data[i:])
+    if tail and signatures and len(tail) < block_size and \
+       strong_checksum(tail) == signatures[-1][1]:
+        flush_literal()
+        ops.append(len(signatures) - 1)
+    else:
+        literal.extend(tail)
+    flush_literal()
+    return ops
+
+
+def apply_delta(path, ops, block_size):
+    """
+    Rebuilds path from its current contents and a list of delta operations
+    """
+    tmp_path = path + '.delta-tmp'
+    old = open(path, 'rb') if os.path.exists(path) else None
+    try:
+        with open(tmp_path, 'wb') as out:
+            for op in ops:
+                if isinstance(op, int):
+                    old.seek(op * block_size)
+                    out.write(old.read(block_size))
+                else:
+                    out.write(base64.b64decode(op))
+    finally:
+        if old is not None:
+            old.close()
+    os.rename(tmp_path, path)
+
+
+def _signatures(root, block_size, local_manifest):
+    """
+    Compares the given manifest with root. Files that are the same (by size
+    and mtime, or by content) map to None, missing ones to 'missing', and
+    changed ones to their block signatures
+    """
+    result = {}
+    for relpath, entry in local_manifest.items():
+        path = os.path.join(root, relpath)
+        if entry[0] == 'link':
+            same = os.path.islink(path) and os.readlink(path) == entry[1]
+            result[relpath] = None if same else 'missing'
+            continue
+        if os.path.islink(path) or not os.path.isfile(path):
+            result[relpath] = 'missing'
+            continue
+        size, mtime, checksum = entry[:3]
+        st = os.stat(path)
+        if st.st_size == size and (int(st.st_mtime) == mtime or file_checksum(path) == checksum):
+            result[relpath] = None
+        else:
+            result[relpath] = block_signatures(path, block_size)
+    return result
+
+
+def _patch(root, block_size, patch):
+    for relpath, entry in patch.items():
+        path = os.path.join(root, relpath)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if entry['type'] == 'link':
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(entry['target'], path)
+            continue
+        if os.path.islink(path):
+            os.unlink(path)
+        apply_delta(path, entry['ops'], block_size)
+        os.chmod(path, entry['mode'])
+        os.utime(path, (entry['mtime'], entry['mtime']))
+    return {'patched': len(patch)}
+
+
+def main(argv):
+    mode, root, block_size = argv[1], argv[2], int(argv[3])
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    request = json.loads(zlib.decompress(stdin.read()).decode('utf-8'))
+    if mode == 'signatures':
+        result = _signatures(root, block_size, request)
+    elif mode == 'patch':
+        result = _patch(root, block_size, request)
+    else:
+        raise ValueError('Unknown mode: %s' % mode)
+    sys.stdout.write(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -36,6 +36,7 @@ from fabric.tasks import execute
 from fabric.utils import puts
 
 from fabfileTemplate.APPcommon import APP_root_dir, APP_user, APP_source_dir, APP_name
+from fabfileTemplate.executor import execute_on_hosts
 from fabfileTemplate.system import get_fab_public_key
 from fabfileTemplate.utils import check_ssh, generate_key_pair, run, success, failure,\
     default_if_empty, info
@@ -163,7 +164,7 @@ def setup_container():
     # NOTE: This does NOT work on a Mac, because the docker0 network is not
     #       available!
     with settings(disable_known_hosts=True):
-        execute(check_ssh)
+        execute_on_hosts(check_ssh)
 
     success('Container successfully setup! {0} installation will start now'.\
             format(APP_name()))
@@ -0,0 +1,475 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2016
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Module containing an asyncio-based engine to execute tasks on many hosts.
+
+Fabric's @parallel forks a new process for every host, which on clusters with
+thousands of nodes exhausts the memory and file descriptors of the control
+node. The engine in this module instead drives all hosts from a single
+asyncio event loop, and hands the (blocking) fabric tasks over to a fixed
+number of long-lived worker processes. The number of workers is the
+concurrency limit, and is independent of the number of hosts.
+
+The engine is selected per run through the APP_EXECUTOR env variable
+('fork', the default, or 'async'); APP_CONCURRENCY sets the number of
+workers.
+"""
+import asyncio
+import atexit
+import collections
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+import traceback
+
+from fabric.context_managers import settings
+from fabric.decorators import task, runs_once
+from fabric.network import to_dict
+from fabric.state import env
+from fabric.tasks import execute
+from fabric.utils import abort, puts
+
+from fabfileTemplate.connections import install_connection_pool
+from fabfileTemplate.utils import default_if_empty, run, info, success, failure
+
+# Don't re-export the tasks imported from other modules
+__all__ = ['benchmark']
+
+EXECUTORS = ['fork', 'async']
+DEFAULT_EXECUTOR = 'fork'
+DEFAULT_CONCURRENCY = 50
+
+# How often (in seconds) the workers are checked while waiting for results
+WORKER_CHECK_INTERVAL = 1.
+
+# env keys that are never shipped to the workers
+_LOCAL_ENV_KEYS = ('command_batch', 'host_string', 'host', 'port')
+
+
+def executor_name():
+    default_if_empty(env, 'APP_EXECUTOR', DEFAULT_EXECUTOR)
+    if env.APP_EXECUTOR not in EXECUTORS:
+        abort('Unknown APP_EXECUTOR {0}, must be one of {1}'.format(
+            env.APP_EXECUTOR, ', '.join(EXECUTORS)))
+    return env.APP_EXECUTOR
+
+
+def executor_concurrency():
+    default_if_empty(env, 'APP_CONCURRENCY', DEFAULT_CONCURRENCY)
+    return int(env.APP_CONCURRENCY)
+
+
+def _task_reference(t):
+    """
+    Tasks cannot be pickled (fabric wraps them), so workers get the name
+    of the module and attribute where the task can be found instead
+    """
+    func = getattr(t, 'wrapped', t)
+    return func.__module__, func.__name__
+
+
+def _resolve_task(ref):
+    module, name = ref
+    return getattr(sys.modules[module], name)
+
+
+def _env_snapshot():
+    """
+    Returns the part of env that can be sent to the workers
+    """
+    snapshot = {}
+    for k, v in env.items():
+        if k in _LOCAL_ENV_KEYS:
+            continue
+        try:
+            pickle.dumps(v)
+        except Exception:
+            continue
+        snapshot[k] = v
+    return snapshot
+
+
+def _worker_main(jobs, results):
+    """
+    Main loop of a worker process. Each job runs a task against one host,
+    starting from a clean copy of env so hosts don't see each other's state.
+    """
+    install_connection_pool().forget()
+    base_env = dict(env)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, host, task_ref, env_snapshot, args, kwargs = job
+        env.clear()
+        env.update(base_env)
+        env.update(env_snapshot)
+        try:
+            with settings(**to_dict(host)):
+                value = _resolve_task(task_ref)(*args, **kwargs)
+            try:
+                pickle.dumps(value)
+            except Exception:
+                value = repr(value)
+            results.put((job_id, True, value))
+        except KeyboardInterrupt:
+            results.put((job_id, False, 'Interrupted'))
+            break
+        except BaseException as e:
+            if isinstance(e, SystemExit):
+                error = str(e)
+            else:
+                error = traceback.format_exc()
+            results.put((job_id, False, error))
+
+
+class WorkerPool(object):
+    """
+    A fixed set of worker processes, each with its own job queue, running
+    one job at a time. A host's jobs go to the worker that ran its previous
+    ones, so any per-host state kept by the worker (e.g., its pooled SSH
+    connections) is reused across tasks. Hosts without such a worker go to
+    any idle one.
+
+    A worker that dies (e.g., killed by the OOM killer) fails the job it was
+    running and is replaced by a new one.
+    """
+
+    def __init__(self, size):
+        self._ctx = multiprocessing.get_context('fork')
+        self.size = size
+        self.results = self._ctx.Queue()
+        self.queues = [None] * size
+        self.processes = [None] * size
+        # host -> worker holding its state
+        self.host_worker = {}
+        # worker -> job_id it is running
+        self._running = {}
+        # job_id -> worker, for the jobs sent to a worker without a result yet
+        self._pending = {}
+        # Jobs not sent to a worker yet
+        self._waiting = collections.deque()
+        self._lost = collections.deque()
+        self._lock = threading.Lock()
+        for i in range(size):
+            self._start_worker(i)
+
+    def _start_worker(self, i):
+        q = self._ctx.Queue()
+        p = self._ctx.Process(target=_worker_main, args=(q, self.results))
+        p.daemon = True
+        p.start()
+        self.queues[i] = q
+        self.processes[i] = p
+
+    def submit(self, job_id, host, task_ref, env_snapshot, args, kwargs):
+        with self._lock:
+            self._waiting.append((job_id, host, task_ref, env_snapshot, args, kwargs))
+            self._dispatch()
+
+    def _dispatch(self):
+        """
+        Sends the waiting jobs that can run now to their workers
+        """
+        idle = [i for i in range(self.size) if i not in self._running]
+        waiting = collections.deque()
+        while self._waiting:
+            job = self._waiting.popleft()
+            host = job[1]
+            worker = self.host_worker.get(host)
+            if worker is None and idle:
+                worker = self.host_worker[host] = idle[0]
+            if worker is None or worker in self._running:
+                waiting.append(job)
+                continue
+            idle.remove(worker)
+            self._running[worker] = job[0]
+            self._pending[job[0]] = worker
+            self.queues[worker].put(job)
+        self._waiting = waiting
+
+    def _reap_dead_workers(self):
+        with self._lock:
+            for i, p in enumerate(self.processes):
+                if p.is_alive():
+                    continue
+                job_id = self._running.pop(i, None)
+                if job_id is not None:
+                    del self._pending[job_id]
+                    self._lost.append((job_id, False, 'Worker process {0} died (exit code {1})'.format(
+                        p.pid, p.exitcode)))
+                # The state of its hosts died with it
+                for host in [h for h, w in self.host_worker.items() if w == i]:
+                    del self.host_worker[host]
+                self._start_worker(i)
+            self._dispatch()
+
+    def next_result(self, block=True):
+        """
+        Returns the next (job_id, ok, value) result. If block is False
+        returns None when there is no result yet.
+        """
+        while True:
+            if self._lost:
+                return self._lost.popleft()
+            try:
+                job_id, ok, value = self.results.get(block, WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                # Anything a dead worker sent before dying is read first
+                if any(not p.is_alive() for p in self.processes):
+                    try:
+                        job_id, ok, value = self.results.get(True, 0.1)
+                    except queue.Empty:
+                        self._reap_dead_workers()
+                        continue
+                elif not block:
+                    return None
+                else:
+                    continue
+            with self._lock:
+                worker = self._pending.pop(job_id, None)
+                if worker is None:
+                    continue
+                del self._running[worker]
+                self._dispatch()
+            return job_id, ok, value
+
+    def shutdown(self):
+        for q in self.queues:
+            q.put(None)
+        for p in self.processes:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []
+
+
+_pool = None
+
+
+def worker_pool(size):
+    """
+    Returns the process-wide worker pool, creating it if necessary
+    """
+    global _pool
+    if _pool is None or _pool.size != size:
+        shutdown_pool()
+        _pool = WorkerPool(size)
+    return _pool
+
+
+@atexit.register
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+async def _run_on_hosts(pool, task_ref, hosts, args, kwargs, concurrency):
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    env_snapshot = _env_snapshot()
+    futures = {}
+    done = []
+
+    def read_results():
+        # Runs in a thread, as multiprocessing queues can't be awaited
+        while len(done) < len(hosts):
+            job_id, ok, value = pool.next_result()
+            done.append(job_id)
+            loop.call_soon_threadsafe(futures[job_id].set_result, (ok, value))
+
+    async def run_host(job_id, host):
+        async with semaphore:
+            futures[job_id] = loop.create_future()
+            pool.submit(job_id, host, task_ref, env_snapshot, args, kwargs)
+            ok, value = await futures[job_id]
+        if ok:
+            success('{0}: done'.format(host), with_stars=False)
+        else:
+            failure('{0}: failed'.format(host), with_stars=False)
+        return host, ok, value
+
+    reader = threading.Thread(target=read_results)
+    reader.daemon = True
+    reader.start()
+    return await asyncio.gather(*[run_host(i, h) for i, h in enumerate(hosts)])
+
+
+def execute_async(t, *args, **kwargs):
+    """
+    Executes task t on all hosts using the asyncio engine, returning a
+    dictionary with the results per host, like fabric's execute does
+    """
+    hosts = kwargs.pop('hosts', None) or env.hosts
+    if not hosts:
+        abort('No hosts given to execute {0} on'.format(_task_reference(t)[1]))
+    concurrency = min(executor_concurrency(), len(hosts))
+    pool = worker_pool(concurrency)
+    info('Running {0} on {1} hosts with {2} workers'.format(
+        _task_reference(t)[1], len(hosts), concurrency))
+
+    outcome = asyncio.run(_run_on_hosts(pool, _task_reference(t), hosts,
+                                        args, kwargs, concurrency))
+
+    results = {}
+    failed = []
+    for host, ok, value in outcome:
+        results[host] = value
+        if not ok:
+            failed.append(host)
+            failure('{0}: {1}'.format(host, value), with_stars=False)
+    if failed and not env.warn_only:
+        abort('Task failed on {0} of {1} hosts: {2}'.format(
+            len(failed), len(hosts), ', '.join(failed)))
+    return results
+
+
+def execute_pipelined(t, host_source, *args, **kwargs):
+    """
+    Executes task t on each host yielded by host_source (e.g., hosts that
+    become reachable one by one) as soon as it is yielded, using the worker
+    pool of the asyncio engine. Returns a dictionary with the results per
+    host once all of them are done.
+    """
+    pool = worker_pool(executor_concurrency())
+    task_ref = _task_reference(t)
+    env_snapshot = _env_snapshot()
+    hosts = []
+    results = {}
+    failed = []
+    start = time.time()
+
+    def collect(block):
+        while len(results) < len(hosts):
+            result = pool.next_result(block)
+            if result is None:
+                return
+            job_id, ok, value = result
+            host = hosts[job_id]
+            results[host] = value
+            if ok:
+                success('{0}: done after {1:.1f} [s]'.format(host, time.time() - start),
+                        with_stars=False)
+            else:
+                failed.append(host)
+                failure('{0}: {1}'.format(host, value), with_stars=False)
+
+    for host in host_source:
+        info('{0}: starting {1} after {2:.1f} [s]'.format(host, task_ref[1], time.time() - start))
+        pool.submit(len(hosts), host, task_ref, env_snapshot, args, kwargs)
+        hosts.append(host)
+        # Report the hosts that finished in the meanwhile
+        collect(False)
+    collect(True)
+    if failed and not env.warn_only:
+        abort('Task failed on {0} of {1} hosts: {2}'.format(
+            len(failed), len(hosts), ', '.join(failed)))
+    return results
+
+
+def execute_on_hosts(t, *args, **kwargs):
+    """
+    Executes task t on the target hosts with the engine selected by
+    APP_EXECUTOR
+    """
+    if executor_name() == 'async':
+        return execute_async(t, *args, **kwargs)
+    return execute(t, *args, **kwargs)
+
+
+def _tree_usage(pid=None):
+    """
+    Returns the resident memory (in kB) and the number of open file
+    descriptors of a process and all its descendants (Linux only)
+    """
+    pid = pid or os.getpid()
+    rss, fds = 0, 0
+    try:
+        with open('/proc/{0}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+        fds = len(os.listdir('/proc/{0}/fd'.format(pid)))
+        children = []
+        for tid in os.listdir('/proc/{0}/task'.format(pid)):
+            with open('/proc/{0}/task/{1}/children'.format(pid, tid)) as f:
+                children += f.read().split()
+    except (IOError, OSError):
+        return rss, fds
+    for child in children:
+        child_rss, child_fds = _tree_usage(int(child))
+        rss += child_rss
+        fds += child_fds
+    return rss, fds
+
+
+def benchmark_command(command):
+    run(command, quiet=True)
+
+
+@task
+@runs_once
+def benchmark(command='true', engines='fork,async'):
+    """
+    Compares wall time and peak memory/fds of the execution engines,
+    running a command on all target hosts
+    """
+    stats = []
+    for engine in engines.split(','):
+        peak = [0, 0]
+        running = [True]
+
+        def sample():
+            while running[0]:
+                rss, fds = _tree_usage()
+                peak[0] = max(peak[0], rss)
+                peak[1] = max(peak[1], fds)
+                time.sleep(0.1)
+
+        sampler = threading.Thread(target=sample)
+        sampler.daemon = True
+        sampler.start()
+        start = time.time()
+        with settings(APP_EXECUTOR=engine, parallel=(engine == 'fork')):
+            execute_on_hosts(benchmark_command, command, hosts=env.hosts)
+        elapsed = time.time() - start
+        running[0] = False
+        sampler.join()
+        shutdown_pool()
+        stats.append((engine, elapsed, peak[0], peak[1]))
+
+    info('{0:<8} {1:>12} {2:>16} {3:>10}'.format('engine', 'wall time [s]',
+                                                 'peak RSS [MB]', 'peak fds'))
+    for engine, elapsed, rss, fds in stats:
+        puts('{0:<8} {1:>12.2f} {2:>16.1f} {3:>10}'.format(engine, elapsed,
+                                                         rss / 1024., fds))
+
+
+# Use the pool in this process too, connections opened by serial tasks
+# are then reused by later ones
+install_connection_pool()
@@ -0,0 +1,312 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2016
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Module gathering host facts in a single remote round-trip and caching them
+on the control node.
+
+The helpers in the system, utils and pkgmgr modules read from this cache
+first, and only fall back to their own remote probes if a fact is unknown.
+"""
+import json
+import os
+import threading
+import time
+
+from fabric.context_managers import settings, hide
+from fabric.decorators import task
+from fabric.network import join_host_strings, normalize
+from fabric.state import env
+from fabric.utils import puts
+
+from fabfileTemplate.utils import run, default_if_empty, local_cache_dir, info
+
+# Don't re-export the tasks imported from other modules
+__all__ = ['gather_facts', 'show_facts', 'clear_facts']
+
+# Time (in seconds) for which gathered facts are considered valid.
+# A value of 0 disables the cache completely.
+DEFAULT_FACTS_TTL = 3600
+
+# Commands whose location is probed
+PROBE_COMMANDS = [
+    'sudo', 'wget', 'curl', 'tar', 'git', 'gcc', 'make', 'ccache', 'rsync',
+    'lsb_release', 'python', 'python2', 'python3', 'yum', 'apt-get',
+    'dpkg-query', 'rpm', 'zypper', 'brew', 'port',
+]
+
+# Paths whose existence is probed. These are system files that
+# don't change during a deployment; add more through APP_FACTS_PATHS
+PROBE_PATHS = ['/etc/issue', '/etc/os-release']
+
+# Directories whose existence is probed
+PROBE_DIRS = ['/opt/local', '/usr/local/src']
+
+# Prints something unique to the host, telling apart a host re-created
+# with the same address
+MACHINE_ID_COMMAND = 'cat /etc/machine-id 2>/dev/null || hostname'
+
+# Print the architecture and the OS release of the host
+ARCH_COMMAND = 'uname -m'
+OS_RELEASE_COMMAND = ('(. /etc/os-release 2>/dev/null && echo $ID-$VERSION_ID) '
+                      '|| sw_vers -productVersion 2>/dev/null')
+
+# Per-process copy of the facts, keyed by user@host:port
+_facts = {}
+
+# Hosts whose cached facts were checked to belong to them during this run
+_validated = set()
+
+
+def facts_ttl():
+    default_if_empty(env, 'APP_FACTS_TTL', DEFAULT_FACTS_TTL)
+    return float(env.APP_FACTS_TTL)
+
+
+def _facts_key():
+    """
+    Returns the user@host:port the current host is connected with. Facts
+    like the commands in the PATH depend on the user, and settings(user=...)
+    doesn't change env.host_string
+    """
+    return join_host_strings(*normalize(env.host_string))
+
+
+def _facts_file(key):
+    fname = key.replace('@', '_at_').replace(':', '_') + '.json'
+    return os.path.join(local_cache_dir('facts'), fname)
+
+
+def _probe_commands():
+    commands = list(PROBE_COMMANDS)
+    if env.get('APP_PYTHON_VERSION'):
+        commands.append('python{0}'.format(env.APP_PYTHON_VERSION))
+    return commands
+
+
+def _probe_paths():
+    paths = list(PROBE_PATHS)
+    if env.get('APP_FACTS_PATHS'):
+        paths += env.APP_FACTS_PATHS.split(',')
+    return paths
+
+
+def _probe_users():
+    users = []
+    for user in (env.get('APP_USER'), env.user):
+        if user and user not in users:
+            users.append(user)
+    return users
+
+
+def probe_script():
+    """
+    Returns a shell script that prints all the facts we are interested in,
+    one per line, with the form "fact:<key>=<value>"
+    """
+    lines = []
+    for user in _probe_users():
+        lines.append('echo "fact:home.{0}=$(echo ~{0})"'.format(user))
+    for cmd in _probe_commands():
+        lines.append('echo "fact:cmd.{0}=$(command -v {0} 2>/dev/null)"'.format(cmd))
+        if cmd.startswith('python'):
+            lines.append('command -v {0} >/dev/null 2>&1 && echo "fact:pyver.{0}='
+                         '$({0} -V 2>&1 | awk \'{{print $2}}\')"'.format(cmd))
+    for path in _probe_paths():
+        lines.append('if [ -e {0} ]; then echo "fact:path.{0}=1"; else echo "fact:path.{0}=0"; fi'.format(path))
+    for directory in PROBE_DIRS:
+        lines.append('if [ -d {0} ]; then echo "fact:dir.{0}=1"; else echo "fact:dir.{0}="; fi'.format(directory))
+    lines += [
+        'command -v lsb_release >/dev/null 2>&1 && echo "fact:lsb_release=$(lsb_release -i 2>/dev/null)"',
+        'command -v python >/dev/null 2>&1 && echo "fact:python_distribution=$(python -c '
+        '\'import platform; print(platform.linux_distribution()[0])\' 2>/dev/null)"',
+        '[ -e /etc/issue ] && echo "fact:issue=$(head -n 1 /etc/issue)"',
+        'echo "fact:uname=$(uname -s)"',
+        'echo "fact:arch=$({0})"'.format(ARCH_COMMAND),
+        'echo "fact:os_release=$( {0})"'.format(OS_RELEASE_COMMAND),
+        'echo "fact:machine_id=$({0})"'.format(MACHINE_ID_COMMAND),
+        'echo "fact:cpus=$(getconf _NPROCESSORS_ONLN 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null)"',
+        'echo "fact:disk_free_home_kb=$(df -Pk ~ 2>/dev/null | awk \'NR==2 {print $4}\')"',
+        'echo "fact:disk_free_tmp_kb=$(df -Pk /tmp 2>/dev/null | awk \'NR==2 {print $4}\')"',
+        'command -v brew >/dev/null 2>&1 && echo "fact:brew_cellar=$(brew --cellar 2>/dev/null)"',
+        'true',
+    ]
+    return '\n'.join(lines)
+
+
+def parse_facts(output):
+    """
+    Parses the output of the probe script into a dictionary
+    """
+    facts = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if not line.startswith('fact:') or '=' not in line:
+            continue
+        key, value = line[5:].split('=', 1)
+        facts[key] = value.strip()
+
+    # Unresolved home directories are echoed back verbatim
+    for key in list(facts):
+        if key.startswith('home.') and facts[key].startswith('~'):
+            del facts[key]
+    return facts
+
+
+def _load_cached_facts(key, ttl):
+    fname = _facts_file(key)
+    try:
+        with open(fname, 'rt') as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if time.time() - cached['timestamp'] > ttl:
+        return None
+    return cached['facts']
+
+
+def _save_facts(key, facts):
+    # Write to a temporary file first, other parallel processes
+    # might be reading this file
+    fname = _facts_file(key)
+    tmpname = '{0}.{1}.{2}'.format(fname, os.getpid(), threading.current_thread().ident)
+    with open(tmpname, 'wt') as f:
+        json.dump({'timestamp': time.time(), 'facts': facts}, f, indent=1)
+    os.rename(tmpname, fname)
+
+
+def probe_machine_id():
+    """
+    Returns the machine ID of the current host, always probing it remotely
+    """
+    with settings(hide('everything'), warn_only=True, command_batch=None):
+        res = run(MACHINE_ID_COMMAND, quiet=True)
+    return res.strip() if res.succeeded else ''
+
+
+def host_facts(refresh=False):
+    """
+    Returns the facts of the current host, gathering them remotely with
+    a single command if they are not cached or the cache has expired.
+    Returns an empty dictionary if the cache is disabled.
+
+    Facts cached by a previous run are only used if the machine ID of the
+    host is still the same, otherwise they belong to a host that used to
+    have the same address.
+    """
+    if not env.host_string or facts_ttl() <= 0:
+        return {}
+    key = _facts_key()
+
+    if not refresh:
+        facts = _facts.get(key)
+        if facts is None:
+            facts = _load_cached_facts(key, facts_ttl())
+            if facts is not None and key not in _validated:
+                if facts.get('machine_id') != probe_machine_id():
+                    facts = None
+        if facts is not None:
+            _validated.add(key)
+            _facts[key] = facts
+            return facts
+
+    # Never queue the probe in a command batch, we need its output now
+    with settings(hide('everything'), warn_only=True, command_batch=None):
+        res = run(probe_script(), quiet=True)
+    if res.failed:
+        return {}
+    facts = parse_facts(res)
+    _validated.add(key)
+    _facts[key] = facts
+    _save_facts(key, facts)
+    return facts
+
+
+def host_fact(key, default=None):
+    """
+    Returns the value of a single fact of the current host, or default if
+    the fact is unknown
+    """
+    return host_facts().get(key, default)
+
+
+def probed_fact(key, command):
+    """
+    Returns a fact of the current host, running command to find it out if
+    it is unknown (e.g., because the facts cache is disabled)
+    """
+    value = host_fact(key)
+    if value:
+        return value
+    with settings(hide('everything'), warn_only=True, command_batch=None):
+        res = run(command, quiet=True)
+    return res.strip() if res.succeeded else ''
+
+
+def forget_host_facts():
+    """
+    Forget the in-memory facts of the current host, so they are read again
+    from the local cache. Needed when other processes might have changed them.
+    """
+    if env.host_string:
+        _facts.pop(_facts_key(), None)
+
+
+def invalidate_host_facts():
+    """
+    Forget the facts of the current host. This needs to be called after
+    operations that change the host (e.g., installing packages or users)
+    """
+    if not env.host_string:
+        return
+    key = _facts_key()
+    _facts.pop(key, None)
+    try:
+        os.unlink(_facts_file(key))
+    except OSError:
+        pass
+
+
+@task
+def gather_facts():
+    """
+    Gathers the facts of the target host(s) in a single round-trip
+    """
+    return host_facts(refresh=True)
+
+
+@task
+def show_facts():
+    """
+    Prints the (cached) facts of the target host(s)
+    """
+    facts = host_facts()
+    info('Facts for {0}:'.format(env.host_string))
+    for key in sorted(facts):
+        puts('{0}: {1}'.format(key, facts[key]))
+
+
+@task
+def clear_facts():
+    """
+    Removes the cached facts of the target host(s)
+    """
+    invalidate_host_facts()
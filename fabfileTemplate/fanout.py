@@ -0,0 +1,256 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2016
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Module distributing deployment artifacts to many hosts through a tree.
+
+Instead of the control node uploading the same file to every host, it only
+uploads it to a few seed hosts. Every host that has received (and verified)
+the file serves it over HTTP to its children in the tree, which fetch it and
+verify its checksum in turn. With a fan-out degree d the file reaches N hosts
+in about log_d(N) rounds.
+
+Hosts serve the files on their private address, and only under a random
+path that changes with every distribution. The port can be reachable from
+anywhere (e.g., through the public address of a cloud instance), only the
+hosts taking part in the distribution know where the file is. They need to
+be able to reach each other on APP_FANOUT_PORT.
+"""
+import binascii
+import hashlib
+import os
+
+from fabric.context_managers import settings, hide
+from fabric.operations import put
+from fabric.state import env
+from fabric.utils import abort
+
+from fabfileTemplate.executor import execute_on_hosts
+from fabfileTemplate.system import check_command
+from fabfileTemplate.utils import run, default_if_empty, info, success, warning
+
+# Number of children of each node in the distribution tree.
+# 0 disables the tree distribution.
+DEFAULT_FANOUT_DEGREE = 0
+
+# Port where hosts serve the artifacts to their children
+DEFAULT_FANOUT_PORT = 8888
+
+
+def fanout_degree():
+    default_if_empty(env, 'APP_FANOUT_DEGREE', DEFAULT_FANOUT_DEGREE)
+    return int(env.APP_FANOUT_DEGREE)
+
+
+def fanout_port():
+    default_if_empty(env, 'APP_FANOUT_PORT', DEFAULT_FANOUT_PORT)
+    return int(env.APP_FANOUT_PORT)
+
+
+def fanout_dir():
+    """
+    Remote directory holding (and serving) the distributed artifacts
+    """
+    return '/tmp/{0}_fanout'.format(env.APP_NAME)
+
+
+def fanout_path(local_file):
+    return '{0}/{1}'.format(fanout_dir(), os.path.basename(local_file))
+
+
+def local_checksum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def remote_checksum(path):
+    """
+    Returns the SHA-256 of a remote file, or an empty string if the file
+    does not exist
+    """
+    res = run('if [ -f {0} ]; then (sha256sum {0} 2>/dev/null || shasum -a 256 {0}) '
+              '| cut -d" " -f1; fi'.format(path), quiet=True, warn_only=True)
+    return res.strip() if res.succeeded else ''
+
+
+def fanout_tree(hosts, degree):
+    """
+    Returns the rounds of the distribution, each a list of (host, parent)
+    tuples; a parent of None means the control node. The control node and
+    every host have at most degree children, and a host's children are
+    served in the round after it received the file.
+    """
+    parents = {}
+    for i, host in enumerate(hosts):
+        parents[host] = None if i < degree else hosts[i // degree - 1]
+    rounds = []
+    depth = {}
+    for host in hosts:
+        parent = parents[host]
+        depth[host] = 0 if parent is None else depth[parent] + 1
+        if depth[host] == len(rounds):
+            rounds.append([])
+        rounds[depth[host]].append((host, parent))
+    return rounds
+
+
+# Serves the current directory on the address and port given as arguments,
+# under the path given in APP_FANOUT_TOKEN (an environment variable, unlike
+# the arguments it can't be seen by other users of the host)
+_SERVER_SNIPPET = ('import os, sys\n'
+                   'try:\n'
+                   '    from http.server import HTTPServer, SimpleHTTPRequestHandler\n'
+                   'except ImportError:\n'
+                   '    from BaseHTTPServer import HTTPServer\n'
+                   '    from SimpleHTTPServer import SimpleHTTPRequestHandler\n'
+                   'prefix = "/" + os.environ["APP_FANOUT_TOKEN"] + "/"\n'
+                   'class Handler(SimpleHTTPRequestHandler):\n'
+                   '    def send_head(self):\n'
+                   '        if not self.path.startswith(prefix):\n'
+                   '            self.send_error(404)\n'
+                   '            return None\n'
+                   '        self.path = self.path[len(prefix) - 1:]\n'
+                   '        return SimpleHTTPRequestHandler.send_head(self)\n'
+                   'HTTPServer((sys.argv[1], int(sys.argv[2])), Handler).serve_forever()')
+
+# Exits successfully once the address and port given as arguments accept connections
+_WAIT_SNIPPET = ('import socket, sys, time\n'
+                 'for _ in range(50):\n'
+                 '    try:\n'
+                 '        socket.create_connection((sys.argv[1], int(sys.argv[2])), 1).close()\n'
+                 '        sys.exit(0)\n'
+                 '    except socket.error:\n'
+                 '        time.sleep(0.1)\n'
+                 'sys.exit(1)')
+
+
+def private_address():
+    """
+    Returns the private (first non-loopback) IPv4 address of the current
+    host, or an empty string if it can't be found
+    """
+    res = run("(hostname -I 2>/dev/null || ip -4 -o addr show scope global 2>/dev/null "
+              "| awk '{sub(\"/.*\", \"\", $4); print $4}') | awk '{print $1; exit}'",
+              quiet=True, warn_only=True)
+    return res.strip() if res.succeeded else ''
+
+
+def fanout_token():
+    """
+    Returns a new random path under which the hosts serve a distribution
+    """
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+def _serve(token):
+    """
+    Serves fanout_dir() under token on the private address of the current
+    host, and returns the address once the server answers, or None if it
+    couldn't be started (children then get the file from the control node)
+    """
+    python = check_command('python3') or check_command('python')
+    address = private_address()
+    if not python or not address:
+        warning('Cannot serve artifacts from {0}, its children will get them directly'.format(
+            env.host), with_stars=False)
+        return None
+    with hide('running'):
+        run("cd {0} && (APP_FANOUT_TOKEN={1} nohup {2} -c '{3}' {4} {5} > /dev/null 2>&1 & "
+            "echo $! > .server.pid)".format(fanout_dir(), token, python, _SERVER_SNIPPET,
+                                            address, fanout_port()), quiet=True)
+    # The children are served in the next round, the server must be up by then
+    res = run("{0} -c '{1}' {2} {3}".format(python, _WAIT_SNIPPET, address, fanout_port()),
+              quiet=True, warn_only=True)
+    if res.failed:
+        warning('Artifact server on {0} did not start, its children will get them directly'.format(
+            env.host), with_stars=False)
+        stop_serving()
+        return None
+    return address
+
+
+def receive(local_file, checksum, parents, addresses, serve_hosts, token):
+    """
+    Gets local_file into fanout_dir() of the current host, from its parent
+    in the tree or from the control node, and verifies it. Hosts with
+    children then start serving it under token, returning the address they
+    serve on.
+    """
+    target = fanout_path(local_file)
+    run('mkdir -p {0}'.format(fanout_dir()), quiet=True)
+    if remote_checksum(target) != checksum:
+        parent = parents.get(env.host_string)
+        address = addresses.get(parent)
+        if address:
+            url = 'http://{0}:{1}/{2}/{3}'.format(address, fanout_port(), token,
+                                                  os.path.basename(target))
+            run('wget -q -O {0} {1} || curl -sf -o {0} {1}'.format(target, url),
+                quiet=True, warn_only=True)
+        if remote_checksum(target) != checksum:
+            if parent is not None:
+                warning('Checksum mismatch for {0} from {1}, uploading it directly'.format(
+                    target, parent), with_stars=False)
+            put(local_file, target)
+            if remote_checksum(target) != checksum:
+                abort('Checksum mismatch for {0} in {1}'.format(target, env.host))
+    if env.host_string in serve_hosts:
+        return _serve(token)
+    return None
+
+
+def stop_serving():
+    run('cd {0} && if [ -f .server.pid ]; then kill $(cat .server.pid); rm .server.pid; fi'.format(
+        fanout_dir()), quiet=True, warn_only=True)
+
+
+def distribute(local_file, hosts=None):
+    """
+    Distributes local_file to fanout_path(local_file) on all hosts through
+    a tree of degree APP_FANOUT_DEGREE
+    """
+    hosts = list(hosts or env.hosts)
+    degree = fanout_degree()
+    if degree <= 0 or not hosts:
+        return
+    checksum = local_checksum(local_file)
+    rounds = fanout_tree(hosts, degree)
+    parents = dict(pair for r in rounds for pair in r)
+    serve_hosts = set(p for p in parents.values() if p is not None)
+    token = fanout_token()
+    info('Distributing {0} to {1} hosts in {2} rounds'.format(
+        os.path.basename(local_file), len(hosts), len(rounds)))
+    # Addresses where the hosts of the previous rounds serve the file
+    addresses = {}
+    try:
+        with settings(parallel=True):
+            for i, r in enumerate(rounds):
+                results = execute_on_hosts(receive, local_file, checksum, parents, addresses,
+                                           serve_hosts, token, hosts=[host for host, _ in r])
+                addresses.update((host, address) for host, address in results.items() if address)
+                info('Round {0}: {1} hosts'.format(i + 1, len(r)))
+    finally:
+        if serve_hosts:
+            with settings(parallel=True):
+                execute_on_hosts(stop_serving, hosts=sorted(serve_hosts))
+    success('{0} distributed'.format(os.path.basename(local_file)))
@@ -26,23 +26,27 @@ Module with a few high-level fabric tasks users are likely to use
 import os, inspect
 
 from fabric.context_managers import settings
-from fabric.decorators import task, parallel
+from fabric.decorators import task, parallel, runs_once
 from fabric.operations import local
 from fabric.state import env
-from fabric.tasks import execute
+from fabric.utils import abort
 
-from .aws import create_aws_instances
+from .aws import create_aws_instances, create_aws_instances_pipelined, aws_pipeline
+from .aws import bake_ami
 from .dockerContainer import setup_container, create_final_image
-from .utils import repo_root, check_ssh, append_desc
-from .system import check_sudo
+from .executor import execute_on_hosts, execute_pipelined
+from .fanout import distribute, fanout_degree
+from .utils import repo_root, check_ssh, append_desc, to_boolean
+from .system import check_sudo, python_tarball
 
 from .APPcommon import install_and_check, prepare_install_and_check
 from .APPcommon import create_sources_tarball, upload_to, APP_revision
+from .APPcommon import sources_tarball
 
 
 # Don't re-export the tasks imported from other modules, only ours
-__all__ = ['user_deploy', 'operations_deploy', 'aws_deploy', 'docker_image',
-           'prepare_release', 'upload_release']
+__all__ = ['user_deploy', 'operations_deploy', 'fleet_deploy', 'aws_deploy',
+           'docker_image', 'prepare_release', 'upload_release']
 
 
 @task
@@ -67,17 +71,67 @@ def operations_deploy():
     prepare_install_and_check()
 
 
+@task
+@runs_once
+def fleet_deploy(deploy='operations'):
+    """Runs user_deploy or operations_deploy on all hosts with the APP_EXECUTOR engine."""
+    # Meant for large numbers of hosts: with APP_EXECUTOR=async all of them
+    # are driven from this process by a fixed number of workers instead of
+    # forking one process per host
+    env.FAB_TASK = inspect.currentframe().f_code.co_name
+    deploy_tasks = {'user': user_deploy, 'operations': operations_deploy}
+    if deploy not in deploy_tasks:
+        abort('deploy must be one of {0}'.format(', '.join(deploy_tasks)))
+    # Build the sources tarball before fanning out to the hosts
+    distribute_artifacts(sources_tarball())
+    execute_on_hosts(deploy_tasks[deploy])
+
+
+def distribute_artifacts(tarball):
+    """
+    Distributes the sources tarball, and the python tarball if python is
+    pushed from the control node, through the fan-out tree
+    """
+    distribute(tarball)
+    if fanout_degree() > 0:
+        python = python_tarball()
+        if python:
+            distribute(python)
+
+
 @task
 #@append_desc
-def aws_deploy():
-    """Deploy APP on fresh AWS EC2 instances."""
+def aws_deploy(bake=False):
+    """Deploy APP on fresh AWS EC2 instances, baking an AMI from the first one with bake=True."""
     # This task doesn't have @parallel because its initial work
     # (actually *creating* the target host(s)) is serial.
     # After that it modifies the env.hosts to point to the target hosts
     # and then calls execute(prepare_install_and_check) which will be parallel
     env.FAB_TASK = inspect.currentframe().f_code.co_name
-    create_aws_instances()
-    execute(prepare_install_and_check)
+    bake = to_boolean(bake)
+    if bake:
+        # The AMI is baked from a full deployment on the base AMI
+        env.AWS_USE_BAKED_AMI = False
+    tarball = sources_tarball()
+    if aws_pipeline():
+        # Each instance is deployed as soon as it is reachable, while the
+        # rest are still booting. There is no tree distribution of the
+        # sources then, each host gets them from here
+        execute_pipelined(_prepare_install_and_check_when_ready,
+                          create_aws_instances_pipelined())
+    else:
+        create_aws_instances()
+        distribute_artifacts(tarball)
+        execute_on_hosts(prepare_install_and_check)
+    if bake:
+        bake_ami(env.hosts[0])
+
+
+def _prepare_install_and_check_when_ready():
+    # Run in the pipelined job of each host, so the session retries of the
+    # instances overlap instead of holding up the ones that follow
+    check_ssh(timeout=300)
+    prepare_install_and_check()
 
 
 @task
@@ -89,6 +143,7 @@ def docker_image():
     # This container will be running an SSH server, and we will be able
     # to connect to its root user with our SSH key
     env.FAB_TASK = inspect.currentframe().f_code.co_name
+    sources_tarball()
     dockerState = setup_container()
 
     # Now install into the docker container.
@@ -100,7 +155,7 @@ def docker_image():
     # Finally, we also hardcode that the doc dependencies will *not* be
     # installed into the docker container, so we generate a thiner image
     with settings(disable_known_hosts=True, APP_NO_DOC_DEPENDENCIES=True):
-        execute(prepare_install_and_check)
+        execute_on_hosts(prepare_install_and_check)
         create_final_image(dockerState)
 
 
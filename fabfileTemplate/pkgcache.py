@@ -0,0 +1,290 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2016
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Caching HTTP proxy for system packages.
+
+yum, apt and zypper are pointed to this proxy through http_proxy. Package
+files (rpm, deb) never change once published under a given name, so they
+are downloaded from the upstream mirror only once and then served from the
+cache directory to every host; concurrent requests for the same package wait
+for the first download instead of starting their own. Everything else
+(repository metadata, HTTPS through CONNECT) is passed through uncached.
+
+The proxy only listens on the given address (loopback by default), and
+only serves package mirrors: the known mirror domains and any given with
+--mirrors. Requests for other hosts are refused, and HTTPS is only tunneled
+to port 443. With --owner it exits once the given process does.
+
+Like delta.py this module only depends on the standard library and works
+with python 2 and 3, so it can also run on a host other than the control
+node::
+
+    python pkgcache.py <port> <cache_dir> [--bind <address>] [--owner <pid>]
+                       [--mirrors <domain>,...]
+"""
+import argparse
+import hashlib
+import os
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit
+    from urllib.request import Request, ProxyHandler, build_opener
+    from urllib.error import HTTPError
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+    from urllib2 import Request, ProxyHandler, build_opener, HTTPError
+
+# Files that never change once published, and can therefore be cached forever
+CACHEABLE_EXTENSIONS = ('.rpm', '.drpm', '.deb', '.udeb')
+
+# Domains of the package mirrors served by the proxy (and their subdomains)
+MIRROR_DOMAINS = ('amazonaws.com', 'amazonlinux.com', 'centos.org', 'fedoraproject.org',
+                  'rockylinux.org', 'almalinux.org', 'debian.org', 'ubuntu.com',
+                  'launchpad.net', 'opensuse.org', 'suse.com')
+
+# Hop-by-hop headers that are not forwarded
+_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'proxy-authorization',
+                'te', 'trailer', 'transfer-encoding', 'upgrade')
+
+# The proxy itself must reach the mirrors directly, not through http_proxy
+_opener = build_opener(ProxyHandler({}))
+
+
+def cache_key(url):
+    """
+    Name of the cache file for url, keeping its basename for readability
+    """
+    path = urlsplit(url).path
+    return '{0}-{1}'.format(hashlib.sha1(url.encode('utf-8')).hexdigest()[:16],
+                            os.path.basename(path))
+
+
+def is_cacheable(url):
+    return urlsplit(url).path.endswith(CACHEABLE_EXTENSIONS)
+
+
+class PackageCache(object):
+    """
+    Files downloaded from the upstream mirrors, with one download per URL
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'passthrough': 0, 'bytes_served': 0,
+                      'bytes_fetched': 0}
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _count(self, stat, n=1):
+        with self._locks_lock:
+            self.stats[stat] += n
+
+    def get(self, url):
+        """
+        Returns the path of the cached copy of url, downloading it first if
+        necessary. Raises HTTPError if the upstream mirror fails.
+        """
+        key = cache_key(url)
+        path = os.path.join(self.cache_dir, key)
+        with self._lock(key):
+            if os.path.exists(path):
+                self._count('hits')
+                return path
+            self._count('misses')
+            response = _opener.open(Request(url))
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.' + key)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(response, f, 1 << 20)
+                self._count('bytes_fetched', os.path.getsize(tmp))
+                os.rename(tmp, path)
+            except:
+                os.unlink(tmp)
+                raise
+            finally:
+                response.close()
+        return path
+
+
+class PackageCacheHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send_file(self, path, head_only=False):
+        size = os.path.getsize(path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if head_only:
+            return
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, 1 << 20)
+        self.server.cache._count('bytes_served', size)
+
+    def _passthrough(self, head_only=False):
+        self.server.cache._count('passthrough')
+        headers = dict((k, v) for k, v in self.headers.items()
+                       if k.lower() not in _HOP_HEADERS and k.lower() != 'host')
+        request = Request(self.path, headers=headers)
+        if head_only:
+            request.get_method = lambda: 'HEAD'
+        try:
+            response = _opener.open(request)
+        except HTTPError as e:
+            response = e
+        try:
+            self.send_response(response.getcode())
+            for k, v in response.info().items():
+                if k.lower() not in _HOP_HEADERS:
+                    self.send_header(k, v)
+            self.end_headers()
+            if not head_only:
+                shutil.copyfileobj(response, self.wfile, 1 << 20)
+        finally:
+            response.close()
+
+    def _get(self, head_only=False):
+        if not self.path.startswith('http://'):
+            self.send_error(400, 'Only proxy requests are served')
+            return
+        if not self.server.is_mirror(urlsplit(self.path).hostname or ''):
+            self.send_error(403, 'Only package mirrors are served')
+            return
+        try:
+            if is_cacheable(self.path):
+                self._send_file(self.server.cache.get(self.path), head_only)
+            else:
+                self._passthrough(head_only)
+        except HTTPError as e:
+            self.send_error(e.code, str(e.reason))
+        except (IOError, OSError) as e:
+            self.send_error(502, str(e))
+
+    def do_GET(self):
+        self._get()
+
+    def do_HEAD(self):
+        self._get(head_only=True)
+
+    def do_CONNECT(self):
+        """
+        Tunnels HTTPS traffic, which can't be cached
+        """
+        host, _, port = self.path.partition(':')
+        if (port or '443') != '443' or not self.server.is_mirror(host):
+            self.send_error(403, 'Only HTTPS to package mirrors is tunneled')
+            return
+        self.server.cache._count('passthrough')
+        try:
+            upstream = socket.create_connection((host, int(port or 443)), timeout=60)
+        except (IOError, OSError) as e:
+            self.send_error(502, str(e))
+            return
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, broken = select.select(sockets, [], sockets, 60)
+                if broken or not readable:
+                    break
+                for s in readable:
+                    data = s.recv(1 << 16)
+                    if not data:
+                        return
+                    (upstream if s is self.connection else self.connection).sendall(data)
+        finally:
+            upstream.close()
+
+
+class PackageCacheServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache_dir, verbose=False, mirrors=()):
+        HTTPServer.__init__(self, address, PackageCacheHandler)
+        self.cache = PackageCache(cache_dir)
+        self.verbose = verbose
+        self.mirror_domains = tuple(MIRROR_DOMAINS) + tuple(m.lower() for m in mirrors)
+
+    def is_mirror(self, host):
+        host = host.lower()
+        return any(host == d or host.endswith('.' + d) for d in self.mirror_domains)
+
+
+def _exit_with(server, pid):
+    while True:
+        time.sleep(5)
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            server.shutdown()
+            return
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('port', type=int)
+    parser.add_argument('cache_dir')
+    parser.add_argument('--bind', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--owner', type=int, help='exit once this process does')
+    parser.add_argument('--mirrors', default='', help='more mirror domains, comma-separated')
+    args = parser.parse_args(argv[1:])
+
+    mirrors = [m for m in args.mirrors.split(',') if m]
+    server = PackageCacheServer((args.bind, args.port), args.cache_dir, verbose=True,
+                                mirrors=mirrors)
+    if args.owner:
+        watcher = threading.Thread(target=_exit_with, args=(server, args.owner))
+        watcher.daemon = True
+        watcher.start()
+    try:
+        server.serve_forever()
+    finally:
+        sys.stderr.write('Package cache stats: {0}\n'.format(server.cache.stats))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -22,19 +22,63 @@
 """
 Module containing methods and fabric tasks that manage system packages
 """
+import contextlib
+import inspect
+import os
+import socket
+import subprocess
+import sys
+import time
 
 from fabric.colors import red
-from fabric.context_managers import settings, hide
+from fabric.context_managers import settings, hide, shell_env, remote_tunnel
 from fabric.decorators import task
+from fabric.operations import put
 from fabric.state import env
 from fabric.utils import puts, abort
 
+from fabfileTemplate import pkgcache
+from fabfileTemplate.facts import host_fact, invalidate_host_facts
+from fabfileTemplate.fanout import private_address
 from fabfileTemplate.system import check_command, get_linux_flavor
-from fabfileTemplate.utils import sudo, run
+from fabfileTemplate.utils import sudo, run, info, success, default_if_empty, \
+    local_cache_dir, local_lock
 
 # Don't re-export the tasks imported from other modules, only ours
 __all__ = ['install_homebrew', 'install_system_packages', 'system_check',
-           'list_packages']
+           'list_packages', 'start_package_cache', 'stop_package_cache']
+
+# Where the package cache runs: '' (don't use one), 'local' (on the control
+# node, reached by the hosts through a reverse SSH tunnel) or the
+# host[:port] of a host running it (see start_package_cache)
+DEFAULT_PKG_CACHE = ''
+DEFAULT_PKG_CACHE_PORT = 3142
+
+# Domains of package mirrors (or other repositories) the cache serves,
+# besides the well-known ones (comma-separated)
+DEFAULT_PKG_CACHE_MIRRORS = ''
+
+# The fab process itself (this module is imported before any host is forked),
+# a local package cache stops when it does
+_FAB_PID = os.getpid()
+
+# Package manager and package list used on each linux flavor
+PACKAGE_MANAGERS = (
+    (('CentOS', 'Amazon Linux', 'Linux'), 'yum', 'YUM_PACKAGES'),
+    (('Ubuntu', 'Debian'), 'apt', 'APT_PACKAGES'),
+    (('SUSE', 'SLES-SP2', 'SLES-SP3', 'SLES', 'openSUSE'), 'zypper', 'SLES_PACKAGES'),
+)
+
+# Single command listing all installed packages, one per line
+INSTALLED_PACKAGES_QUERIES = {
+    'yum': "rpm -qa --queryformat '%{NAME}\\n'",
+    'zypper': "rpm -qa --queryformat '%{NAME}\\n'",
+    'apt': "dpkg-query -W -f '${Package} ${Status}\\n'",
+}
+
+# apt-get errors meaning that a package name is wrong, as opposed to
+# failures of the installation itself
+APT_UNKNOWN_PACKAGE_MESSAGES = ('Unable to locate package', 'has no installation candidate')
 
 def extra_packages():
     key = 'APP_EXTRA_PACKAGES'
@@ -43,11 +87,185 @@ def extra_packages():
     return []
 
 
+def with_extra_packages(packages):
+    """
+    Returns packages followed by the extra packages not already in it
+    """
+    return packages + [p for p in extra_packages() if p not in packages]
+
+
+def package_cache():
+    default_if_empty(env, 'APP_PKG_CACHE', DEFAULT_PKG_CACHE)
+    return env.APP_PKG_CACHE
+
+
+def package_cache_port():
+    default_if_empty(env, 'APP_PKG_CACHE_PORT', DEFAULT_PKG_CACHE_PORT)
+    return int(env.APP_PKG_CACHE_PORT)
+
+
+def package_cache_mirrors():
+    default_if_empty(env, 'APP_PKG_CACHE_MIRRORS', DEFAULT_PKG_CACHE_MIRRORS)
+    return env.APP_PKG_CACHE_MIRRORS
+
+
+def _listening(host, port):
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def start_local_package_cache():
+    """
+    Starts the package cache on the control node, unless it's running already.
+    It only listens on the loopback interface, where the hosts' reverse
+    tunnels arrive, and stops when fab finishes; the cached packages are
+    kept for later deployments.
+    """
+    port = package_cache_port()
+    cache_dir = local_cache_dir('packages')
+    with local_lock(os.path.join(cache_dir, '.lock')):
+        if _listening('127.0.0.1', port):
+            return
+        with open(os.path.join(cache_dir, '.server.log'), 'ab') as log:
+            proc = subprocess.Popen([sys.executable, inspect.getsourcefile(pkgcache),
+                                     str(port), cache_dir, '--owner', str(_FAB_PID),
+                                     '--mirrors', package_cache_mirrors()],
+                                    stdout=log, stderr=log, close_fds=True)
+        with open(os.path.join(cache_dir, '.server.pid'), 'w') as f:
+            f.write(str(proc.pid))
+        for _ in range(50):
+            if _listening('127.0.0.1', port):
+                break
+            if proc.poll() is not None:
+                abort('Package cache failed to start, see {0}'.format(
+                    os.path.join(cache_dir, '.server.log')))
+            time.sleep(0.1)
+    info('Package cache listening on port {0} of the control node'.format(port))
+
+
+@contextlib.contextmanager
+def _no_tunnel():
+    yield
+
+
+@contextlib.contextmanager
+def package_cache_proxy():
+    """
+    Context manager routing the package managers' downloads through the
+    package cache, if one is configured
+    """
+    cache = package_cache()
+    if not cache:
+        yield
+        return
+
+    port = package_cache_port()
+    if cache == 'local':
+        start_local_package_cache()
+        tunnel = remote_tunnel(port, local_port=port, local_host='127.0.0.1')
+        proxy = 'http://127.0.0.1:{0}'.format(port)
+    else:
+        tunnel = _no_tunnel()
+        proxy = 'http://{0}'.format(cache if ':' in cache else '{0}:{1}'.format(cache, port))
+
+    with tunnel, shell_env(http_proxy=proxy, https_proxy=proxy):
+        yield
+
+
+@task
+def start_package_cache():
+    """
+    Starts the package cache on the host (or on the control node if no host
+    is given), so that others can use it through APP_PKG_CACHE. On a host
+    it listens on its private address only, and runs until stopped.
+    """
+    port = package_cache_port()
+    if not env.host_string:
+        return start_local_package_cache()
+    python = check_command('python3') or check_command('python')
+    if not python:
+        abort('No python found in {0} to run the package cache'.format(env.host))
+    address = private_address()
+    if not address:
+        abort('Could not find the private address of {0}'.format(env.host))
+    cache_dir = '/tmp/{0}_pkgcache'.format(env.APP_NAME)
+    run('mkdir -p {0}'.format(cache_dir))
+    put(inspect.getsourcefile(pkgcache), '{0}/pkgcache.py'.format(cache_dir))
+    run("cd {0} && if [ ! -f .server.pid ] || ! kill -0 $(cat .server.pid) 2> /dev/null; then "
+        "(nohup {1} pkgcache.py {2} {0} --bind {3} --mirrors '{4}' > .server.log 2>&1 & "
+        "echo $! > .server.pid); fi".format(
+            cache_dir, python, port, address, package_cache_mirrors()), quiet=True)
+    success('Package cache running, use it with APP_PKG_CACHE={0}:{1}'.format(address, port))
+
+
+@task
+def stop_package_cache():
+    """
+    Stops the package cache on the host (or on the control node if no host
+    is given). The cached packages are kept.
+    """
+    if not env.host_string:
+        pidfile = os.path.join(local_cache_dir('packages'), '.server.pid')
+        if os.path.exists(pidfile):
+            with open(pidfile) as f:
+                try:
+                    os.kill(int(f.read()), 15)
+                except OSError:
+                    pass
+            os.unlink(pidfile)
+        return
+    run('cd /tmp/{0}_pkgcache && if [ -f .server.pid ]; then kill $(cat .server.pid); '
+        'rm .server.pid; fi'.format(env.APP_NAME), quiet=True, warn_only=True)
+
+
+def package_manager(linux_flavor):
+    """
+    Returns the (package manager, env.pkgs key) for the given linux flavor,
+    or (None, None) if it isn't handled through a linux package manager
+    """
+    for flavors, pkg_mgr, key in PACKAGE_MANAGERS:
+        if linux_flavor in flavors:
+            return pkg_mgr, key
+    return None, None
+
+
+def installed_packages(pkg_mgr):
+    """
+    Returns the set of package names installed on the host, queried in
+    a single call to the package database
+    """
+    with settings(hide('everything'), warn_only=True):
+        out = run(INSTALLED_PACKAGES_QUERIES[pkg_mgr])
+    if out.failed:
+        return set()
+    installed = set()
+    for line in out.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        # dpkg also lists removed packages whose configuration is still there
+        if pkg_mgr == 'apt' and line.strip().split(' ')[-1] != 'installed':
+            continue
+        installed.add(fields[0])
+    return installed
+
+
+def missing_packages(pkg_mgr, packages):
+    """
+    Returns the packages (in order) that are not installed on the host
+    """
+    installed = installed_packages(pkg_mgr)
+    return [p for p in packages if p not in installed]
+
+
 def install_yum(packages):
     """
     Install packages using YUM
     """
-    errmsg = sudo('yum --assumeyes --quiet install {0}'.format(' '.join(packages + extra_packages())),\
+    errmsg = sudo('yum --assumeyes --quiet install {0}'.format(' '.join(with_extra_packages(packages))),\
                    combine_stderr=True, warn_only=True)
     processCentOSErrMsg(errmsg)
 
@@ -65,7 +283,7 @@ def install_zypper(packages):
     """
     Install packages using zypper (SLES)
     """
-    sudo('zypper --non-interactive install {0}'.format(' '.join(packages + extra_packages())),\
+    sudo('zypper --non-interactive install {0}'.format(' '.join(with_extra_packages(packages))),\
                    combine_stderr=True, warn_only=True)
 
 
@@ -74,13 +292,37 @@ def install_apt(packages):
     """
     Install packages using APT
     """
-    # We need to iterate over each one because if at least one of them
-    # is actually not a package (misspelled, doesn't exist anymore, debian-
-    # or ubuntu-specific, etc) the whole install process would fail
-    # On the other hand there appears to be no flag to ignore these errors
-    # on apt-get (tested on Ubuntu 12.04)
-    for pkg in packages + extra_packages():
-        sudo('apt-get -qq -y install {0}'.format(pkg))
+    # If at least one of them is actually not a package (misspelled, doesn't
+    # exist anymore, debian- or ubuntu-specific, etc) the whole install
+    # process fails, and there appears to be no flag to ignore these errors
+    # on apt-get (tested on Ubuntu 12.04).
+    # We therefore try all of them in one go, and only if that fails because
+    # of unknown packages we bisect the list to isolate the bad names. Any
+    # other failure (e.g., the dpkg lock being held, network errors) aborts
+    invalid = []
+
+    def install(pkgs):
+        if not pkgs:
+            return
+        res = sudo('apt-get -qq -y install {0}'.format(' '.join(pkgs)), warn_only=True)
+        if res.succeeded:
+            return
+        if not any(msg in res for msg in APT_UNKNOWN_PACKAGE_MESSAGES):
+            abort('Installing {0} failed:\n{1}'.format(' '.join(pkgs), res))
+        if len(pkgs) == 1:
+            invalid.append(pkgs[0])
+            return
+        half = len(pkgs) // 2
+        install(pkgs[:half])
+        install(pkgs[half:])
+
+    pkgs = with_extra_packages(packages)
+    install(pkgs)
+    if invalid and len(invalid) == len(pkgs):
+        abort('None of the packages could be installed: {0}'.format(' '.join(invalid)))
+    if invalid:
+        puts(red('Could not install the following packages: {0}'.format(' '.join(invalid))))
+    return invalid
 
 
 def install_brew(package):
@@ -174,6 +416,10 @@ def check_brew_cellar():
     """
     Find the brewing cellar (Mac OSX)
     """
+    cellar = host_fact('brew_cellar')
+    if cellar:
+        return cellar
+
     with hide('output'):
 
         # This yields something like "Homebrew 1.4.2-14-g3e99504"
@@ -208,19 +454,46 @@ def install_system_packages():
     # Install required packages
     linux_flavor = get_linux_flavor()
 
-    if (linux_flavor in ['CentOS', 'Amazon Linux', 'Linux']):
+    # Fast path: if everything is there already there is no need to update
+    # the package database or the system
+    pkg_mgr, key = package_manager(linux_flavor)
+    if not pkg_mgr:
+        _install_system_packages(linux_flavor, pkg_mgr, [])
+    else:
+        missing = missing_packages(pkg_mgr, with_extra_packages(env.pkgs[key]))
+        if not missing:
+            success("All system packages are installed already, skipping update")
+            _stop_firewall(linux_flavor)
+            return
+        info("Missing system packages: {0}".format(' '.join(missing)))
+
+        # Downloads go through the shared package cache, if any
+        with package_cache_proxy():
+            _install_system_packages(linux_flavor, pkg_mgr, missing)
+
+    # Newly installed commands need to be picked up
+    invalidate_host_facts()
+
+
+def _stop_firewall(linux_flavor):
+    # This doesn't persist across reboots, so it's needed on every deployment
+    if linux_flavor == 'CentOS':
+        sudo('/etc/init.d/iptables stop')  # CentOS firewall blocks APP port!
+
+
+def _install_system_packages(linux_flavor, pkg_mgr, missing):
+    if pkg_mgr == 'yum':
         # Update the machine completely
         errmsg = sudo('yum --assumeyes --quiet update', combine_stderr=True, warn_only=True)
         processCentOSErrMsg(errmsg)
-        install_yum(env.pkgs['YUM_PACKAGES'])
-        if linux_flavor == 'CentOS':
-            sudo('/etc/init.d/iptables stop')  # CentOS firewall blocks APP port!
-    elif (linux_flavor in ['Ubuntu', 'Debian']):
+        install_yum(missing)
+        _stop_firewall(linux_flavor)
+    elif pkg_mgr == 'apt':
         errmsg = sudo('apt-get -qq -y update', combine_stderr=True, warn_only=True)
-        install_apt(env.pkgs['APT_PACKAGES'])
-    elif linux_flavor in ['SUSE', 'SLES-SP2', 'SLES-SP3', 'SLES', 'openSUSE']:
+        install_apt(missing)
+    elif pkg_mgr == 'zypper':
         errmsg = sudo('zypper -n -q patch', combine_stderr=True, warn_only=True)
-        install_zypper(env.pkgs['SLES_PACKAGES'])
+        install_zypper(missing)
     elif linux_flavor == 'Darwin':
         pkg_mgr = check_brew_port()
         if pkg_mgr is None:
@@ -240,22 +513,18 @@ def install_system_packages():
 def system_check():
     """
     Check for existence of system level packages
-
-    NOTE: This requires sudo access on the machine(s)
     """
     linux_flavor = get_linux_flavor()
-    ok = True
-    if (linux_flavor in ['CentOS', 'Amazon Linux']):
-        ok = all([check_yum(p) for p in YUM_PACKAGES])
-    elif (linux_flavor == 'Ubuntu'):
-        ok = all([check_apt(p) for p in YUM_PACKAGES])
-    else:
+    pkg_mgr, key = package_manager(linux_flavor)
+    if not pkg_mgr:
         abort("Unknown linux flavor detected: {0}".format(linux_flavor))
 
-    if ok:
+    missing = missing_packages(pkg_mgr, with_extra_packages(env.pkgs[key]))
+    if not missing:
         puts("All required packages are installed.")
     else:
-        puts("At least one package is missing!")
+        puts("At least one package is missing: {0}".format(' '.join(missing)))
+    return not missing
 
 
 @task
@@ -0,0 +1,153 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2016
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Module probing whether hosts are ready to accept SSH connections.
+
+Instead of opening a full SSH session every few seconds, hosts are probed
+by connecting to their SSH port and reading the server's banner, which is
+much cheaper and tells as soon as sshd is up. Failed probes are retried with
+exponential backoff and jitter, and all hosts are probed concurrently from a
+single asyncio event loop, each of them being reported as soon as it is
+ready.
+"""
+import asyncio
+import queue
+import random
+import threading
+import time
+
+from fabric.network import normalize
+from fabric.utils import abort
+
+from fabfileTemplate.utils import info
+
+# Timeout of a single probe
+PROBE_TIMEOUT = 5.
+
+# Backoff between probes of the same host
+INITIAL_DELAY = 0.5
+MAX_DELAY = 10.
+
+_DONE = object()
+
+
+async def ssh_banner(host, port=22, timeout=PROBE_TIMEOUT):
+    """
+    Returns whether an SSH server answers with its banner on host:port
+    """
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        return line.startswith(b'SSH-')
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+async def wait_until_ready(host_string, timeout, probe=ssh_banner):
+    """
+    Probes a host until it is ready or timeout seconds have passed,
+    returning whether it became ready
+    """
+    _, host, port = normalize(host_string)
+    start = time.time()
+    deadline = start + timeout
+    delay = INITIAL_DELAY
+    attempts = 0
+    while True:
+        attempts += 1
+        remaining = deadline - time.time()
+        if await probe(host, int(port), max(min(PROBE_TIMEOUT, remaining), 0.1)):
+            info('{0}: SSH ready after {1:.1f} [s] ({2} probes)'.format(
+                host_string, time.time() - start, attempts))
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        # Exponential backoff with "equal" jitter, so hosts booting together
+        # don't probe in lockstep
+        await asyncio.sleep(min(delay / 2 + random.uniform(0, delay / 2), remaining))
+        delay = min(delay * 2, MAX_DELAY)
+
+
+def ready_hosts(hosts, timeout=300, probe=ssh_banner, failed=None):
+    """
+    Yields each of hosts as soon as it is ready. hosts can be an iterator
+    that takes its time to produce them (e.g., as instances start), and is
+    consumed in a separate thread so the hosts produced so far are probed
+    in the meanwhile.
+
+    Hosts not ready after timeout seconds are added to failed if given, or
+    else make this abort once the rest have been yielded.
+    """
+    results = queue.Queue()
+    loop = asyncio.new_event_loop()
+    runner = threading.Thread(target=loop.run_forever)
+    runner.daemon = True
+    runner.start()
+
+    async def watch(host):
+        results.put((host, await wait_until_ready(host, timeout, probe)))
+
+    def produce():
+        count = 0
+        try:
+            for host in hosts:
+                asyncio.run_coroutine_threadsafe(watch(host), loop)
+                count += 1
+        except BaseException as e:
+            results.put((_DONE, e))
+            return
+        results.put((_DONE, count))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    total = None
+    finished = 0
+    timed_out = []
+    try:
+        while total is None or finished < total:
+            host, value = results.get()
+            if host is _DONE:
+                if isinstance(value, BaseException):
+                    raise value
+                total = value
+                continue
+            finished += 1
+            if value:
+                yield host
+            else:
+                timed_out.append(host)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+
+    if timed_out:
+        if failed is None:
+            abort('No SSH connection could be established to {0} after {1} seconds'.format(
+                ', '.join(timed_out), timeout))
+        failed.extend(timed_out)
@@ -0,0 +1,489 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2016
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Module running the deployment steps of a host as a dependency graph.
+
+Each step declares the steps it runs after; steps whose dependencies are
+satisfied run concurrently, up to APP_STEP_CONCURRENCY at a time. They run
+in threads, which share the SSH connections of the host. Fabric's env and
+output are global, so each thread gets its own copy of them while its step
+runs. The changes a step makes to env (e.g., env.APP_VENV_KEY set by
+virtualenv_setup and used by build) are then seen by the steps that run
+after it.
+
+With APP_STEP_CONCURRENCY=1 the steps run one after the other in this
+process. Either way the timing of every step and the critical path are
+printed at the end.
+
+Steps that declare their inputs are recorded in a per-host journal on the
+control node once they finish. When the deployment is run again, steps whose
+inputs (and those of the steps they run after) haven't changed are skipped,
+so a failed deployment resumes where each host stopped. Set APP_RESUME=False
+to run all steps anyway.
+"""
+import base64
+import hashlib
+import json
+import os
+import pickle
+import queue
+import threading
+import time
+import traceback
+
+from fabric import state
+from fabric.decorators import task
+from fabric.state import env
+from fabric.utils import abort, puts
+
+from fabfileTemplate.connections import install_connection_pool
+from fabfileTemplate.executor import _env_snapshot
+from fabfileTemplate.facts import probe_machine_id
+from fabfileTemplate.utils import default_if_empty, info, success, failure, \
+    local_cache_dir, to_boolean
+
+# Don't re-export the tasks imported from other modules
+__all__ = ['show_journal', 'clear_journal']
+
+DEFAULT_STEP_CONCURRENCY = 4
+DEFAULT_RESUME = True
+
+
+class Step(object):
+    """
+    A deployment step: a function to run on the current host, and the names
+    of the steps that need to finish before it starts. inputs, if given, is
+    a function returning the values the outcome of the step depends on
+    (e.g., the revision of the sources), and makes the step resumable.
+    """
+
+    def __init__(self, name, func, after=(), inputs=None):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+        self.inputs = inputs
+
+    def __repr__(self):
+        return 'Step({0})'.format(self.name)
+
+
+def step_concurrency():
+    default_if_empty(env, 'APP_STEP_CONCURRENCY', DEFAULT_STEP_CONCURRENCY)
+    return int(env.APP_STEP_CONCURRENCY)
+
+
+def resume():
+    default_if_empty(env, 'APP_RESUME', DEFAULT_RESUME)
+    return to_boolean(env.APP_RESUME)
+
+
+def _journal_file():
+    fname = env.host_string.replace('@', '_at_').replace(':', '_') + '.json'
+    return os.path.join(local_cache_dir('journal'), fname)
+
+
+def load_journal():
+    """
+    Returns the journal of the current host: for each finished step the key
+    of its inputs and the changes it made to env
+    """
+    try:
+        with open(_journal_file(), 'rt') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_journal(journal):
+    fname = _journal_file()
+    tmp = '{0}.{1}'.format(fname, os.getpid())
+    with open(tmp, 'wt') as f:
+        json.dump(journal, f, indent=1)
+    os.rename(tmp, fname)
+
+
+def step_keys(steps):
+    """
+    Returns the journal key of each step: a hash of the host, the inputs of
+    the step and the keys of the steps it runs after. Steps without inputs,
+    or running after one without inputs, have no key and always run.
+    """
+    # A re-created host (e.g., a new VM with the same address) starts afresh.
+    # The machine ID is always probed, cached facts could be the old host's
+    host = '{0}\n{1}\n'.format(env.host_string, probe_machine_id())
+    keys = {}
+    for step in steps:
+        deps = [keys[d] for d in step.after]
+        if step.inputs is None or None in deps:
+            keys[step.name] = None
+            continue
+        h = hashlib.sha256(host.encode('utf-8'))
+        h.update(step.name.encode('utf-8'))
+        h.update(json.dumps(step.inputs(), sort_keys=True, default=str).encode('utf-8'))
+        for dep in deps:
+            h.update(dep.encode('utf-8'))
+        keys[step.name] = h.hexdigest()
+    return keys
+
+
+def _record(journal, step, key, env_changes):
+    if key is None:
+        return
+    journal[step.name] = {
+        'key': key,
+        'finished': time.time(),
+        'env': base64.b64encode(pickle.dumps(env_changes)).decode('ascii'),
+    }
+    _save_journal(journal)
+
+
+def _forget(journal, step):
+    if journal.pop(step.name, None) is not None:
+        _save_journal(journal)
+
+
+def _resume(journal, step, key):
+    """
+    If step finished before with the same key, applies its changes to env
+    and returns True
+    """
+    entry = journal.get(step.name)
+    if key is None or not entry or entry['key'] != key or not resume():
+        return False
+    _apply_env_changes(pickle.loads(base64.b64decode(entry['env'])))
+    info('{0}: {1} already done, skipping it'.format(env.host_string, step.name))
+    return True
+
+
+def _apply_env_changes(env_changes):
+    changed, removed = env_changes
+    env.update(changed)
+    for k in removed:
+        env.pop(k, None)
+
+
+def _check_steps(steps):
+    # Steps can only run after steps listed before them, so there are no cycles
+    names = set()
+    for step in steps:
+        if step.name in names:
+            abort('Duplicate deployment step {0}'.format(step.name))
+        for dep in step.after:
+            if dep not in names:
+                abort('Step {0} runs after {1}, which is not listed before it'.format(
+                    step.name, dep))
+        names.add(step.name)
+
+
+def _env_changes(before, after):
+    changed = {}
+    for k, v in after.items():
+        try:
+            if k in before and before[k] == v:
+                continue
+        except Exception:
+            pass
+        changed[k] = v
+    removed = [k for k in before if k not in after]
+    return changed, removed
+
+
+# The items of env and output seen by the current step thread, if any
+_step_items = threading.local()
+
+
+class _PerThread(object):
+    """
+    Makes the items of one of fabric's global dictionaries private to the
+    step threads: each works on its own copy, while the rest of the threads
+    see the original items
+    """
+    __slots__ = ()
+
+    def _items(self):
+        return getattr(_step_items, 'by_dict', {}).get(id(self))
+
+    def __getitem__(self, key):
+        items = self._items()
+        return super(_PerThread, self).__getitem__(key) if items is None else items[key]
+
+    def __setitem__(self, key, value):
+        items = self._items()
+        if items is None:
+            super(_PerThread, self).__setitem__(key, value)
+            return
+        # Like output's aliases, e.g. 'everything'
+        aliases = self.__dict__.get('aliases') or {}
+        if key in aliases:
+            for aliased in aliases[key]:
+                self[aliased] = value
+        else:
+            items[key] = value
+
+    def __delitem__(self, key):
+        items = self._items()
+        if items is None:
+            super(_PerThread, self).__delitem__(key)
+        else:
+            del items[key]
+
+    def __contains__(self, key):
+        items = self._items()
+        return super(_PerThread, self).__contains__(key) if items is None else key in items
+
+    def __iter__(self):
+        items = self._items()
+        return super(_PerThread, self).__iter__() if items is None else iter(items)
+
+    def __len__(self):
+        items = self._items()
+        return super(_PerThread, self).__len__() if items is None else len(items)
+
+    def __repr__(self):
+        items = self._items()
+        return super(_PerThread, self).__repr__() if items is None else repr(items)
+
+    def get(self, key, default=None):
+        items = self._items()
+        return super(_PerThread, self).get(key, default) if items is None else items.get(key, default)
+
+    def keys(self):
+        items = self._items()
+        return super(_PerThread, self).keys() if items is None else items.keys()
+
+    def values(self):
+        items = self._items()
+        return super(_PerThread, self).values() if items is None else items.values()
+
+    def items(self):
+        items = self._items()
+        return super(_PerThread, self).items() if items is None else items.items()
+
+    def copy(self):
+        items = self._items()
+        return super(_PerThread, self).copy() if items is None else items.copy()
+
+    def pop(self, key, *default):
+        items = self._items()
+        return super(_PerThread, self).pop(key, *default) if items is None else items.pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        items = self._items()
+        if items is None:
+            super(_PerThread, self).clear()
+        else:
+            items.clear()
+
+
+def _per_thread(d):
+    """
+    Turns the fabric dictionary d into one whose items can be private to
+    the step threads. Fabric modules hold direct references to env and
+    output, so instead of replacing them their class is changed in place.
+    """
+    if not isinstance(d, _PerThread):
+        # Their __setattr__ sets items
+        dict.__setattr__(d, '__class__', type('PerThread' + type(d).__name__,
+                                              (_PerThread, type(d)), {'__slots__': ()}))
+    return d
+
+
+def _start_step(step, outcomes):
+    """
+    Runs step in a thread with its own copy of env and output, putting its
+    name and outcome into outcomes once it finishes
+    """
+    own_items = dict((id(d), dict(_per_thread(d))) for d in (env, state.output))
+
+    def run_step():
+        _step_items.by_dict = own_items
+        try:
+            before = _env_snapshot()
+            step.func()
+            outcome = (True, _env_changes(before, _env_snapshot()))
+        except BaseException as e:
+            outcome = (False, str(e) if isinstance(e, SystemExit) else traceback.format_exc())
+        outcomes.put((step.name, outcome))
+
+    thread = threading.Thread(target=run_step, name='{0}: {1}'.format(env.host_string, step.name))
+    thread.daemon = True
+    thread.start()
+
+
+def critical_path(steps, timings):
+    """
+    Returns the names of the steps in the critical path: starting from the
+    last step to finish, the dependency that finished last, and so on
+    """
+    by_name = dict((s.name, s) for s in steps)
+    current = max(timings, key=lambda name: timings[name][1])
+    path = [current]
+    while True:
+        deps = [d for d in by_name[current].after if d in timings]
+        if not deps:
+            break
+        current = max(deps, key=lambda name: timings[name][1])
+        path.append(current)
+    return list(reversed(path))
+
+
+def report_timings(steps, timings, skipped=()):
+    if skipped:
+        info('Resumed deployment on {0}, skipped: {1}'.format(
+            env.host_string, ', '.join(skipped)))
+    if not timings:
+        return
+    path = critical_path(steps, timings)
+    info('Deployment steps on {0}:'.format(env.host_string))
+    puts('{0:<20} {1:>10} {2:>10} {3:>10}'.format('step', 'start [s]', 'end [s]', 'time [s]'))
+    for name, (start, end) in sorted(timings.items(), key=lambda x: x[1]):
+        puts('{0:<20} {1:>10.1f} {2:>10.1f} {3:>10.1f}{4}'.format(
+            name, start, end, end - start, '  *' if name in path else ''))
+    total = max(end for _, end in timings.values())
+    busy = sum(end - start for start, end in timings.values())
+    puts('Critical path (*): {0}'.format(' -> '.join(path)))
+    puts('Total {0:.1f} [s], {1:.1f} [s] of steps'.format(total, busy))
+
+
+def _run_sequentially(steps, keys, journal):
+    timings = {}
+    skipped = []
+    t0 = time.time()
+    for step in steps:
+        if _resume(journal, step, keys[step.name]):
+            skipped.append(step.name)
+            continue
+        start = time.time() - t0
+        before = _env_snapshot()
+        try:
+            step.func()
+        except BaseException:
+            timings[step.name] = (start, time.time() - t0)
+            _forget(journal, step)
+            report_timings(steps, timings, skipped)
+            raise
+        timings[step.name] = (start, time.time() - t0)
+        _record(journal, step, keys[step.name], _env_changes(before, _env_snapshot()))
+    report_timings(steps, timings, skipped)
+    return timings
+
+
+def run_steps(steps):
+    """
+    Runs the given steps on the current host, each after the steps it
+    depends on and the independent ones concurrently. Returns the
+    (start, end) time of each step relative to the start of the first one.
+    """
+    _check_steps(steps)
+    keys = step_keys(steps)
+    journal = load_journal()
+    concurrency = step_concurrency()
+    if concurrency <= 1:
+        return _run_sequentially(steps, keys, journal)
+
+    # The steps share the connections of the host
+    install_connection_pool()
+    pending = list(steps)
+    running = {}
+    outcomes = queue.Queue()
+    done = set()
+    timings = {}
+    skipped = []
+    errors = []
+    t0 = time.time()
+    while pending or running:
+        if not errors:
+            for step in list(pending):
+                if len(running) >= concurrency:
+                    break
+                if all(d in done for d in step.after):
+                    pending.remove(step)
+                    if _resume(journal, step, keys[step.name]):
+                        skipped.append(step.name)
+                        done.add(step.name)
+                        continue
+                    info('{0}: starting {1}'.format(env.host_string, step.name))
+                    _start_step(step, outcomes)
+                    running[step.name] = (step, time.time() - t0)
+        if not running:
+            break
+
+        # With a timeout, so the main thread can still be interrupted
+        try:
+            name, (ok, value) = outcomes.get(timeout=1)
+        except queue.Empty:
+            continue
+        step, start = running.pop(name)
+        end = time.time() - t0
+        timings[step.name] = (start, end)
+        if ok:
+            _apply_env_changes(value)
+            _record(journal, step, keys[step.name], value)
+            done.add(step.name)
+            success('{0}: {1} finished in {2:.1f} [s]'.format(
+                env.host_string, step.name, end - start), with_stars=False)
+        else:
+            _forget(journal, step)
+            errors.append((step.name, value))
+            failure('{0}: {1} failed'.format(env.host_string, step.name), with_stars=False)
+
+    report_timings(steps, timings, skipped)
+    if errors:
+        abort('\n'.join('Step {0} failed on {1}: {2}'.format(name, env.host_string, error)
+                        for name, error in errors))
+    return timings
+
+
+@task
+def show_journal():
+    """
+    Prints the deployment steps recorded as finished for the target host(s)
+    """
+    journal = load_journal()
+    if not journal:
+        info('No deployment steps recorded for {0}'.format(env.host_string))
+        return
+    for name, entry in sorted(journal.items(), key=lambda x: x[1]['finished']):
+        puts('{0}: {1:<20} finished at {2}'.format(
+            env.host_string, name,
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['finished']))))
+
+
+@task
+def clear_journal():
+    """
+    Removes the journal of the target host(s), so that their next
+    deployment runs all steps
+    """
+    try:
+        os.unlink(_journal_file())
+    except OSError:
+        pass
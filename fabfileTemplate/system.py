@@ -22,18 +22,27 @@
 """
 Module containing system-level utility methods and fabric tasks
 """
+import hashlib
+import json
 import os
+import shutil
+import time
 from six.moves.urllib import parse as urlparse
+from six.moves.urllib import request as urlrequest
+from six.moves.urllib.error import HTTPError
 
 from fabric.colors import blue, green
 from fabric.context_managers import cd, settings
 from fabric.decorators import task
-from fabric.operations import prompt
+from fabric.operations import prompt, put, get
 from fabric.state import env
 from fabric.utils import puts, abort
 import pkg_resources
 
-from fabfileTemplate.utils import run, sudo, get_public_key
+from fabfileTemplate.facts import host_facts, host_fact, invalidate_host_facts, probed_fact, \
+    ARCH_COMMAND, OS_RELEASE_COMMAND
+from fabfileTemplate.utils import run, sudo, batch, get_public_key, default_if_empty, \
+    to_boolean, info, warning, success, local_cache_dir, local_lock
 
 
 # List of supported OSes
@@ -62,11 +71,40 @@ SUPPORTED_OS += SUPPORTED_OS_MAC
 # The directory under which MaxOSX's 'port' installs stuff
 MACPORT_DIR = '/opt/local'
 
+# How python is compiled by python_setup.
+# APP_PYTHON_MAKE_JOBS: number of parallel make jobs, 0 uses all remote CPUs
+# APP_PYTHON_CCACHE: compile through ccache, if installed in the host
+# APP_PYTHON_OPTIMIZATIONS: comma-separated list of 'pgo' and 'lto'. PGO
+#   trains the interpreter running the test suite, and takes much longer
+# APP_PYTHON_SKIP_TESTS: don't install (nor run) the test suite, which
+#   users opt into as it changes what gets installed
+# APP_PYTHON_PREBUILT: reuse the python built in another host with the same
+#   OS, architecture and settings, unpacking it instead of compiling it
+DEFAULT_PYTHON_MAKE_JOBS = 0
+DEFAULT_PYTHON_CCACHE = False
+DEFAULT_PYTHON_OPTIMIZATIONS = ''
+DEFAULT_PYTHON_SKIP_TESTS = False
+DEFAULT_PYTHON_PREBUILT = True
+
+# How system.download gets files into the hosts:
+# 'push': downloaded once into the control node's cache and uploaded through
+#   the SSH connection (hosts don't need internet access)
+# 'remote': each host downloads them with wget or curl
+DOWNLOAD_MODES = ['push', 'remote']
+DEFAULT_DOWNLOAD_MODE = 'push'
+PYTHON_OPTIMIZATIONS = {
+    'pgo': '--enable-optimizations',
+    'lto': '--with-lto',
+}
+
 @task
 def check_command(command, *args, **kwargs):
     """
     Check existence of command remotely
     """
+    facts = host_facts()
+    if 'cmd.' + command in facts:
+        return facts['cmd.' + command]
     res = run('if command -v {0} &> /dev/null ;then command -v {0};else echo ;fi'.format(command), *args, **kwargs)
     return res
 
@@ -75,6 +113,9 @@ def check_dir(directory):
     """
     Check existence of remote directory
     """
+    facts = host_facts()
+    if 'dir.' + directory in facts:
+        return facts['dir.' + directory]
     res = run("""if [ -d {0} ]; then echo 1; else echo ; fi""".format(directory))
     return res
 
@@ -83,6 +124,9 @@ def check_path(path):
     """
     Check existence of remote path
     """
+    facts = host_facts()
+    if 'path.' + path in facts:
+        return facts['path.' + path]
     res = run('if [ -e {0} ]; then echo 1; else echo 0; fi'.format(path))
     return res
 
@@ -117,22 +161,25 @@ def get_linux_flavor():
     if 'linux_flavor' in env:
         return env.linux_flavor
 
+    facts = host_facts()
     linux_flavor = None
     # Try lsb_release
     if check_command('lsb_release'):
-        distributionId = run('lsb_release -i')
+        distributionId = facts.get('lsb_release') or run('lsb_release -i')
         if distributionId and distributionId.find(':') != -1:
             linux_flavor = distributionId.split(':')[1].strip()
 
     # Try python
     if not linux_flavor and check_command('python'):
-        lf = run("python -c 'import platform; print(platform.linux_distribution()[0])'")
+        lf = facts.get('python_distribution')
+        if lf is None:
+            lf = run("python -c 'import platform; print(platform.linux_distribution()[0])'")
         if lf:
             linux_flavor = lf.split()[0]
 
     # Try /etc/issue
     if not linux_flavor and check_path('/etc/issue') == '1':
-        re = run('cat /etc/issue')
+        re = facts.get('issue') or run('cat /etc/issue')
         issue = re.split()
         if issue:
             if issue[0] == 'CentOS' or issue[0] == 'Ubuntu' \
@@ -145,7 +192,7 @@ def get_linux_flavor():
 
     # Try uname -s
     if not linux_flavor:
-        linux_flavor = run('uname -s')
+        linux_flavor = facts.get('uname') or run('uname -s')
 
     # Sanitize
     if linux_flavor and type(linux_flavor) == type([]):
@@ -199,26 +246,128 @@ def postfix_config():
         prompt('GMail Password:', 'gmail_password')
 
     # Make sure postfix is there and not sendmail
-    sudo('service sendmail stop')
-    sudo('service postfix stop')
-    sudo('chkconfig sendmail off')
-    sudo('chkconfig sendmail --del')
-    sudo('chkconfig postfix --add')
-    sudo('chkconfig postfix on')
+    with batch():
+        sudo('service sendmail stop')
+        sudo('service postfix stop')
+        sudo('chkconfig sendmail off')
+        sudo('chkconfig sendmail --del')
+        sudo('chkconfig postfix --add')
+        sudo('chkconfig postfix on')
 
     # Set up the main configuration file and the password file
     puts(pkg_resources.resource_filename(__name__, 'main.cf'), '/etc/postfix/main.cf')  # @UndefinedVariable
-    sudo('echo "[smtp.gmail.com]:587 {0}@gmail.com:{1}" > /etc/postfix/sasl_passwd'.format(env.gmail_account, env.gmail_password))
-    sudo('chmod 400 /etc/postfix/sasl_passwd')
-    sudo('postmap /etc/postfix/sasl_passwd')
+    with batch():
+        sudo('echo "[smtp.gmail.com]:587 {0}@gmail.com:{1}" > /etc/postfix/sasl_passwd'.format(env.gmail_account, env.gmail_password))
+        sudo('chmod 400 /etc/postfix/sasl_passwd')
+        sudo('postmap /etc/postfix/sasl_passwd')
+
+        # Start it
+        sudo('service postfix start')
+
+def download_mode():
+    default_if_empty(env, 'APP_DOWNLOAD_MODE', DEFAULT_DOWNLOAD_MODE)
+    if env.APP_DOWNLOAD_MODE not in DOWNLOAD_MODES:
+        abort('APP_DOWNLOAD_MODE must be one of {0}'.format(', '.join(DOWNLOAD_MODES)))
+    return env.APP_DOWNLOAD_MODE
 
-    # Start it
-    sudo('service postfix start')
 
-def download(url, target=None, root=False):
+def _fetch(url, part, attempts=3):
+    """
+    Downloads url into part, resuming from whatever part already contains
+    """
+    for attempt in range(attempts):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+        try:
+            response = urlrequest.urlopen(urlrequest.Request(url, headers=headers), timeout=60)
+        except HTTPError as e:
+            if e.code == 416:
+                # Nothing left to download
+                return
+            raise
+        try:
+            # Servers not supporting ranges send the whole file again
+            mode = 'ab' if offset and response.getcode() == 206 else 'wb'
+            with open(part, mode) as f:
+                shutil.copyfileobj(response, f, 1 << 20)
+            return
+        except (IOError, OSError) as e:
+            if attempt == attempts - 1:
+                raise
+            warning('Download of {0} interrupted ({1}), resuming'.format(url, e),
+                    with_stars=False)
+        finally:
+            response.close()
+
+
+def _recorded_checksum(fname):
+    try:
+        with open(fname + '.sha256', 'rt') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def download_to_cache(url, sha256=None):
+    """
+    Returns the path of url in the download cache of the control node,
+    downloading it first if necessary. The file is verified against sha256
+    if given, or else against the checksum it had when first downloaded.
+    """
+    # Lazy import, fanout needs this module
+    from fabfileTemplate.fanout import local_checksum
+
+    parts = urlparse.urlparse(url)
+    fname = os.path.join(local_cache_dir('downloads'), '{0}-{1}'.format(
+        hashlib.sha1(url.encode('utf-8')).hexdigest()[:16],
+        parts.path.split('/')[-1] or 'index'))
+    with local_lock(fname + '.lock'):
+        if os.path.exists(fname):
+            expected = sha256 or _recorded_checksum(fname)
+            if local_checksum(fname) == expected:
+                return fname
+            warning('Cached download of {0} is corrupted or outdated, fetching it again'.format(url),
+                    with_stars=False)
+            os.unlink(fname)
+
+        info('Downloading {0}'.format(url))
+        _fetch(url, fname + '.part')
+        checksum = local_checksum(fname + '.part')
+        if sha256 and checksum != sha256:
+            os.unlink(fname + '.part')
+            abort('Checksum mismatch for {0}: expected {1}, got {2}'.format(url, sha256, checksum))
+        with open(fname + '.sha256', 'wt') as f:
+            f.write(checksum)
+        os.rename(fname + '.part', fname)
+    return fname
+
+
+def download(url, target=None, root=False, sha256=None):
+    """
+    Gets url into target (by default its basename, relative to the current
+    remote directory) on the current host, according to APP_DOWNLOAD_MODE
+    """
     if target is None:
         parts = urlparse.urlparse(url)
         target = parts.path.split('/')[-1]
+
+    from fabfileTemplate.fanout import fanout_degree, fanout_path, remote_checksum
+    if download_mode() == 'push':
+        fname = download_to_cache(url, sha256)
+        checksum = _recorded_checksum(fname)
+        # put() expands ~ before prepending the current directory, so with
+        # cd('~/.pip') it would write to a literal '~' directory. Resolve the
+        # absolute path remotely first
+        if not target.startswith('/'):
+            target = '{0}/{1}'.format(run('pwd', quiet=True).strip(), target)
+        if remote_checksum(target) != checksum:
+            # Use the copy distributed through the fan-out tree, if any
+            if fanout_degree() > 0 and remote_checksum(fanout_path(fname)) == checksum:
+                (sudo if root else run)('cp {0} {1}'.format(fanout_path(fname), target))
+            else:
+                put(fname, target, use_sudo=root)
+        return target
+
     if check_command('wget'):
         cmd = 'wget --no-check-certificate -q -O {0} {1}'.format(target, url)
     elif check_command('curl'):
@@ -229,9 +378,21 @@ def download(url, target=None, root=False):
         sudo(cmd)
     else:
         run(cmd)
+    if sha256 and remote_checksum(target) != sha256:
+        abort('Checksum mismatch for {0} downloaded in {1}'.format(url, env.host))
     return target
 
 
+def python_tarball():
+    """
+    Returns the python tarball in the download cache of the control node,
+    downloading it first, or None if python is not pushed from there
+    """
+    if not env.get('APP_PYTHON_URL') or download_mode() != 'push':
+        return None
+    return download_to_cache(env.APP_PYTHON_URL, env.get('APP_PYTHON_SHA256'))
+
+
 @task
 def check_python():
     """
@@ -239,27 +400,193 @@ def check_python():
     """
     return check_command('python{0}'.format(env.APP_PYTHON_VERSION))
 
+def python_make_jobs():
+    default_if_empty(env, 'APP_PYTHON_MAKE_JOBS', DEFAULT_PYTHON_MAKE_JOBS)
+    jobs = int(env.APP_PYTHON_MAKE_JOBS)
+    if jobs <= 0:
+        # Without facts (e.g., the cache is disabled) ask the host directly
+        cpus = host_fact('cpus') or run('nproc 2>/dev/null || getconf _NPROCESSORS_ONLN',
+                                        quiet=True, warn_only=True)
+        try:
+            jobs = int(cpus.strip() or 1)
+        except ValueError:
+            jobs = 1
+    return max(jobs, 1)
+
+
+def python_major_version():
+    try:
+        return int(str(env.APP_PYTHON_VERSION).split('.')[0])
+    except (AttributeError, ValueError):
+        return 3
+
+
+def python_optimizations():
+    default_if_empty(env, 'APP_PYTHON_OPTIMIZATIONS', DEFAULT_PYTHON_OPTIMIZATIONS)
+    opts = [o.strip() for o in env.APP_PYTHON_OPTIMIZATIONS.split(',') if o.strip()]
+    for o in opts:
+        if o not in PYTHON_OPTIMIZATIONS:
+            abort('Unknown python optimization {0}, must be one of {1}'.format(
+                o, ', '.join(PYTHON_OPTIMIZATIONS)))
+    return opts
+
+
+def python_build_env():
+    """
+    Returns the variables with which python is configured and compiled
+    """
+    default_if_empty(env, 'APP_PYTHON_CCACHE', DEFAULT_PYTHON_CCACHE)
+    build_env = {}
+    if to_boolean(env.APP_PYTHON_CCACHE):
+        if check_command('ccache'):
+            build_env['CC'] = 'ccache gcc'
+        else:
+            warning('ccache not found in {0}, compiling without it'.format(env.host),
+                    with_stars=False)
+    return build_env
+
+
+def _record_python_build(timings, settings_used):
+    """
+    Appends the timings of a python build to a log in the control node
+    """
+    record = dict(settings_used, host=env.host_string, finished=time.time(),
+                  timings=timings)
+    with open(os.path.join(local_cache_dir('builds'), 'python.jsonl'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def python_build_key():
+    """
+    Returns the hash identifying the python built for the current host:
+    its OS and architecture, and the python version and build settings
+    """
+    default_if_empty(env, 'APP_PYTHON_SKIP_TESTS', DEFAULT_PYTHON_SKIP_TESTS)
+    h = hashlib.sha256()
+    for item in (get_linux_flavor(), probed_fact('os_release', OS_RELEASE_COMMAND),
+                 probed_fact('arch', ARCH_COMMAND),
+                 env.APP_PYTHON_VERSION, env.APP_PYTHON_URL, ','.join(python_optimizations()),
+                 str(to_boolean(env.APP_PYTHON_SKIP_TESTS))):
+        h.update(str(item).encode('utf-8') + b'\n')
+    return 'python{0}-{1}'.format(env.APP_PYTHON_VERSION, h.hexdigest()[:16])
+
+
+def _python_build_file(key):
+    return os.path.join(local_cache_dir('pythons'), key + '.tar.gz')
+
+
+def restore_python_build(key, ppath):
+    """
+    Unpacks the python prebuilt for key into ppath, if there is one.
+    Python's scripts and build configuration hardcode the prefix it was
+    built with, so these are rewritten if it was built somewhere else.
+    """
+    tarball = _python_build_file(key)
+    if not os.path.exists(tarball):
+        return False
+    with open(tarball + '.prefix', 'rt') as f:
+        prefix = f.read().strip()
+    remote_tarball = '/tmp/{0}.tar.gz'.format(key)
+    put(tarball, remote_tarball)
+    run('mkdir -p {0} && tar xzf {1} -C {0} && rm {1}'.format(ppath, remote_tarball))
+    if prefix != ppath:
+        run("grep -rlI '{0}' {1} | xargs sed -i 's|{0}|{1}|g'".format(prefix, ppath),
+            warn_only=True)
+    invalidate_host_facts()
+    success('Python restored from prebuilt {0}'.format(key))
+    return True
+
+
+def save_python_build(key, ppath):
+    """
+    Stores the python installed in ppath as the prebuilt for key
+    """
+    tarball = _python_build_file(key)
+    remote_tarball = '/tmp/{0}.tar.gz'.format(key)
+    run('tar czf {0} -C {1} .'.format(remote_tarball, ppath))
+    get(remote_tarball, tarball + '.tmp')
+    run('rm {0}'.format(remote_tarball))
+    with open(tarball + '.prefix', 'wt') as f:
+        f.write(ppath)
+    os.rename(tarball + '.tmp', tarball)
+    info('Saved prebuilt python {0}'.format(key))
+
+
 @task
 def python_setup(ppath):
     """
     Ensure that there is the right version of python available
     If not install it from scratch in user directory.
     """
+    default_if_empty(env, 'APP_PYTHON_PREBUILT', DEFAULT_PYTHON_PREBUILT)
+    if not to_boolean(env.APP_PYTHON_PREBUILT):
+        return build_python(ppath)
+
+    # The first host with a given key builds python while the rest wait for
+    # it, then unpack its build
+    key = python_build_key()
+    if not restore_python_build(key, ppath):
+        with local_lock(_python_build_file(key) + '.lock'):
+            if not restore_python_build(key, ppath):
+                build_python(ppath)
+                save_python_build(key, ppath)
+    return '{0}/bin/python{1}'.format(ppath, env.APP_PYTHON_VERSION)
+
+
+def build_python(ppath):
+    """
+    Downloads, compiles and installs python into ppath
+    """
+    default_if_empty(env, 'APP_PYTHON_SKIP_TESTS', DEFAULT_PYTHON_SKIP_TESTS)
+    jobs = python_make_jobs()
+    optimizations = python_optimizations()
+    skip_tests = to_boolean(env.APP_PYTHON_SKIP_TESTS)
+    build_env = python_build_env()
+
+    configure_args = ['--prefix {0}'.format(ppath)]
+    configure_args += [PYTHON_OPTIMIZATIONS[o] for o in optimizations]
+    if skip_tests:
+        # Understood by python >= 3.10, older versions ignore it
+        configure_args.append('--disable-test-modules')
+    make_args = ['-j{0}'.format(jobs)]
+    if 'pgo' in optimizations and python_major_version() >= 3:
+        # The training runs the test suite, make it use all CPUs too.
+        # python 2's regrtest doesn't know --pgo, it keeps its default task
+        make_args.append('PROFILE_TASK="-m test --pgo -j{0}"'.format(jobs))
+    variables = ' '.join('{0}="{1}"'.format(k, v) for k, v in sorted(build_env.items()))
+
+    timings = []
+    def phase(name, command):
+        puts(green('{0} Python.....'.format(name)))
+        start = time.time()
+        run(command)
+        timings.append((name, time.time() - start))
+
+    start = time.time()
     with cd('/tmp'):
-        download(env.APP_PYTHON_URL)
+        download(env.APP_PYTHON_URL, sha256=env.get('APP_PYTHON_SHA256'))
         base = os.path.basename(env.APP_PYTHON_URL)
         pdir = os.path.splitext(base)[0]
         run('tar -xzf {0}'.format(base))
+    timings.append(('Downloading', time.time() - start))
     with cd('/tmp/{0}'.format(pdir)):
         puts('Python BUILD log-file can be found in: /tmp/py_install.log')
-        puts(green('Configuring Python.....'))
-        run('./configure --prefix {0} > /tmp/py_install.log 2>&1;'.format(ppath))
-        puts(green('Building Python.....'))
-        run('make >> /tmp/py_install.log 2>&1;')
-        puts(green('Installing Python.....'))
-        run('make install >> /tmp/py_install.log 2>&1')
+        phase('Configuring', '{0} ./configure {1} > /tmp/py_install.log 2>&1;'.format(
+            variables, ' '.join(configure_args)))
+        phase('Building', 'make {0} >> /tmp/py_install.log 2>&1;'.format(' '.join(make_args)))
+        if not skip_tests:
+            phase('Testing', 'make test TESTOPTS="-j{0}" >> /tmp/py_install.log 2>&1'.format(jobs))
+        phase('Installing', 'make -j{0} install >> /tmp/py_install.log 2>&1'.format(jobs))
         ppath = '{0}/bin/python{1}'.format(ppath, env.APP_PYTHON_VERSION)
         run('rm -rf /tmp/Python*')
+    invalidate_host_facts()
+
+    info('Python built with {0} jobs{1} in {2:.1f} [s]: {3}'.format(
+        jobs, ' and ccache' if build_env else '', sum(t for _, t in timings),
+        ', '.join('{0} {1:.1f} [s]'.format(name.lower(), t) for name, t in timings)))
+    _record_python_build(timings, {'version': env.APP_PYTHON_VERSION, 'jobs': jobs,
+                                   'ccache': bool(build_env), 'optimizations': optimizations,
+                                   'skip_tests': skip_tests})
     return ppath
 
 def get_fab_public_key():
@@ -298,22 +625,26 @@ def create_user(user):
     #       Also, these commands are linux-specific,
     #       there are others that work on MacOS
     group = user.lower()
-    sudo('groupadd ' + group, warn_only=True)
-    sudo('useradd -g {0} -m -s /bin/bash {1}'.format(group, user), warn_only=True)
-    sudo('mkdir /home/{0}/.ssh'.format(user), warn_only=True)
-    sudo('chmod 700 /home/{0}/.ssh'.format(user))
-    sudo('chown -R {0}:{1} /home/{0}/.ssh'.format(user,group))
-
-    # Copy the public key of our SSH key if we're using one
     public_key = get_fab_public_key()
-    if public_key:
-        sudo("echo '{0}' >> /home/{1}/.ssh/authorized_keys".format(public_key, user))
-        sudo('chmod 600 /home/{0}/.ssh/authorized_keys'.format(user))
-        sudo('chown {0}:{1} /home/{0}/.ssh/authorized_keys'.format(user, group))
+
+    # None of these depend on each other's output, send them in one go
+    with batch():
+        sudo('groupadd ' + group, warn_only=True)
+        sudo('useradd -g {0} -m -s /bin/bash {1}'.format(group, user), warn_only=True)
+        sudo('mkdir /home/{0}/.ssh'.format(user), warn_only=True)
+        sudo('chmod 700 /home/{0}/.ssh'.format(user))
+        sudo('chown -R {0}:{1} /home/{0}/.ssh'.format(user,group))
+
+        # Copy the public key of our SSH key if we're using one
+        if public_key:
+            sudo("echo '{0}' >> /home/{1}/.ssh/authorized_keys".format(public_key, user))
+            sudo('chmod 600 /home/{0}/.ssh/authorized_keys'.format(user))
+            sudo('chown {0}:{1} /home/{0}/.ssh/authorized_keys'.format(user, group))
 
     # openSUSE creates a suboptimal ~/.profile because it shows an error message
     # if /etc/profile doesn't exist (which is the case on openSUES dockers),
     # so we comment out that particular line
+    invalidate_host_facts()
     if get_linux_flavor() == 'openSUSE':
         with settings(user=user):
             run('''sed -i 's/^test -z "$PROFILEREAD".*/#\\0/' ~/.profile ''')
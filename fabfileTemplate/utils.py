@@ -23,10 +23,13 @@
 Various utilities used throughout the rest of the modules
 """
 
-import math
+import contextlib
+import fcntl
 import os
 import socket
+import subprocess
 import time
+import uuid
 from six.moves import urllib
 
 from fabric.colors import green, red, yellow, blue
@@ -34,7 +37,7 @@ from fabric.context_managers import settings, hide
 from fabric.decorators import task, parallel
 from fabric.exceptions import NetworkError
 from fabric.operations import run as frun, sudo as fsudo
-from fabric.state import env
+from fabric.state import env, connections
 from fabric.utils import puts, abort
 
 
@@ -87,6 +90,10 @@ def whatsmyip():
 
 
 def home():
+    from fabfileTemplate.facts import host_fact
+    user_home = host_fact('home.{0}'.format(env.APP_USER))
+    if user_home:
+        return user_home
     return run('echo ~{0}'.format(env.APP_USER), quiet=True)
 
 
@@ -98,24 +105,28 @@ def check_ssh(timeout=60.):
     """
     Check availability of SSH
     """
-    each_timeout = 5.
-    ntries = math.ceil(timeout / each_timeout)
-    tries = 0
-
-    sleep_time = 0
-    while tries < ntries:
-        time.sleep(sleep_time)
-        start = time.time()
-        try:
-            with settings(timeout=each_timeout, warn_only=True):
-                run('echo', quiet=True)
-                puts(green("SSH is working!"))
-            return
-        except NetworkError:
-            tries += 1
-            puts(yellow("Cannot connect through SSH (%d/%d tries)" % (tries, ntries)))
-            sleep_time = each_timeout - (time.time() - start)
-            sleep_time = max(sleep_time, 0)
+    # Lazy import, readiness needs this module
+    from fabfileTemplate.readiness import ready_hosts
+
+    # Wait cheaply for the SSH server to answer, then for a session to work
+    # (e.g., cloud instances install the key only after sshd starts)
+    timeout = float(timeout)
+    start = time.time()
+    for _ in ready_hosts([env.host_string], timeout, failed=[]):
+        delay = 1.
+        while True:
+            try:
+                with settings(timeout=5, warn_only=True):
+                    run('echo', quiet=True)
+                    puts(green("SSH is working!"))
+                return
+            except NetworkError:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+                puts(yellow("SSH server is up, but cannot open a session yet"))
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 10.)
 
     error = "No SSH connection could be established to %s after %.2f seconds.\n" % (env.host, timeout)
     if is_localhost():
@@ -133,9 +144,152 @@ def check_ssh(timeout=60.):
     abort(error)
 
 
+class BatchedCommand(object):
+    """
+    The result of a command queued in a CommandBatch. Its output and exit
+    status are only available after the batch has been flushed.
+    """
+
+    def __init__(self, command, warn_only, quiet):
+        self.command = command
+        self.warn_only = warn_only
+        self.quiet = quiet
+        self.output = ''
+        self.return_code = None
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+    def __str__(self):
+        return self.output
+
+    def __bool__(self):
+        return bool(self.output)
+    __nonzero__ = __bool__
+
+
+class CommandBatch(object):
+    """
+    Queues consecutive commands and sends them to the remote host as a
+    single script, so N commands cost a single round-trip.
+
+    Commands are grouped in segments run by the same user and with the same
+    (sudo or not) mechanism; a new segment flushes the previous one.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.commands = []
+
+    def add(self, command, use_sudo, kwargs):
+        key = (use_sudo, env.host_string, env.user, kwargs.get('user'))
+        if key != self.key:
+            self.flush()
+            self.key = key
+        # sudo() runs its commands with quiet=True, which implies warn_only,
+        # so failed ones don't abort outside of a batch either
+        warn_only = use_sudo or kwargs.get('warn_only', False) or env.warn_only
+        quiet = use_sudo or kwargs.get('quiet', False)
+        res = BatchedCommand(command, warn_only, quiet)
+        # The working directory is that at the time the command is queued
+        if env.cwd:
+            res.command = 'cd {0} && {1}'.format(env.cwd, command)
+        self.commands.append(res)
+        return res
+
+    def script(self, marker):
+        lines = ['unset PYTHONPATH']
+        for i, res in enumerate(self.commands):
+            lines += [
+                'echo "{0} {1} BEGIN"'.format(marker, i),
+                '( {0} ) 2>&1'.format(res.command),
+                'rc=$?',
+                'echo "{0} {1} END $rc"'.format(marker, i),
+            ]
+            if not res.warn_only:
+                lines.append('[ $rc -eq 0 ] || exit $rc')
+        return '\n'.join(lines)
+
+    def parse(self, marker, output, commands):
+        current = None
+        lines = []
+        for line in output.splitlines():
+            if line.startswith(marker):
+                fields = line.split()
+                idx = int(fields[1])
+                if fields[2] == 'BEGIN':
+                    current, lines = idx, []
+                elif fields[2] == 'END' and idx == current:
+                    res = commands[idx]
+                    res.output = '\n'.join(lines)
+                    res.return_code = int(fields[3])
+                    current = None
+            elif current is not None:
+                lines.append(line)
+
+    def flush(self):
+        if not self.commands:
+            return
+        use_sudo, host_string, user, sudo_user = self.key
+        marker = '__batch_{0}__'.format(uuid.uuid4().hex)
+        script = self.script(marker)
+        commands, self.commands = self.commands, []
+        with settings(hide('running', 'stdout', 'stderr'),
+                      host_string=host_string, user=user, cwd='',
+                      warn_only=True):
+            if use_sudo:
+                out = fsudo(script, quiet=True, pty=False, user=sudo_user)
+            else:
+                out = frun(script, quiet=True, pty=False)
+        self.parse(marker, out, commands)
+
+        for res in commands:
+            if not res.quiet and res.output:
+                puts(res.output)
+            if res.return_code is None:
+                abort("Batched command was not executed: {0}\n\n{1}".format(
+                      res.command, out))
+            if res.failed and not res.warn_only:
+                abort("{0}() received nonzero return code {1} while executing!"
+                      "\n\nRequested: {2}\n\n{3}".format(
+                          'sudo' if use_sudo else 'run', res.return_code,
+                          res.command, res.output))
+
+
+@contextlib.contextmanager
+def batch():
+    """
+    Context manager queueing all run() and sudo() invocations done inside it
+    and executing them in a single remote script when the context is left.
+    Nested batches join the outer one.
+
+    Commands inside a batch must not depend on each other's output, since
+    the BatchedCommand objects they return are filled only after the batch
+    has been flushed.
+    """
+    if env.get('command_batch'):
+        yield env.command_batch
+        return
+    cmd_batch = CommandBatch()
+    env.command_batch = cmd_batch
+    try:
+        yield cmd_batch
+    finally:
+        env.command_batch = None
+    cmd_batch.flush()
+
+
 # Replacement functions for running commands
 # They wrap up the command with useful things
 def run(*args, **kwargs):
+    if env.get('command_batch'):
+        puts('Queueing: {0}'.format(args[0]))
+        return env.command_batch.add(args[0], False, kwargs)
     with hide('running'):
         com = args[0]
         com = 'unset PYTHONPATH; {0}'.format(com)
@@ -148,6 +302,9 @@ def run(*args, **kwargs):
 
 
 def sudo(*args, **kwargs):
+    if env.get('command_batch'):
+        puts('Queueing: {0}'.format(args[0]))
+        return env.command_batch.add(args[0], True, kwargs)
     with hide('running'):
         com = args[0]
         com = 'unset PYTHONPATH; {0}'.format(com)
@@ -156,6 +313,64 @@ def sudo(*args, **kwargs):
     return res
 
 
+def stream_to_remote(local_command, remote_command, bufsize=65536):
+    """
+    Pipes the standard output of a local command into the standard input
+    of a remote command, through a new channel of the current host's SSH
+    connection. No temporary files are created on either side. If
+    local_command is a pipeline, any of its commands failing fails it.
+
+    Returns the number of bytes sent.
+    """
+    puts('Streaming: {0} => {1}'.format(local_command, remote_command))
+    proc = subprocess.Popen('set -o pipefail; ' + local_command, shell=True,
+                            executable='/bin/bash', stdout=subprocess.PIPE)
+    chan = connections[env.host_string].get_transport().open_session()
+    nbytes = 0
+    try:
+        chan.exec_command('unset PYTHONPATH; {0}'.format(remote_command))
+        for chunk in iter(lambda: proc.stdout.read(bufsize), b''):
+            chan.sendall(chunk)
+            nbytes += len(chunk)
+        chan.shutdown_write()
+        status = chan.recv_exit_status()
+        errors = chan.makefile_stderr('rb').read().decode('utf-8', 'replace')
+    except socket.error as e:
+        proc.kill()
+        abort('Streaming to {0} failed: {1}'.format(env.host_string, e))
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        chan.close()
+    if proc.returncode != 0:
+        abort('Local command failed with status {0}: {1}'.format(proc.returncode, local_command))
+    if status != 0:
+        abort('Remote command failed with status {0}: {1}\n{2}'.format(status, remote_command, errors))
+    return nbytes
+
+
+def exchange_with_remote(remote_command, data):
+    """
+    Runs a remote command through a new channel of the current host's SSH
+    connection, feeding it data on its standard input.
+
+    Returns the standard output of the command.
+    """
+    chan = connections[env.host_string].get_transport().open_session()
+    try:
+        chan.exec_command('unset PYTHONPATH; {0}'.format(remote_command))
+        chan.sendall(data)
+        chan.shutdown_write()
+        stdout = chan.makefile('rb').read()
+        errors = chan.makefile_stderr('rb').read().decode('utf-8', 'replace')
+        status = chan.recv_exit_status()
+    finally:
+        chan.close()
+    if status != 0:
+        abort('Remote command failed with status {0}: {1}\n{2}'.format(status, remote_command, errors))
+    return stdout
+
+
 def is_localhost():
     # ensure something is run in that host
     if not env.host:
@@ -191,6 +406,39 @@ def repo_root():
     return os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 
+def local_cache_dir(*subdirs):
+    """
+    Returns (and creates if necessary) a directory on the control node
+    used to cache data across fab runs. The base directory can be changed
+    through the APP_LOCAL_CACHE_DIR env variable.
+    """
+    default_if_empty(env, 'APP_LOCAL_CACHE_DIR',
+                     os.path.expanduser('~/.fabfileTemplate'))
+    path = os.path.join(env.APP_LOCAL_CACHE_DIR, *subdirs)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another (parallel) process might have created it already
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+@contextlib.contextmanager
+def local_lock(path):
+    """
+    Context manager holding an exclusive lock on a file of the control node,
+    so that only one (parallel) fab process at a time enters the block
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def _colored_puts(msg, color, with_stars):
     if with_stars:
         puts(color("******** %s ********" % (msg,)))
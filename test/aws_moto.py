@@ -0,0 +1,79 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Base test case running the AWS functions against moto's EC2 mock
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+from fabric.state import env
+
+from fabfileTemplate import aws
+
+
+class MotoEC2TestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {
+            'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1', 'USER': 'tester'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        moto = mock_aws()
+        moto.start()
+        self.addCleanup(moto.stop)
+        self.conn = boto3.client('ec2', region_name='us-east-1')
+        vpc_id = self.conn.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+        subnet_id = self.conn.create_subnet(VpcId=vpc_id, CidrBlock='10.0.0.0/24')['Subnet']['SubnetId']
+        ami_id = self.conn.describe_images()['Images'][0]['ImageId']
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        patcher = mock.patch.dict(env, {
+            'AWS_PROFILE': 'testing', 'AWS_REGION': 'us-east-1',
+            'AWS_VPC_ID': vpc_id, 'AWS_SUBNET_ID': subnet_id,
+            'AWS_KEY_NAME': 'testing', 'AWS_SEC_GROUP': 'testing',
+            'AWS_INSTANCE_TYPE': 't2.micro', 'AWS_WARM_POOL': 0,
+            'AMI_ID': ami_id, 'root': 'ec2-user', 'user': 'ec2-user',
+            'pkgs': {}, 'APP_LOCAL_CACHE_DIR': cache_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.patch(connect=mock.Mock(return_value=self.conn),
+                   APP_name=mock.Mock(return_value='APP'),
+                   APP_revision=mock.Mock(return_value='abcdef'),
+                   APP_user=mock.Mock(return_value='app'),
+                   whatsmyip=mock.Mock(return_value='127.0.0.1'),
+                   aws_create_key_pair=mock.Mock(),
+                   fill_warm_pool_in_background=mock.Mock())
+
+    def patch(self, module=aws, **attributes):
+        for name, value in attributes.items():
+            patcher = mock.patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
@@ -0,0 +1,94 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Tests of the pipelined creation and deployment of AWS instances against
+moto's EC2 mock
+"""
+import unittest
+from unittest import mock
+
+from fabric.state import env
+
+from aws_moto import MotoEC2TestCase
+from fabfileTemplate import aws, hl
+
+
+class PipelineTest(MotoEC2TestCase):
+
+    def setUp(self):
+        super(PipelineTest, self).setUp()
+        env.AWS_INSTANCES = 3
+        self.ready = []
+        self.patch(ready_hosts=self.ready_hosts, check_ssh=mock.Mock())
+
+    def ready_hosts(self, hosts):
+        # Hosts are probed as they are produced, not after all are running
+        self.assertFalse(isinstance(hosts, (list, tuple)))
+        for host in hosts:
+            self.ready.append(host)
+            yield host
+
+    def running_instances(self):
+        reservations = self.conn.describe_instances(Filters=[
+            {'Name': 'instance-state-name', 'Values': ['running']}])['Reservations']
+        return [i for r in reservations for i in r['Instances']]
+
+    def test_hosts(self):
+        hosts = aws.create_aws_instances_pipelined()
+        self.assertEqual([], env.hosts)
+        hosts = list(hosts)
+        self.assertEqual(3, len(set(hosts)))
+        self.assertEqual(hosts, self.ready)
+        self.assertEqual(hosts, env.hosts)
+        self.assertEqual(sorted(hosts), sorted(i['PublicDnsName'] for i in self.running_instances()))
+
+    def test_sessions_are_not_retried_serially(self):
+        for _ in aws.create_aws_instances_pipelined():
+            pass
+        aws.check_ssh.assert_not_called()
+
+    def test_deploy(self):
+        jobs = []
+
+        def execute_pipelined(t, host_source):
+            for host in host_source:
+                jobs.append((t, host))
+
+        self.patch(hl, aws_pipeline=mock.Mock(return_value=True),
+                   sources_tarball=mock.Mock(return_value='sources.tar.gz'),
+                   execute_pipelined=execute_pipelined)
+        hl.aws_deploy()
+        self.assertEqual([(hl._prepare_install_and_check_when_ready, host) for host in env.hosts],
+                         jobs)
+        self.assertEqual(3, len(jobs))
+
+    def test_session_retried_in_each_job(self):
+        calls = mock.Mock()
+        self.patch(hl, check_ssh=calls.check_ssh,
+                   prepare_install_and_check=calls.prepare_install_and_check)
+        hl._prepare_install_and_check_when_ready()
+        self.assertEqual([mock.call.check_ssh(timeout=300), mock.call.prepare_install_and_check()],
+                         calls.mock_calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Tests of the package cache against a local mirror stand-in
+"""
+import shutil
+import tempfile
+import threading
+import unittest
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from fabfileTemplate import pkgcache
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """
+    Serves the packages of the mirror, counting the requests for each path
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+class PackageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mirror = HTTPServer(('127.0.0.1', 0), MirrorHandler)
+        self.mirror.files = {'/repo/app-1.0.rpm': b'rpm contents',
+                             '/repo/repodata/repomd.xml': b'<repomd/>'}
+        self.mirror.requests = []
+        _start(self.mirror)
+        self.addCleanup(self.mirror.server_close)
+        self.addCleanup(self.mirror.shutdown)
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.proxy = pkgcache.PackageCacheServer(('127.0.0.1', 0), cache_dir,
+                                                 mirrors=['localhost'])
+        _start(self.proxy)
+        self.addCleanup(self.proxy.server_close)
+        self.addCleanup(self.proxy.shutdown)
+
+    def request(self, method, url):
+        conn = HTTPConnection(*self.proxy.server_address, timeout=10)
+        try:
+            conn.request(method, url)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def mirror_url(self, path, host='localhost'):
+        return 'http://{0}:{1}{2}'.format(host, self.mirror.server_address[1], path)
+
+    def test_packages_are_fetched_once(self):
+        url = self.mirror_url('/repo/app-1.0.rpm')
+        for _ in range(3):
+            self.assertEqual((200, b'rpm contents'), self.request('GET', url))
+        self.assertEqual(['/repo/app-1.0.rpm'], self.mirror.requests)
+        self.assertEqual(1, self.proxy.cache.stats['misses'])
+        self.assertEqual(2, self.proxy.cache.stats['hits'])
+
+    def test_metadata_is_not_cached(self):
+        url = self.mirror_url('/repo/repodata/repomd.xml')
+        for _ in range(2):
+            self.assertEqual((200, b'<repomd/>'), self.request('GET', url))
+        self.assertEqual(2, len(self.mirror.requests))
+
+    def test_upstream_errors_are_forwarded(self):
+        status, _ = self.request('GET', self.mirror_url('/repo/missing.rpm'))
+        self.assertEqual(404, status)
+
+    def test_other_hosts_are_refused(self):
+        # 127.0.0.1 is the mirror too, but not under a mirror domain
+        status, _ = self.request('GET', self.mirror_url('/repo/app-1.0.rpm', '127.0.0.1'))
+        self.assertEqual(403, status)
+        status, _ = self.request('GET', 'http://example.com/app-1.0.rpm')
+        self.assertEqual(403, status)
+        self.assertEqual([], self.mirror.requests)
+
+    def test_connect_only_to_mirrors(self):
+        # Not even after a plain HTTP request for the same host
+        self.request('GET', 'http://example.com/')
+        for target in ('example.com:443', 'localhost:{0}'.format(self.mirror.server_address[1])):
+            status, _ = self.request('CONNECT', target)
+            self.assertEqual(403, status)
+
+    def test_only_mirror_domains(self):
+        self.assertTrue(self.proxy.is_mirror('deb.debian.org'))
+        self.assertTrue(self.proxy.is_mirror('LOCALHOST'))
+        self.assertFalse(self.proxy.is_mirror('debian.org.example.com'))
+        self.assertFalse(self.proxy.is_mirror('notdebian.org'))
+
+
+if __name__ == '__main__':
+    unittest.main()
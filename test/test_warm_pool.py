@@ -0,0 +1,142 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Tests of the AWS warm pool against moto's EC2 mock
+"""
+import unittest
+from unittest import mock
+
+from fabric.state import env
+
+from aws_moto import MotoEC2TestCase
+from fabfileTemplate import aws
+
+
+class WarmPoolTest(MotoEC2TestCase):
+
+    def setUp(self):
+        super(WarmPoolTest, self).setUp()
+        env.AWS_WARM_POOL = 2
+        self.patch(WARM_POOL_CLAIM_SETTLE=0)
+
+    def fill(self, side_effect=None):
+        with mock.patch.object(aws, 'running_hosts', lambda conn, instances: ['host'] * len(instances)), \
+             mock.patch.object(aws, 'ready_hosts', lambda hosts: hosts), \
+             mock.patch.object(aws, 'execute_on_hosts', side_effect=side_effect) as execute:
+            aws.fill_warm_pool()
+        return execute
+
+    def state(self, instance_id):
+        return aws._instance_states(self.conn, [instance_id])[instance_id][0]
+
+    def tags(self, instance_id):
+        return aws._instance_states(self.conn, [instance_id])[instance_id][1]
+
+    def test_fill(self):
+        execute = self.fill()
+        execute.assert_called_once_with(aws.prepare_install_and_check)
+        self.assertEqual(2, len(aws.pool_instances(self.conn, ('stopping', 'stopped'))))
+
+        # A full pool is left alone
+        execute = self.fill()
+        execute.assert_not_called()
+
+    def test_fill_failure_terminates_instances(self):
+        self.assertRaises(SystemExit, self.fill, SystemExit(1))
+        states = ('pending', 'running', 'stopping', 'stopped')
+        self.assertEqual([], aws.pool_instances(self.conn, states))
+        self.assertEqual(2, len(aws.pool_instances(self.conn, ('shutting-down', 'terminated'))))
+
+    def test_claim(self):
+        self.fill()
+        pool = aws.pool_instances(self.conn)
+
+        claimed = aws.claim_pool_instances(self.conn, 1, 'deployed')
+        self.assertEqual(1, len(claimed))
+        self.assertIn(claimed[0], pool)
+        tags = self.tags(claimed[0])
+        self.assertEqual('deployed', tags['Name'])
+        self.assertNotIn(aws.WARM_POOL_TAG, tags)
+        self.assertNotIn(aws.WARM_POOL_CLAIM_TAG, tags)
+        self.assertEqual(sorted(set(pool) - set(claimed)), sorted(aws.pool_instances(self.conn)))
+
+        # The rest, and then nothing
+        self.assertEqual(1, len(aws.claim_pool_instances(self.conn, 2, 'deployed')))
+        self.assertEqual([], aws.claim_pool_instances(self.conn, 1, 'deployed'))
+
+    def test_claim_only_matching_pool(self):
+        self.fill()
+        env.AWS_INSTANCE_TYPE = 't2.small'
+        self.assertEqual([], aws.claim_pool_instances(self.conn, 2, 'deployed'))
+
+    def test_claim_lost_to_concurrent_claim(self):
+        self.fill()
+        pool = aws.pool_instances(self.conn)
+
+        def claim_concurrently(_):
+            self.conn.create_tags(Resources=pool, Tags=[
+                {'Key': aws.WARM_POOL_CLAIM_TAG, 'Value': 'someone else'}])
+
+        with mock.patch.object(aws.time, 'sleep', claim_concurrently):
+            self.assertEqual([], aws.claim_pool_instances(self.conn, 2, 'deployed'))
+        self.assertEqual(sorted(pool), sorted(aws.pool_instances(self.conn)))
+
+    def claim_found_before(self, pool):
+        # A concurrent claim that found the instances in the pool before
+        # they were taken out of it
+        with mock.patch.object(aws, 'pool_instances', return_value=pool):
+            return aws.claim_pool_instances(self.conn, len(pool), 'other')
+
+    def test_claim_lost_after_leaving_pool(self):
+        self.fill()
+        pool = aws.pool_instances(self.conn)
+        sleeps = []
+        other = []
+
+        # The other claim tags the instances after this one took them out
+        # of the pool, and gets them
+        def claim_concurrently(_):
+            sleeps.append(1)
+            if len(sleeps) == 2:
+                other.extend(self.claim_found_before(pool))
+
+        with mock.patch.object(aws.time, 'sleep', claim_concurrently):
+            self.assertEqual([], aws.claim_pool_instances(self.conn, 2, 'deployed'))
+        self.assertEqual(sorted(pool), sorted(other))
+        for instance_id in pool:
+            self.assertEqual('other', self.tags(instance_id)['Name'])
+            self.assertNotEqual('stopped', self.state(instance_id))
+
+    def test_claim_too_late(self):
+        self.fill()
+        pool = aws.pool_instances(self.conn)
+        claimed = aws.claim_pool_instances(self.conn, 2, 'deployed')
+        self.assertEqual(sorted(pool), sorted(claimed))
+
+        # The instances were started already, whatever the tag says now
+        self.assertEqual([], self.claim_found_before(pool))
+        for instance_id in pool:
+            self.assertEqual('deployed', self.tags(instance_id)['Name'])
+
+
+if __name__ == '__main__':
+    unittest.main()